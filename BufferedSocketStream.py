@@ -1,25 +1,96 @@
 import socket as sockets
+from typing import Callable, Tuple, Union, TypeVar, List, Optional
+
+T = TypeVar('T')
 
 
 class BufferedSocketStream:
-    def __init__(self, socket: sockets.socket):
+    """
+    receives into one preallocated buffer with recv_into, consuming bytes only moves the read offset.
+    unread bytes are moved to the front of the buffer only when the next read does not fit behind them,
+    and the buffer grows only for frames bigger than itself.
+    views returned by read and passed to frame parsers are valid until the next read
+    """
+
+    def __init__(self, socket: sockets.socket, capacity=64 * 1024, on_receive: Optional[Callable[[int], None]] = None):
         self.socket = socket
-        self.buffer = bytearray()
-        self.size = 0
+        self.on_receive = on_receive  # gets the byte count of every recv
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unread byte
+        self.end = 0  # end of received bytes
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
 
-    def read(self, count) -> bytes:
+    def read(self, count) -> memoryview:
         """
-        block until "count" bytes are available and return them
+        block until "count" bytes are available and return a view of them
+        """
+        self._fill(count)
+        part = self.view[self.start:self.start + count]
+        self._consume(count)
+        return part
+
+    def read_frame(self, parse: Callable[[memoryview], Union[Tuple[T, int], int]]) -> T:
+        """
+        block until parse finds a complete frame at the read position and return it.
+        parse gets a view of all buffered bytes and returns (frame, frame_size),
+        or the number of bytes it needs to see when the frame is not complete yet
         """
         while True:
-            if count <= self.size:
-                part = self.buffer[:count]
-                self.buffer = self.buffer[count:]
-                self.size -= count
-                return part
-            received = self.socket.recv(64 * 1024)
-
-            if received == b'':
+            parsed = parse(self.view[self.start:self.end])
+            if isinstance(parsed, tuple):
+                frame, frame_size = parsed
+                self._consume(frame_size)
+                return frame
+            self._fill(max(parsed, self.size + 1))
+
+    def read_frames(self, decode: Callable[[memoryview], Tuple[List[T], int, int]]) -> List[T]:
+        """
+        block until at least one complete frame is buffered and return all complete frames.
+        decode gets a view of all buffered bytes and returns
+        (frames, bytes consumed, bytes needed by the incomplete frame that follows)
+        """
+        while True:
+            frames, consumed, needed = decode(self.view[self.start:self.end])
+            if frames:
+                self._consume(consumed)
+                return frames
+            self._fill(max(needed, self.size + 1))
+
+    def _consume(self, count):
+        self.start += count
+        if self.start == self.end:
+            self.start = self.end = 0  # empty, next recv lands at the front for free
+
+    def _fill(self, count):
+        """
+        block until "count" bytes are buffered
+        """
+        while self.end - self.start < count:
+            if self.start + count > len(self.buffer):
+                self._compact(count)
+            received = self.socket.recv_into(self.view[self.end:])
+            if received == 0:
                 raise ConnectionError("received 0 bytes possibly socket disconnected")
-            self.buffer.extend(received)
-            self.size += len(received)
+            self.end += received
+            if self.on_receive:
+                self.on_receive(received)
+
+    def _compact(self, count):
+        """
+        make room for "count" unread bytes at the front of the buffer
+        """
+        size = self.end - self.start
+        if count > len(self.buffer):
+            # never resize in place, views handed out earlier keep the old buffer alive
+            buffer = bytearray(max(count, 2 * len(self.buffer)))
+            buffer[:size] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.view[:size] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = size
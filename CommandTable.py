@@ -0,0 +1,55 @@
+"""
+server commands by their leading /verb. a message finds its command with one dict lookup on the text before the
+first space, and chat text that does not start with '/' is told apart by its first character
+"""
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+Handler = Callable[..., None]  # (this_user, message, argument)
+
+
+class Command(NamedTuple):
+    verb: str
+    name: str  # metrics label, the verb without the slash
+    handler: Handler
+    usage: str
+    doc: str
+
+
+class CommandTable:
+    """
+    any module can add its commands with the command decorator, the table keeps them in the order they were added
+    """
+
+    def __init__(self):
+        self.commands: Dict[str, Command] = {}
+
+    def command(self, verb: str, usage='', doc='') -> Callable[[Handler], Handler]:
+        def register(handler: Handler) -> Handler:
+            self.add(verb, handler, usage, doc)
+            return handler
+
+        return register
+
+    def add(self, verb: str, handler: Handler, usage='', doc=''):
+        if not verb.startswith('/') or ' ' in verb:
+            raise ValueError(f"command {verb} must be a / and a single word")
+        if verb in self.commands:
+            raise ValueError(f"command {verb} is registered already")
+        self.commands[verb] = Command(verb, verb[1:], handler, usage, doc)
+
+    def find(self, content: str) -> Optional[Tuple[Command, str]]:
+        """
+        the command of a message and the text after its verb, None for chat
+        """
+        if not content.startswith('/'):
+            return None
+        verb, _, argument = content.partition(' ')
+        command = self.commands.get(verb)
+        return None if command is None else (command, argument)
+
+    def __contains__(self, verb: str):
+        return verb in self.commands
+
+    def help(self) -> str:
+        return ''.join(f'{command.verb + " " + command.usage if command.usage else command.verb:<24}{command.doc}\n'
+                       for command in self.commands.values() if command.doc)
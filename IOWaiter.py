@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import selectors
+import socket as sockets
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from lib import log
+
+
+class IOWaiter:
+    """
+    one thread that waits for sockets to become writable and for delays to pass, so the writers of the threads
+    engine never hold a pool thread while a peer is not reading or a flush window is open.
+    callbacks run on the waiter thread and must only hand the work to a writer
+    """
+    _shared: Optional['IOWaiter'] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, name='io-waiter'):
+        self.selector = selectors.DefaultSelector()
+        self._wake_read, self._wake_write = sockets.socketpair()
+        self._wake_read.setblocking(False)
+        self._wake_write.setblocking(False)
+        self.selector.register(self._wake_read, selectors.EVENT_READ)
+        self._requests: Deque[Tuple[sockets.socket, Callable[[], None], Callable[[], None], float]] = deque()
+        self._timers: List[Tuple[float, int, Callable[[], None]]] = []  # heap of (due, sequence, callback)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def shared() -> 'IOWaiter':
+        """
+        the waiter of this process, started on first use
+        """
+        if IOWaiter._shared is None:
+            with IOWaiter._shared_lock:
+                if IOWaiter._shared is None:
+                    IOWaiter._shared = IOWaiter()
+        return IOWaiter._shared
+
+    def when_writable(self, socket: sockets.socket, on_writable: Callable[[], None],
+                      timeout: float, on_timeout: Callable[[], None]):
+        """
+        call on_writable once socket takes more data, or on_timeout if it does not within timeout seconds
+        """
+        with self._lock:
+            self._requests.append((socket, on_writable, on_timeout, time.monotonic() + timeout))
+        self._wake()
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        with self._lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), callback))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_write.send(b'\0')
+        except BlockingIOError:
+            pass  # a wake up is pending already
+
+    def run(self):
+        waiting: Dict[int, Tuple[Callable[[], None], Callable[[], None], float]] = {}  # fd: callbacks, deadline
+        while True:
+            with self._lock:
+                requests, self._requests = self._requests, deque()
+                due = self._timers[0][0] if self._timers else None
+            for socket, on_writable, on_timeout, deadline in requests:
+                try:
+                    # a closed socket's number may be reused, the stale registration goes first
+                    self.selector.unregister(socket.fileno())
+                except (KeyError, ValueError):
+                    pass
+                try:
+                    self.selector.register(socket.fileno(), selectors.EVENT_WRITE)
+                except (OSError, ValueError):
+                    run_callback(on_writable)  # closed already, the writer finds out when it writes
+                    continue
+                waiting[socket.fileno()] = (on_writable, on_timeout, deadline)
+            deadlines = [deadline for _, _, deadline in waiting.values()] + ([due] if due is not None else [])
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self._wake_read:
+                    try:
+                        while self._wake_read.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                run_callback(waiting.pop(key.fileobj)[0])
+            now = time.monotonic()
+            for fd in [fd for fd, (_, _, deadline) in waiting.items() if deadline <= now]:
+                self.selector.unregister(fd)
+                run_callback(waiting.pop(fd)[1])
+            while True:
+                with self._lock:
+                    if not self._timers or self._timers[0][0] > now:
+                        break
+                    callback = heapq.heappop(self._timers)[2]
+                run_callback(callback)
+
+
+def run_callback(callback: Callable[[], None]):
+    try:
+        callback()
+    except Exception:
+        log.exception("io waiter callback failed")
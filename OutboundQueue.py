@@ -0,0 +1,201 @@
+import threading
+from collections import deque
+from typing import Callable, Deque, List, Optional, Dict, Union, Tuple
+
+from frame_codec import Frame
+from IOWaiter import IOWaiter
+
+
+class OutboundQueue:
+    """
+    bounded queue of frames waiting to be written to one connection.
+    at most one drain is scheduled at a time so frames are written in the order they were put,
+    each drain hands every pending frame to the writer in a single call. the writer never waits on the consumer,
+    it returns False with what the connection did not take kept aside and calls drain again once it can write,
+    meanwhile frames gather here where the overflow policy sees a consumer that stopped reading.
+    with a flush window the drain starts that long after the first frame, so a burst goes out in one write
+    when a slow consumer fills the queue the overflow policy decides what to give up
+    """
+    DROP_OLDEST = 'drop_oldest'  # make room by dropping the frames that waited the longest
+    DROP_NEWEST = 'drop_newest'  # refuse the frame being put
+    DISCONNECT = 'disconnect'  # close the queue and disconnect the consumer
+    POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+    # defaults for new queues, the server overrides them from its command line
+    MAX_FRAMES = 1024
+    MAX_BYTES = 1024 * 1024
+    POLICY = DROP_OLDEST
+    FLUSH_WINDOW = 0.0  # seconds
+
+    # how often each policy fired in this process, see stats()
+    counters: Dict[str, int] = {DROP_OLDEST: 0, DROP_NEWEST: 0, DISCONNECT: 0, 'dropped_frames': 0, 'dropped_bytes': 0}
+    _counters_lock = threading.Lock()
+
+    def __init__(self,
+                 write: Callable[[List[Union[bytes, Tuple[bytes, ...]]]], Optional[bool]],
+                 schedule: Callable[[Callable[[], None]], object],
+                 on_error: Optional[Callable[[BaseException], None]] = None,
+                 on_overflow: Optional[Callable[[str], None]] = None,
+                 max_frames: Optional[int] = None,
+                 max_bytes: Optional[int] = None,
+                 policy: Optional[str] = None,
+                 schedule_later: Optional[Callable[[float, Callable[[], None]], object]] = None,
+                 flush_window: Optional[float] = None):
+        self.write = write  # writes a batch of frames, returns False if the writer is paused
+        self.schedule = schedule  # runs the drain on the writer (thread pool or event loop)
+        self.schedule_later = schedule_later or run_later(schedule)  # same after a delay in seconds
+        self.flush_window = flush_window if flush_window is not None else OutboundQueue.FLUSH_WINDOW
+        self.on_error = on_error
+        self.on_overflow = on_overflow  # called outside the lock when the policy fires first since the queue was empty
+        self.max_frames = max_frames if max_frames is not None else OutboundQueue.MAX_FRAMES
+        self.max_bytes = max_bytes if max_bytes is not None else OutboundQueue.MAX_BYTES
+        self.policy = policy if policy is not None else OutboundQueue.POLICY
+        assert self.policy in OutboundQueue.POLICIES, f"unknown overflow policy {self.policy}"
+        self.frames: Deque[Union[bytes, Tuple[bytes, ...], Frame]] = deque()
+        self.size = 0  # bytes in frames
+        self.closed = False
+        self.overflowing = False  # policy fired since the queue was last empty
+        self._draining = False
+        self._put_count = 0
+        self._written_count = 0
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+
+    def put(self, data: Union[bytes, Tuple[bytes, ...], Frame], wait=False) -> bool:
+        """
+        queue a frame, returns False if it was not accepted because the queue is full or closed.
+        a frame is bytes, a tuple of parts that are shared with other queues and written back to back, or a Frame.
+        with wait=True block until the frame was written
+        """
+        size = sum(len(part) for part in data) if isinstance(data, tuple) else len(data)
+        fired = None
+        with self._lock:
+            if self.closed:
+                return False
+            first_overflow = not self.overflowing
+            if len(self.frames) >= self.max_frames or self.size + size > self.max_bytes:
+                fired = self._overflow(size)
+            accepted = fired is None or fired == OutboundQueue.DROP_OLDEST
+            if accepted:
+                self.frames.append(data)
+                self.size += size
+                self._put_count += 1
+                ticket = self._put_count
+                start_drain = not self._draining
+                self._draining = True
+        if fired is not None and first_overflow and self.on_overflow:
+            self.on_overflow(fired)
+        if not accepted:
+            return False
+        if start_drain:
+            if self.flush_window > 0:
+                self.schedule_later(self.flush_window, self.drain)
+            else:
+                self.schedule(self.drain)
+        if wait:
+            with self._lock:
+                while self._written_count < ticket and not self.closed:
+                    self._written.wait()
+                return self._written_count >= ticket
+        return True
+
+    def _overflow(self, incoming: int) -> str:
+        """
+        apply the policy for a frame of size incoming that does not fit, called with the lock held
+        """
+        policy = self.policy
+        dropped_frames, dropped_bytes = 0, 0
+        if policy == OutboundQueue.DROP_OLDEST and incoming <= self.max_bytes:
+            while self.frames and (len(self.frames) >= self.max_frames or self.size + incoming > self.max_bytes):
+                frame = self.frames.popleft()
+                frame_size = sum(len(part) for part in frame) if isinstance(frame, tuple) else len(frame)
+                self.size -= frame_size
+                dropped_frames += 1
+                dropped_bytes += frame_size
+            # dropped frames count as handled for waiters
+            self._written_count += dropped_frames
+            self._written.notify_all()
+        elif policy == OutboundQueue.DISCONNECT:
+            dropped_frames, dropped_bytes = len(self.frames) + 1, self.size + incoming
+            self._close()
+        else:
+            policy = OutboundQueue.DROP_NEWEST  # also when a single frame is bigger than the whole queue
+            dropped_frames, dropped_bytes = 1, incoming
+        self.overflowing = True
+        with OutboundQueue._counters_lock:
+            OutboundQueue.counters[policy] += 1
+            OutboundQueue.counters['dropped_frames'] += dropped_frames
+            OutboundQueue.counters['dropped_bytes'] += dropped_bytes
+        return policy
+
+    def drain(self):
+        """
+        write pending frames until the queue is empty or the writer is paused, only one drain runs at a time.
+        a paused writer must call drain again once it can take more
+        """
+        while True:
+            with self._lock:
+                if not self.frames or self.closed:
+                    self._draining = False
+                    self.overflowing = False
+                    return
+                frames = list(self.frames)
+                self.frames.clear()
+                self.size = 0
+            try:
+                more = self.write(frames)
+            except BaseException as e:
+                self.close()
+                if self.on_error:
+                    self.on_error(e)
+                return
+            with self._lock:
+                self._written_count += len(frames)
+                self._written.notify_all()
+            if more is False:
+                return
+
+    def close(self):
+        """
+        drop pending frames and refuse new ones
+        """
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        self.closed = True
+        self.frames.clear()
+        self.size = 0
+        self._draining = False
+        self._written.notify_all()
+
+    @staticmethod
+    def buffers(frames: List[Union[bytes, Tuple[bytes, ...], Frame]], version=1) -> List[bytes]:
+        """
+        flatten frames into the buffers to write, a frame is bytes, a tuple of shared parts or a Frame that is
+        encoded for the protocol version of the connection
+        """
+        buffers = []
+        for frame in frames:
+            if isinstance(frame, tuple):
+                buffers.extend(frame)
+            elif isinstance(frame, Frame):
+                buffers.append(frame.encoded(version))
+            else:
+                buffers.append(frame)
+        return buffers
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        with OutboundQueue._counters_lock:
+            return dict(OutboundQueue.counters)
+
+
+def run_later(schedule: Callable[[Callable[[], None]], object]) -> Callable[[float, Callable[[], None]], object]:
+    """
+    delay for writers that run on a thread pool, the io waiter thread keeps the time and schedules the task when it
+    is due so no pool thread sleeps through a flush window
+    """
+    def schedule_later(delay: float, function: Callable[[], None]):
+        IOWaiter.shared().call_later(delay, lambda: schedule(function))
+    return schedule_later
@@ -1,98 +1,123 @@
 import threading
-from typing import List
+import time
+from typing import Callable, Dict, Optional
 
 
 class ReentrantRWLock:
     """
     A lock object that allows many simultaneous "read locks", but only one "write lock."
-    it also ignores multiple write locks from the same thread
+    both are reentrant per thread, the writer may also take read locks and a reader may upgrade to write
+    (two readers upgrading at the same time deadlock, like with any upgradable lock).
+    writers are preferred: while a writer waits no new reader gets in, threads that already read still may
     """
 
     def __init__(self):
-        super().__init__()
-        self._writer = None  # current writer
-        self._readers: List[int] = []  # list of unique readers
-        self._read_ready = threading.Condition(threading.Lock())
-        self._with_ops_write = []  # stack for 'with' keyword for write or read operations, 0 for read 1 for write
-        self._ops_arr_lock = threading.Lock() # lock for previous list
+        self._cond = threading.Condition(threading.Lock())
+        self._readers: Dict[int, int] = {}  # thread ident -> read depth
+        self._writer: Optional[int] = None  # current writer
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self.on_wait: Optional[Callable[[float], None]] = None  # gets the seconds a contended acquire waited
+        self._read_context = _LockContext(self.acquire_read, self.release_read)
+        self._write_context = _LockContext(self.acquire_write, self.release_write)
 
     def acquire_read(self):
         """
-        Acquire a read lock. Blocks only if a another thread has acquired the write lock.
+        Acquire a read lock. Blocks while another thread holds or waits for the write lock.
         """
-        ident = threading.current_thread().ident
-        if self._writer == ident or ident in self._readers:
-            return
-        with self._read_ready:
-            self._readers.append(ident)
+        ident = threading.get_ident()
+        waited = None
+        with self._cond:
+            depth = self._readers.get(ident, 0)
+            if depth == 0 and self._writer != ident and (self._writer is not None or self._writers_waiting):
+                started = time.perf_counter()
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                waited = time.perf_counter() - started
+            self._readers[ident] = depth + 1
+        if waited is not None and self.on_wait:
+            self.on_wait(waited)
 
     def release_read(self):
         """
-        Release a read lock if exists from this thread
+        Release one read lock of this thread
         """
-        ident = threading.current_thread().ident
-        if self._writer == ident or ident not in self._readers:
-            return
-        with self._read_ready:
-            self._readers.remove(ident)
-            if len(self._readers) == 0:
-                self._read_ready.notifyAll()
+        ident = threading.get_ident()
+        with self._cond:
+            depth = self._readers.get(ident, 0)
+            if depth == 0:
+                raise RuntimeError("ReentrantRWLock: release_read without acquire_read")
+            if depth > 1:
+                self._readers[ident] = depth - 1
+                return
+            del self._readers[ident]
+            if self._writers_waiting and len(self._readers) <= 1:  # one left may be upgrading
+                self._cond.notify_all()
 
     def acquire_write(self):
         """
-        Acquire a write lock. Blocks until there are no acquired read or write locks from another thread.
+        Acquire a write lock. Blocks until there are no read or write locks from another thread.
         """
-        ident = threading.current_thread().ident
-        if self._writer == ident:
-            return
-        self._read_ready.acquire()
-        me_included = 1 if ident in self._readers else 0
-        while len(self._readers) - me_included > 0:
-            self._read_ready.wait()
-        self._writer = ident
+        ident = threading.get_ident()
+        waited = None
+        with self._cond:
+            if self._writer == ident:
+                self._write_depth += 1
+                return
+            if self._writer is not None or len(self._readers) > (1 if ident in self._readers else 0):
+                started = time.perf_counter()
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or len(self._readers) > (1 if ident in self._readers else 0):
+                        self._cond.wait()
+                except BaseException:
+                    self._writers_waiting -= 1
+                    self._cond.notify_all()  # readers held back by this writer may go
+                    raise
+                self._writers_waiting -= 1
+                waited = time.perf_counter() - started
+            self._writer = ident
+            self._write_depth = 1
+        if waited is not None and self.on_wait:
+            self.on_wait(waited)
 
     def release_write(self):
         """
-        Release a write lock if exists from this thread.
+        Release one write lock of this thread.
         """
-        if not self._writer or not self._writer == threading.current_thread().ident:
-            return
-        self._writer = None
-        self._read_ready.release()
-
-    def __enter__(self):
-        with self._ops_arr_lock:
-            if len(self._with_ops_write) == 0:
-                raise RuntimeError("ReentrantRWLock: used 'with' block without call to for_read or for_write")
-            write = self._with_ops_write[-1]
-        if write:
-            self.acquire_write()
-        else:
-            self.acquire_read()
-
-    def __exit__(self, exc_type, exc_value, tb):
-        with self._ops_arr_lock:
-            write = self._with_ops_write.pop()
-        if write:
-            self.release_write()
-        else:
-            self.release_read()
-        if exc_type is not None:
-            return False  # exception happened
-        return True
+        with self._cond:
+            if self._writer != threading.get_ident():
+                raise RuntimeError("ReentrantRWLock: release_write without acquire_write")
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
 
     def for_read(self):
         """
         used for 'with' block
         """
-        with self._ops_arr_lock:
-            self._with_ops_write.append(0)
-        return self
+        return self._read_context
 
     def for_write(self):
         """
         used for 'with' block
         """
-        with self._ops_arr_lock:
-            self._with_ops_write.append(1)
-        return self
+        return self._write_context
+
+
+class _LockContext:
+    """
+    'with' support for one mode of the lock, holds no per use state so threads can share it
+    """
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._release()
+        return False
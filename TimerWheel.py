@@ -0,0 +1,76 @@
+import math
+import threading
+import time
+from typing import Callable, Dict, Hashable, List
+
+
+class TimerWheel:
+    """
+    hashed timing wheel, a ring of slots tick seconds apart that one thread walks. scheduling and cancelling an item
+    is O(1) whatever the number of items, a timer further away than the ring stays in its slot for more turns.
+    an item is in the wheel at most once, scheduling it again moves it
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]  # item: tick it is due
+        self.due: Dict[Hashable, int] = {}
+        self.current = self.tick_of(time.monotonic())  # last tick walked
+        self._lock = threading.Lock()
+
+    def tick_of(self, now: float) -> int:
+        return int(now / self.tick)
+
+    def schedule(self, item: Hashable, delay: float):
+        """
+        expire item after delay seconds, up to one tick late
+        """
+        with self._lock:
+            self._remove(item)
+            due = max(self.current + 1, self.tick_of(time.monotonic()) + math.ceil(delay / self.tick))
+            self.due[item] = due
+            self.slots[due % len(self.slots)][item] = due
+
+    def cancel(self, item: Hashable):
+        with self._lock:
+            self._remove(item)
+
+    def _remove(self, item: Hashable):
+        due = self.due.pop(item, None)
+        if due is not None:
+            del self.slots[due % len(self.slots)][item]
+
+    def advance(self, now: float) -> List[Hashable]:
+        """
+        walk the ticks up to now, returns the items that expired and are no longer in the wheel
+        """
+        expired = []
+        with self._lock:
+            until = self.tick_of(now)
+            # a clock jump longer than the ring walks each slot once
+            for tick in range(max(self.current + 1, until - len(self.slots) + 1), until + 1):
+                slot = self.slots[tick % len(self.slots)]
+                for item, due in list(slot.items()):
+                    if due <= until:
+                        del slot[item]
+                        del self.due[item]
+                        expired.append(item)
+            self.current = max(self.current, until)
+        return expired
+
+    def run(self, on_expired: Callable[[Hashable], None]):
+        """
+        walk the wheel forever, on_expired runs on this thread for every expired item
+        """
+        while True:
+            time.sleep(self.tick - time.monotonic() % self.tick)
+            for item in self.advance(time.monotonic()):
+                on_expired(item)
+
+    def start(self, on_expired: Callable[[Hashable], None], name='timer-wheel') -> threading.Thread:
+        thread = threading.Thread(target=self.run, args=(on_expired,), name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def __len__(self):
+        return len(self.due)
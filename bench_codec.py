@@ -0,0 +1,126 @@
+"""
+microbenchmark of the frame codec against the per-field path it replaced.
+usage: python bench_codec.py [frames=20000] [content=40] [repeat=5]
+"""
+import sys
+import timeit
+
+import frame_codec
+from BufferedSocketStream import BufferedSocketStream
+from server_types import parse_args
+
+
+class MemorySocket:
+    """
+    serves prepared bytes through the recv calls used by the streams, 64KiB per call like a busy socket
+    """
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.at = 0
+
+    def recv(self, count):
+        part = self.data[self.at:self.at + min(count, 64 * 1024)]
+        self.at += len(part)
+        return bytes(part)
+
+    def recv_into(self, view):
+        part = self.data[self.at:self.at + min(len(view), 64 * 1024)]
+        view[:len(part)] = part
+        self.at += len(part)
+        return len(part)
+
+
+class LegacyStream:
+    """
+    the copying stream that was used before, kept here as the reference
+    """
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.buffer = bytearray()
+        self.size = 0
+
+    def read(self, count) -> bytes:
+        while True:
+            if count <= self.size:
+                part = self.buffer[:count]
+                self.buffer = self.buffer[count:]
+                self.size -= count
+                return part
+            received = self.socket.recv(64 * 1024)
+            if received == b'':
+                raise ConnectionError("received 0 bytes possibly socket disconnected")
+            self.buffer.extend(received)
+            self.size += len(received)
+
+
+def legacy_from_client(reader: LegacyStream):
+    sig = reader.read(2)
+    assert sig == frame_codec.SIG_BYTES
+    target_context = int.from_bytes(reader.read(1), byteorder='little')
+    target = reader.read(int.from_bytes(reader.read(1), byteorder='little')).decode('utf-8')
+    content = reader.read(int.from_bytes(reader.read(2), byteorder='little')).decode('utf-8')
+    return target_context, target, content
+
+
+def legacy_to_server(target_context: int, target: str, content: str):
+    data = bytearray()
+    data.extend(frame_codec.SIG_BYTES)
+    data.extend(target_context.to_bytes(length=1, byteorder='little'))
+    target_bytes = target.encode('utf-8')
+    data.extend(len(target_bytes).to_bytes(length=1, byteorder='little'))
+    data.extend(target_bytes)
+    content_bytes = content.encode('utf-8')
+    data.extend(len(content_bytes).to_bytes(length=2, byteorder='little'))
+    data.extend(content_bytes)
+    return data
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    frames = int(args.get('frames', 20000))
+    content = 'x' * int(args.get('content', 40))
+    repeat = int(args.get('repeat', 5))
+    data = b''.join(frame_codec.encode_client_frame(2, 'global', content) for _ in range(frames))
+
+    def legacy_decode():
+        reader = LegacyStream(MemorySocket(data))
+        for _ in range(frames):
+            legacy_from_client(reader)
+
+    def frame_decode():
+        reader = BufferedSocketStream(MemorySocket(data))
+        for _ in range(frames):
+            reader.read_frame(frame_codec.decode_client_frame)
+
+    def batch_decode():
+        reader = BufferedSocketStream(MemorySocket(data))
+        decoded = 0
+        while decoded < frames:
+            decoded += len(reader.read_frames(frame_codec.decode_client_frames))
+
+    def legacy_encode():
+        for _ in range(frames):
+            legacy_to_server(2, 'global', content)
+
+    def codec_encode():
+        for _ in range(frames):
+            frame_codec.encode_client_frame(2, 'global', content)
+
+    print(f"{frames} frames of {len(data) // frames} bytes, best of {repeat}")
+    results = {}
+    for name, fn in (('legacy decode (read per field)', legacy_decode),
+                     ('read_frame decode', frame_decode),
+                     ('read_frames batch decode', batch_decode),
+                     ('legacy encode (bytearray.extend)', legacy_encode),
+                     ('struct encode', codec_encode)):
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        results[name] = best
+        print(f"{name.ljust(34)} {best * 1000:9.2f} ms  {frames / best:12,.0f} frames/s")
+    print(f"decode speedup {results['legacy decode (read per field)'] / results['read_frames batch decode']:.1f}x, "
+          f"encode speedup {results['legacy encode (bytearray.extend)'] / results['struct encode']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
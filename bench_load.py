@@ -0,0 +1,366 @@
+"""
+load generator for the chat server, simulated clients log in, form groups and chat like bot.py does but
+as fast as the configured rate allows. every message carries its send time so each delivery gives one
+end to end latency sample. results are printed and written as json so runs can be compared between commits.
+usage: python bench_load.py [clients=50] [group_size=10] [whisper_ratio=0.1] [message_size=64] [rate=20]
+                            [duration=10] [settle=2] [processes=1] [engine=threads] [workers=1]
+                            [flush_window_us=0] [compress=off] [protocol=1] [server=spawn] [out=bench_load.json]
+                            [seed=1]
+group_size=0 puts everybody in the global group, rate=0 sends as fast as the server takes it,
+server=host:port benchmarks a running server instead of spawning one.
+a spawned server also reports its socket write calls, read from its metrics
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket as sockets
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+import frame_codec
+from compression import Inflater
+from server_types import parse_args, Message
+
+BENCH_PREFIX = 'bench '  # bench <sender index> <send time ns> <padding>
+
+
+class BenchClient:
+    """
+    one simulated user on an asyncio connection, frames that are not bench messages go to the inbox
+    """
+
+    def __init__(self, index: int, name: str, compress: str, protocol: int):
+        self.index = index
+        self.name = name
+        self.compress = compress  # method offered in the hello
+        self.protocol = protocol  # version asked for in the hello, frames are sent in it once the server agreed
+        self.version = 1
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.inbox: Optional[asyncio.Queue] = asyncio.Queue()  # None once the load starts
+        self.latencies: List[int] = []  # ns
+        self.group = 'global'
+        self.recipients = 0  # receivers of one group message, not counting this client
+        self.sent = 0
+        self.expected = 0  # deliveries the messages sent so far should cause
+        self.receiving: Optional[asyncio.Task] = None
+
+    async def connect(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.receiving = asyncio.ensure_future(self.receive())
+        options = [f'version={self.protocol}'] if self.protocol > 1 else []
+        if self.compress != 'off':
+            options.append(f'compress={self.compress}')
+        if options:
+            self.send(Message.CONTEXT_SYSTEM, 'system', ' '.join(['/hello'] + options))
+        await self.expect('choose a username')
+        if options:
+            # the greeting was sent before the server read the hello
+            answer = await self.expect('/hello')
+            if f'version={self.protocol}' in answer.split():
+                self.version = self.protocol
+        self.send(Message.CONTEXT_GROUP, 'global', self.name)
+        await self.expect(f'/set username {self.name}')
+
+    def send(self, target_context: int, target: str, content: str):
+        if self.version >= 2:
+            self.writer.write(frame_codec.encode_client_frame_v2(target_context, target, content))
+        else:
+            self.writer.write(frame_codec.encode_client_frame(target_context, target, content))
+
+    async def expect(self, content: str, timeout=30.0) -> str:
+        """
+        wait for a frame that contains content, dropping the frames before it
+        """
+        async def find():
+            while True:
+                received = await self.inbox.get()
+                if content in received:
+                    return received
+
+        return await asyncio.wait_for(find(), timeout)
+
+    async def receive(self):
+        buffer = bytearray()
+        inflater = Inflater()
+        try:
+            while True:
+                data = await self.reader.read(64 * 1024)
+                if not data:
+                    return
+                buffer.extend(data)
+                frames, consumed, _ = inflater.decode_frames(buffer, frame_codec.decode_server_frame)
+                del buffer[:consumed]
+                now = time.time_ns()
+                for sender_context, _, sender, _, content in frames:
+                    if sender_context == Message.CONTEXT_USER and content.startswith(BENCH_PREFIX):
+                        if sender != self.name:
+                            self.latencies.append(now - int(content.split(' ', 3)[2]))
+                    elif self.inbox is not None:
+                        self.inbox.put_nowait(content)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def chat(self, names: List[str], whisper_ratio: float, padding: str, rate: float, until: float,
+                   rand: random.Random):
+        self.inbox = None
+        interval = 1 / rate if rate > 0 else 0
+        next_at = time.monotonic()
+        while time.monotonic() < until:
+            content = f'{BENCH_PREFIX}{self.index} {time.time_ns()} {padding}'
+            target = rand.choice(names) if rand.random() < whisper_ratio else None
+            if target is not None and target != self.name:
+                self.send(Message.CONTEXT_USER, target, content)
+                self.expected += 1
+            else:
+                self.send(Message.CONTEXT_GROUP, self.group, content)
+                self.expected += self.recipients
+            self.sent += 1
+            await self.writer.drain()
+            if interval:
+                next_at += interval
+                await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+            else:
+                await asyncio.sleep(0)
+
+    async def close(self):
+        self.writer.close()
+        self.receiving.cancel()
+
+
+def plan_groups(clients: int, group_size: int) -> List[List[int]]:
+    """
+    client indexes of every group, the first one creates the group. group_size=0 means the global group
+    """
+    if group_size <= 0:
+        return [list(range(clients))]
+    return [list(range(start, min(start + group_size, clients))) for start in range(0, clients, group_size)]
+
+
+async def form_group(group: List[BenchClient], group_name: str):
+    leader, members = group[0], group[1:]
+    leader.send(Message.CONTEXT_GROUP, 'global', f'/create {group_name}')
+    await leader.expect(f'/switch {group_name}')
+    for member in members:
+        leader.send(Message.CONTEXT_GROUP, group_name, f'/invite {member.name}')
+    for member in members:
+        await member.expect(f'/accept {group_name}')
+        member.send(Message.CONTEXT_GROUP, 'global', f'/accept {group_name}')
+    for member in members:
+        await member.expect(f'/switch {group_name}')
+    for client in group:
+        client.group = group_name
+        client.recipients = len(group) - 1
+
+
+async def run_clients(config: Dict, groups: List[List[int]], barrier) -> Dict:
+    """
+    connect the clients of groups, form the groups and chat for the configured duration
+    """
+    prefix = config['prefix']
+    names = [f'{prefix}{i}' for i in range(config['clients'])]
+    rand = random.Random(config['seed'] * 7919 + groups[0][0])
+    clients = {i: BenchClient(i, names[i], config['compress'], config['protocol']) for group in groups for i in group}
+    # connect a few at a time, a connection that overflows the listen backlog looks established to the client
+    # but never gets accepted
+    ordered = list(clients.values())
+    for start in range(0, len(ordered), 4):
+        await asyncio.gather(*(client.connect(config['host'], config['port']) for client in ordered[start:start + 4]))
+    if config['group_size'] > 0:
+        await asyncio.gather(*(form_group([clients[i] for i in group], f'{prefix}g{group[0]}') for group in groups))
+    else:
+        for client in ordered:
+            client.recipients = config['clients'] - 1
+    if barrier is not None:
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+    padding = 'x' * max(0, config['message_size'] - len(BENCH_PREFIX) - 24)
+    started = time.monotonic()
+    until = started + config['duration']
+    await asyncio.gather(*(client.chat(names, config['whisper_ratio'], padding, config['rate'], until, rand)
+                           for client in ordered))
+    elapsed = time.monotonic() - started
+    await asyncio.sleep(config['settle'])  # deliveries still in flight
+    for client in ordered:
+        await client.close()
+    return {
+        'sent': sum(client.sent for client in ordered),
+        'expected': sum(client.expected for client in ordered),
+        'latencies': [latency for client in ordered for latency in client.latencies],
+        'elapsed': elapsed,
+    }
+
+
+def run_worker(config: Dict, groups: List[List[int]], barrier, results):
+    results.put(asyncio.run(run_clients(config, groups, barrier)))
+
+
+def percentile(values: List[int], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))] / 1e6  # ms
+
+
+def free_port() -> int:
+    with sockets.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(config: Dict) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+         f"port={config['port']}", f"engine={config['engine']}", f"workers={config['workers']}",
+         f"max_users={config['clients'] + 10}", f"flush_window_us={config['flush_window_us']}",
+         f"metrics_port={config['metrics_port']}", 'log_level=warning', 'rate_limit=off'],
+        stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            sockets.create_connection((config['host'], config['port']), timeout=1).close()
+            return process
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError("server did not start")
+            time.sleep(0.1)
+
+
+def server_counters(config: Dict) -> Dict[str, float]:
+    """
+    frames and socket write calls of the spawned server, summed over its workers
+    """
+    counters = {'chat_frames_out_total': 0, 'chat_send_calls_total': 0, 'chat_bytes_out_total': 0}
+    for worker in range(config['workers']):
+        url = f"http://127.0.0.1:{config['metrics_port'] + worker}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            for line in response.read().decode('utf-8').splitlines():
+                name, _, value = line.partition(' ')
+                if name in counters:
+                    counters[name] += float(value)
+    return counters
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(config: Dict, parts: List[Dict], counters: Optional[Dict[str, float]]) -> Dict:
+    latencies = sorted(latency for part in parts for latency in part['latencies'])
+    elapsed = max(part['elapsed'] for part in parts)
+    sent = sum(part['sent'] for part in parts)
+    expected = sum(part['expected'] for part in parts)
+    summary = {
+        'commit': git_commit(),
+        'config': {k: v for k, v in config.items() if k not in ('host', 'port', 'prefix', 'metrics_port')},
+        'sent': sent,
+        'delivered': len(latencies),
+        'expected_deliveries': expected,
+        'delivery_ratio': round(len(latencies) / expected, 4) if expected else None,
+        'messages_per_sec': round(sent / elapsed, 1),
+        'deliveries_per_sec': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.5), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'p999': round(percentile(latencies, 0.999), 3),
+            'max': round(latencies[-1] / 1e6, 3) if latencies else 0.0,
+        },
+    }
+    if counters is not None:
+        frames, calls = counters['chat_frames_out_total'], counters['chat_send_calls_total']
+        summary['server'] = {
+            'frames_out': int(frames),
+            'send_calls': int(calls),
+            'frames_per_send_call': round(frames / calls, 2) if calls else None,
+            'bytes_out': int(counters['chat_bytes_out_total']),
+            'bytes_per_frame': round(counters['chat_bytes_out_total'] / frames, 1) if frames else None,
+        }
+    return summary
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    try:
+        config = {
+            'clients': int(args.get('clients', 50)),
+            'group_size': int(args.get('group_size', 10)),
+            'whisper_ratio': float(args.get('whisper_ratio', 0.1)),
+            'message_size': int(args.get('message_size', 64)),
+            'rate': float(args.get('rate', 20)),
+            'duration': float(args.get('duration', 10)),
+            'settle': float(args.get('settle', 2)),
+            'processes': int(args.get('processes', 1)),
+            'workers': int(args.get('workers', 1)),
+            'flush_window_us': int(args.get('flush_window_us', 0)),
+            'protocol': int(args.get('protocol', 1)),
+            'seed': int(args.get('seed', 1)),
+        }
+    except ValueError as e:
+        print("clients, group_size, whisper_ratio, message_size, rate, duration, settle, processes, workers, "
+              "flush_window_us and seed expect numbers")
+        raise e
+    config['engine'] = args.get('engine', 'threads')
+    config['compress'] = args.get('compress', 'off')
+    config['prefix'] = f'b{random.Random().randrange(36 ** 4):x}-'  # unique names against a running server
+    server_address = args.get('server', 'spawn')
+    process = None
+    counters = None
+    if server_address == 'spawn':
+        config['host'], config['port'] = '127.0.0.1', free_port()
+        config['metrics_port'] = free_port()  # workers take the ports after it
+        process = spawn_server(config)
+    else:
+        host, _, port = server_address.rpartition(':')
+        config['host'], config['port'] = host or 'localhost', int(port)
+
+    groups = plan_groups(config['clients'], config['group_size'])
+    try:
+        if config['processes'] <= 1:
+            parts = [asyncio.run(run_clients(config, groups, None))]
+        else:
+            # whole groups go to one process, the invites are exchanged inside it
+            shares = [groups[i::config['processes']] for i in range(config['processes'])]
+            shares = [share for share in shares if share]
+            barrier = multiprocessing.Barrier(len(shares))
+            results = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=run_worker, args=(config, share, barrier, results))
+                       for share in shares]
+            for worker in workers:
+                worker.start()
+            parts = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+        if process is not None:
+            counters = server_counters(config)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    summary = summarize(config, parts, counters)
+    latency = summary['latency_ms']
+    print(f"{summary['sent']} messages from {config['clients']} clients in {config['duration']}s, "
+          f"{summary['messages_per_sec']} msg/s, {summary['deliveries_per_sec']} deliveries/s, "
+          f"delivered {summary['delivered']}/{summary['expected_deliveries']}")
+    print(f"latency ms p50 {latency['p50']} p99 {latency['p99']} p999 {latency['p999']} max {latency['max']}")
+    if 'server' in summary:
+        print(f"server wrote {summary['server']['frames_out']} frames in {summary['server']['send_calls']} send calls, "
+              f"{summary['server']['frames_per_send_call']} frames per call, "
+              f"{summary['server']['bytes_per_frame']} bytes per frame")
+    out = args.get('out', 'bench_load.json')
+    with open(out, 'w') as file:
+        json.dump(summary, file, indent=2)
+    print(f"written to {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+"""
+federation backend of a cluster of server nodes. a broker gives a node two ways to reach the others:
+publish() puts an event in the one order every node sees, send_to() hands it to the chosen nodes only.
+BusHub is the reference broker server, it runs in any node or supervisor process and listens on tcp or a unix socket.
+events are opaque to the brokers: SIZE(4) TYPE(1) PAYLOAD(SIZE - 1), types below FIRST_EVENT belong to the bus itself
+"""
+import asyncio
+import os
+import queue
+import socket as sockets
+import struct
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from BufferedSocketStream import BufferedSocketStream
+from lib import log
+
+EVENT_HEAD = struct.Struct('<IB')  # size of type and payload, event type
+EVENT_START = 0  # sent by the hub once every node is connected, nothing is relayed before it
+EVENT_HELLO = 1  # NODE_ID(2), first event of a node
+EVENT_ROUTE = 2  # COUNT(2), NODE_ID(2) * COUNT, event for those nodes only
+EVENT_NODE_DOWN = 3  # NODE_ID(2), published by the hub when a node left, the users of that node are gone
+EVENT_SYNC = 4  # NODE_ID(2), hub to one node: send the state of the cluster for that node, which is joining again
+EVENT_STATE = 5  # NODE_ID(2), STATE, the answer to EVENT_SYNC. the hub hands STATE alone to the joining node
+FIRST_EVENT = 8
+NODE_ID = struct.Struct('<H')
+
+Event = Tuple[int, bytes]  # event type, payload
+Address = Union[str, Tuple[str, int]]  # unix socket path or tcp host and port
+
+
+def encode_event(event_type: int, *payload: bytes) -> bytes:
+    size = sum(len(part) for part in payload)
+    return b''.join((EVENT_HEAD.pack(size + 1, event_type),) + payload)
+
+
+def decode_events(buffer) -> Tuple[List[Event], int, int]:
+    """
+    every complete event in buffer, returns (events, bytes consumed, bytes needed by the incomplete event that follows)
+    """
+    events = []
+    offset = 0
+    available = len(buffer)
+    while True:
+        if available - offset < EVENT_HEAD.size:
+            return events, offset, EVENT_HEAD.size
+        size, event_type = EVENT_HEAD.unpack_from(buffer, offset)
+        end = offset + 4 + size
+        if end > available:
+            return events, offset, end - offset
+        events.append((event_type, bytes(buffer[offset + EVENT_HEAD.size:end])))
+        offset = end
+
+
+def parse_address(text: str) -> Address:
+    """
+    unix:path or host:port
+    """
+    if text.startswith('unix:'):
+        return text[5:]
+    host, _, port = text.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError as e:
+        print(f"broker address {text} parse failed, expected host:port or unix:path")
+        raise e
+
+
+class Broker:
+    """
+    what a node needs from the federation backend, events of both kinds arrive on one thread in the order the
+    broker gave them
+    """
+
+    def __init__(self, node_id: int, on_event: Callable[[int, bytes], None]):
+        self.node_id = node_id
+        self.on_event = on_event
+        self.started = threading.Event()  # set once every node is there, wait for it before taking clients
+
+    def start(self):
+        raise NotImplementedError
+
+    def publish(self, event: bytes):
+        """
+        every node gets the event, all of them in the same order relative to the other published events
+        """
+        raise NotImplementedError
+
+    def send_to(self, nodes: Iterable[int], event: bytes):
+        """
+        only the given nodes get the event, it keeps its order with the events this node published before
+        """
+        raise NotImplementedError
+
+
+class LocalBroker(Broker):
+    """
+    a cluster of one node inside the process, runs the cluster code paths without any socket
+    """
+
+    def __init__(self, node_id: int, on_event: Callable[[int, bytes], None]):
+        super().__init__(node_id, on_event)
+        self.events: 'queue.SimpleQueue[bytes]' = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.receive, name='bus', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.started.set()
+
+    def publish(self, event: bytes):
+        self.events.put(event)
+
+    def send_to(self, nodes: Iterable[int], event: bytes):
+        if self.node_id in nodes:
+            self.events.put(event)
+
+    def receive(self):
+        while True:
+            events, _, _ = decode_events(self.events.get())
+            for event_type, payload in events:
+                dispatch_event(self.on_event, event_type, payload)
+
+
+class HubBroker(Broker):
+    """
+    a node's connection to a BusHub, publish from any thread, events arrive on the bus thread in hub order.
+    publish only queues the event, a writer thread sends what gathered in one write so a caller holding a lock
+    never waits on the hub
+    """
+
+    def __init__(self, address: Address, node_id: int, on_event: Callable[[int, bytes], None]):
+        super().__init__(node_id, on_event)
+        if isinstance(address, str):
+            self.socket = sockets.socket(sockets.AF_UNIX, sockets.SOCK_STREAM)
+        else:
+            self.socket = sockets.socket(sockets.AF_INET, sockets.SOCK_STREAM)
+            self.socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_NODELAY, 1)
+        self.socket.connect(address)
+        self.outbound: 'queue.SimpleQueue[bytes]' = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.send, name='bus-send', daemon=True)
+        self.thread = threading.Thread(target=self.receive, name='bus', daemon=True)
+
+    def start(self):
+        self.writer.start()
+        self.publish(encode_event(EVENT_HELLO, NODE_ID.pack(self.node_id)))
+        self.thread.start()
+
+    def publish(self, event: bytes):
+        self.outbound.put(event)
+
+    def send(self):
+        while True:
+            events = [self.outbound.get()]
+            try:
+                while True:
+                    events.append(self.outbound.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self.socket.sendall(b''.join(events))
+            except OSError as err:
+                self.lost(err)
+
+    def send_to(self, nodes: Iterable[int], event: bytes):
+        nodes = tuple(nodes)
+        if nodes:
+            self.publish(encode_event(EVENT_ROUTE, NODE_ID.pack(len(nodes)),
+                                      struct.pack(f'<{len(nodes)}H', *nodes), event))
+
+    def receive(self):
+        stream = BufferedSocketStream(self.socket)
+        try:
+            while True:
+                for event_type, payload in stream.read_frames(decode_events):
+                    if event_type == EVENT_START:
+                        self.started.set()
+                        continue
+                    # bus events that the node acts on, EVENT_NODE_DOWN, EVENT_SYNC and EVENT_STATE, go to on_event
+                    dispatch_event(self.on_event, event_type, payload)
+        except ConnectionError as err:
+            self.lost(err)
+
+    @staticmethod
+    def lost(err: BaseException):
+        log.error("bus connection lost, cause: %s", err)
+        os._exit(1)  # this node's state can't follow the others anymore
+
+
+def dispatch_event(on_event: Callable[[int, bytes], None], event_type: int, payload: bytes):
+    try:
+        on_event(event_type, payload)
+    except Exception:
+        log.exception("bus event %s failed", event_type)
+
+
+def connect(address: str, node_id: int, on_event: Callable[[int, bytes], None]) -> Broker:
+    """
+    the broker at address, 'local' for the in process one
+    """
+    if address == 'local':
+        return LocalBroker(node_id, on_event)
+    return HubBroker(parse_address(address), node_id, on_event)
+
+
+class Rejoin:
+    """
+    a node that connected after the start, it waits for the state of a donor node and the events published since
+    the donor was asked
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.donor: Optional[int] = None
+        self.events: List[bytes] = []
+        self.joined = asyncio.Event()
+
+
+class BusHub:
+    """
+    the relay, one event loop reads whole events from every node and writes each one to all of them, or to the
+    nodes it is routed to, before it reads the next. that loop is what puts the events in one order.
+    when a node leaves, the others get EVENT_NODE_DOWN at that point of the order. the hub keeps no events: a node
+    that comes back later gets the state of a running node, taken where EVENT_SYNC reached it in the order, then
+    the events published after that point and EVENT_START
+    """
+
+    def __init__(self, address: Address, nodes: int):
+        self.address = address
+        self.nodes = nodes
+        self.writers: Dict[int, asyncio.StreamWriter] = {}
+        self.joining: Dict[int, Rejoin] = {}
+        self.ready = threading.Event()
+        self.started: Optional[asyncio.Event] = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def run_in_thread(self):
+        """
+        serve from a daemon thread of this process, returns once the hub is listening
+        """
+        threading.Thread(target=self.run, name='bus-hub', daemon=True).start()
+        if not self.ready.wait(10):
+            raise RuntimeError(f"bus hub did not start on {self.address}")
+
+    async def serve(self):
+        self.started = asyncio.Event()
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            hub = await asyncio.start_unix_server(self.relay, self.address)
+        else:
+            hub = await asyncio.start_server(self.relay, *self.address, reuse_address=True)
+        self.ready.set()
+        async with hub:
+            await hub.serve_forever()
+
+    async def relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            event_type, payload = await self.read_event(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        node = NODE_ID.unpack_from(payload)[0] if event_type == EVENT_HELLO else None
+        if node is None or node in self.writers or node in self.joining:
+            log.warning("node %s can't join the bus, the id is taken", node)
+            writer.close()
+            return
+        rejoin = None
+        if self.started.is_set():
+            rejoin = self.joining[node] = Rejoin(writer)
+            self.ask_state(node)
+        else:
+            self.writers[node] = writer
+            if len(self.writers) == self.nodes:
+                # a node that missed an event would disagree with the others from then on
+                for other in self.writers.values():
+                    other.write(encode_event(EVENT_START))
+                self.started.set()
+        try:
+            await self.started.wait()
+            if rejoin is not None:
+                await rejoin.joined.wait()
+            while True:
+                event_type, payload = await self.read_event(reader)
+                if event_type == EVENT_STATE:
+                    self.hand_state(node, NODE_ID.unpack_from(payload)[0], payload[NODE_ID.size:])
+                    continue
+                if event_type == EVENT_ROUTE:
+                    count = NODE_ID.unpack_from(payload)[0]
+                    targets = struct.unpack_from(f'<{count}H', payload, NODE_ID.size)
+                    event = payload[NODE_ID.size * (count + 1):]
+                    receivers = [self.writers[target] for target in targets if target in self.writers]
+                    for other in receivers:
+                        other.write(event)
+                else:
+                    receivers = self.publish(encode_event(event_type, payload))
+                # a node that does not keep up slows down the ones sending to it, not the order
+                await self.drain(receivers)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.warning("node %s left the bus", node)
+        finally:
+            self.writers.pop(node, None)
+            self.joining.pop(node, None)
+            writer.close()
+            if self.started.is_set():
+                log.warning("node %s is down, the other nodes drop its users", node)
+                self.publish(encode_event(EVENT_NODE_DOWN, NODE_ID.pack(node)))
+                for other, waiting in list(self.joining.items()):
+                    if waiting.donor == node:
+                        self.ask_state(other)
+
+    def publish(self, event: bytes) -> List[asyncio.StreamWriter]:
+        """
+        write event to every node, the nodes joining again get it after their state. returns the writers written to
+        """
+        for rejoin in self.joining.values():
+            rejoin.events.append(event)
+        receivers = list(self.writers.values())
+        for other in receivers:
+            other.write(event)
+        return receivers
+
+    def ask_state(self, node: int):
+        rejoin = self.joining[node]
+        rejoin.events.clear()  # the state of the donor asked now holds them
+        rejoin.donor = next(iter(self.writers), None)
+        if rejoin.donor is None:
+            self.admit(node, None)  # nobody is left, it starts out empty like the first nodes did
+        else:
+            self.writers[rejoin.donor].write(encode_event(EVENT_SYNC, NODE_ID.pack(node)))
+
+    def hand_state(self, donor: int, node: int, state: bytes):
+        rejoin = self.joining.get(node)
+        if rejoin is not None and rejoin.donor == donor:  # else an answer to an earlier donor or a gone node
+            self.admit(node, state)
+
+    def admit(self, node: int, state: Optional[bytes]):
+        rejoin = self.joining.pop(node)
+        if state is not None:
+            rejoin.writer.write(encode_event(EVENT_STATE, state))
+        rejoin.writer.writelines(rejoin.events)
+        rejoin.writer.write(encode_event(EVENT_START))
+        self.writers[node] = rejoin.writer
+        rejoin.joined.set()
+        log.info("node %s joined the bus again, state from node %s and %s events after it",
+                 node, rejoin.donor, len(rejoin.events))
+
+    @staticmethod
+    async def drain(receivers: List[asyncio.StreamWriter]):
+        for other in receivers:
+            try:
+                await other.drain()
+            except ConnectionError:
+                pass  # its own relay finds out and lets it go
+
+    @staticmethod
+    async def read_event(reader: asyncio.StreamReader) -> Event:
+        head = await reader.readexactly(EVENT_HEAD.size)
+        size, event_type = EVENT_HEAD.unpack(head)
+        return event_type, await reader.readexactly(size - 1)
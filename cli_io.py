@@ -1,12 +1,14 @@
+import codecs
 import sys
 import threading
+import time
 import traceback
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from readchar import readkey, key
 from termcolor import colored
 
-from ReentrantRWLock import ReentrantRWLock
+from line_editor import GapBuffer, InputHistory
 
 
 class ReadError(IOError):
@@ -14,203 +16,311 @@ class ReadError(IOError):
 
 
 class IO:
-    def __init__(self):
-        self.read_buffer = ''
+    """
+    terminal with one input line below the written text. edits and writes only change the state, the renderer
+    draws a frame at most every frame_interval seconds: the lines written since the last frame and the cells of
+    the input line that changed, moved to with cursor escape codes, in a single write to stdout.
+    with auto_render off the owner calls render() itself, see frame_due()
+    """
+    FRAME_INTERVAL = 1 / 60  # seconds
+
+    def __init__(self, frame_interval=FRAME_INTERVAL, auto_render=True):
+        self.line = GapBuffer()  # the line being read
         self.label = ''
-        self.label_colored = ''
         self.read_lock = threading.Lock()
-        self.write_lock = threading.RLock()
-        self.buffer_lock = ReentrantRWLock()
-        self.last_line = ''
-        self.last_writer_was_reader = False
+        self.write_lock = threading.RLock()  # guards the state below, never held while writing to stdout
+        self.render_lock = threading.Lock()  # one frame at a time, in order
         self.read_interrupted_buffer = ''
         self.label_color = 'white'
-        self.history: List[str] = []
-        self.history_tail_index = 0
+        self.history = InputHistory()
         self.read_error: Optional[ReadError] = None
         self.read_interrupted = False
-        self.cursor_at = 0
+        self.editing = False  # a line is being read, it is drawn below the written text
+        self.frame_interval = frame_interval
+        self.auto_render = auto_render
+        self.pending: List[str] = []  # written text of the next frame
+        self.dirty = False
+        self.last_frame = 0.0  # time.monotonic() of the last frame
+        self.shown: Optional[Tuple[str, str, str, int]] = None  # label, color, buffer and cursor on the screen
+        self.wake_renderer = threading.Event()
+        self.renderer: Optional[threading.Thread] = None
 
-    def update_input_label(self, label):
-        self.label = label
-        self.label_colored = colored(self.label, self.label_color)
-        if self.read_lock.locked():
-            self.__write_input()
+    def __changed(self):
+        """
+        called with write_lock held after the state changed
+        """
+        if self.dirty:
+            return
+        self.dirty = True
+        if self.auto_render:
+            if self.renderer is None:
+                self.renderer = threading.Thread(target=self.__render_loop, name='render', daemon=True)
+                self.renderer.start()
+            self.wake_renderer.set()
 
-    def __clear_input(self):
-        with self.write_lock:
-            sys.stdout.write('\r')
-            sys.stdout.write(''.join(' ' for _ in range(len(self.last_line))))
-            sys.stdout.write('\r')
-            self.last_line = ''
+    def __render_loop(self):
+        while True:
+            self.wake_renderer.wait()
+            self.wake_renderer.clear()
+            delay = self.frame_due()
+            if delay:
+                time.sleep(delay)
+            self.render()
+
+    def frame_due(self) -> Optional[float]:
+        """
+        seconds until the next frame may be drawn, 0 if it is due, None if there is nothing to draw
+        """
+        if not self.dirty:
+            return None
+        return max(0.0, self.last_frame + self.frame_interval - time.monotonic())
+
+    def render(self):
+        """
+        draw what changed since the last frame
+        """
+        with self.render_lock:
+            with self.write_lock:
+                if not self.dirty:
+                    return
+                lines, self.pending = self.pending, []
+                line = (self.label, self.label_color, self.line.text(), self.line.cursor) if self.editing else None
+                shown = self.shown
+                self.shown = line
+                self.dirty = False
+                self.last_frame = time.monotonic()
+            frame = []
+            if lines:
+                if shown is not None:
+                    frame.append('\r\x1b[K')  # the text goes where the input line was, it is drawn again below
+                    shown = None
+                frame.extend(lines)
+            frame.append(line_diff(shown, line))
+            sys.stdout.write(''.join(frame))
             sys.stdout.flush()
 
-    def __move_cursor(self, txt: str, at: int):
+    def flush(self):
+        """
+        draw now, before the program exits or gives the terminal away
+        """
         with self.write_lock:
-            sys.stdout.write('\r')
-            sys.stdout.write(txt[:at])
-            sys.stdout.flush()
+            self.dirty = True
+        self.render()
 
-    def __write_input(self, append=''):
+    def update_input_label(self, label):
         with self.write_lock:
-            self.__clear_input()
-            with self.buffer_lock.for_read():
-                self.last_line = self.label_colored + self.read_buffer + append
-                sys.stdout.write(self.last_line)
-                self.__move_cursor(self.last_line, self.cursor_at + len(self.label_colored))
-                self.last_writer_was_reader = True
+            self.label = label
+            self.__changed()
 
     def update_input_label_color(self, color):
-        self.label_color = color
-        self.label_colored = colored(self.label, self.label_color)
-        if self.read_lock.locked():
-            self.__write_input()
+        with self.write_lock:
+            self.label_color = color
+            self.__changed()
 
     def __command_left_key(self):
         with self.write_lock:
-            if self.cursor_at > 0:
-                self.cursor_at -= 1
-                self.__move_cursor(self.last_line, self.cursor_at + len(self.label_colored))
+            if self.line.cursor > 0:
+                self.line.move_to(self.line.cursor - 1)
+                self.__changed()
 
     def __command_right_key(self):
         with self.write_lock:
-            if self.cursor_at < len(self.last_line) - len(self.label_colored):
-                self.cursor_at += 1
-                self.__move_cursor(self.last_line, self.cursor_at + len(self.label_colored))
+            if self.line.cursor < len(self.line):
+                self.line.move_to(self.line.cursor + 1)
+                self.__changed()
 
     def __command_up_key(self):
         with self.write_lock:
-            if self.history_tail_index > 0:
-                self.history_tail_index -= 1
-                self.update_input_buffer(self.history[self.history_tail_index])
+            entry = self.history.older(self.line.text())
+            if entry is not None:
+                self.update_input_buffer(entry)
 
     def __command_down_key(self):
         with self.write_lock:
-            if len(self.history) - 1 > self.history_tail_index:
-                self.history_tail_index += 1
-                self.update_input_buffer(self.history[self.history_tail_index])
+            entry = self.history.newer()
+            if entry is not None:
+                self.update_input_buffer(entry)
 
     def __command_delete_key(self):
         with self.write_lock:
-            if self.cursor_at < len(self.read_buffer):
-                # delete char after cursor
-                self.read_buffer = self.read_buffer[:self.cursor_at] + self.read_buffer[self.cursor_at + 1:]
-                self.__write_input()
+            if self.line.delete_after():
+                self.__changed()
 
     def handle_stroke(self, char):
-        with self.buffer_lock.for_read():
-            if char == key.UP:  # up
-                self.__command_up_key()
-            elif char == key.DOWN:  # bottom
-                self.__command_down_key()
-            elif char == key.LEFT:  # left
-                self.__command_left_key()
-            elif char == key.RIGHT:  # right
-                self.__command_right_key()
-            elif char == key.DELETE:  # delete
-                self.__command_delete_key()
-            else:
-                # modify the code and add another elif and handle it by yourself...
-                self.write(f"unhandled control: {char.encode('utf-8')}")
+        if char == key.UP:  # up
+            self.__command_up_key()
+        elif char == key.DOWN:  # bottom
+            self.__command_down_key()
+        elif char == key.LEFT:  # left
+            self.__command_left_key()
+        elif char == key.RIGHT:  # right
+            self.__command_right_key()
+        elif char == key.DELETE:  # delete
+            self.__command_delete_key()
+        else:
+            # modify the code and add another elif and handle it by yourself...
+            self.write(f"unhandled control: {char.encode('utf-8')}")
 
     def thread_read(self):
-        self.__write_input()
         try:
             while True:
                 try:
                     char = readkey()
                 except KeyboardInterrupt:
-                    with self.buffer_lock.for_read():
-                        self.read_interrupted_buffer = self.read_buffer
-                        self.read_interrupted = True
-                    self.__clear_input()
-                    break
-                # self.write(char.encode('utf-8'))
-                if len(char) > 1:
-                    self.handle_stroke(char)
-                    continue
-                delchr = ord(char) == 8 or ord(char) == 127
-                if delchr:
-                    with self.buffer_lock.for_write():
-                        if len(self.read_buffer) != 0 and self.cursor_at > 0:
-                            # delete char before cursor
-                            self.read_buffer = self.read_buffer[:self.cursor_at - 1] + self.read_buffer[self.cursor_at:]
-                            self.cursor_at -= 1
-                            self.__write_input()
-                    continue
-                line_feed = char == '\n' or char == '\r'
-                read_interrupted = ord(char) == 3
-
-                if line_feed or read_interrupted:
-                    self.__clear_input()
-                    if read_interrupted:
-                        with self.buffer_lock.for_read():
-                            self.read_interrupted_buffer = self.read_buffer
-                        self.read_interrupted = True
+                    char = '\x03'
+                if self.feed_key(char):
                     break
-                if ord(char) <= 31:
-                    continue  # control character
-                with self.write_lock:
-                    with self.buffer_lock.for_write():
-                        self.read_buffer = self.read_buffer[:self.cursor_at] + char + self.read_buffer[self.cursor_at:]
-                        self.cursor_at += 1
-                    self.__write_input()
         except BaseException:
             self.read_error = traceback.format_exc()
             return
 
+    def feed_key(self, char: str) -> bool:
+        """
+        apply one key to the line being read, returns True when the line is done (enter or Ctrl+C)
+        """
+        if len(char) > 1:
+            self.handle_stroke(char)
+            return False
+        with self.write_lock:
+            delchr = ord(char) == 8 or ord(char) == 127
+            if delchr:
+                if self.line.delete_before():
+                    self.__changed()
+                return False
+            line_feed = char == '\n' or char == '\r'
+            read_interrupted = ord(char) == 3
+
+            if line_feed or read_interrupted:
+                if read_interrupted:
+                    self.read_interrupted_buffer = self.line.text()
+                    self.read_interrupted = True
+                return True
+            if ord(char) <= 31:
+                return False  # control character
+            self.line.insert(char)
+            self.__changed()
+        return False
+
     def write(self, txt: object, new_line=True):
-        txt = str(txt)
         with self.write_lock:
-            if self.read_lock.locked():
-                self.__clear_input()
-                sys.stdout.write(txt)
-                sys.stdout.write('\n')
-                with self.buffer_lock.for_read():
-                    self.__write_input()
-            else:
-                sys.stdout.write(txt)
-                if new_line:
-                    sys.stdout.write('\n')
-                sys.stdout.flush()
-                self.last_line = ''
-            self.last_writer_was_reader = False
+            # the input line starts at the beginning of a line, the text before it must end
+            self.pending.append(str(txt) + ('\n' if new_line or self.editing else ''))
+            self.__changed()
 
     def update_input_buffer(self, txt: str):
-        with self.buffer_lock.for_write():
-            self.read_buffer = txt
-        if self.read_lock.locked():
-            self.__write_input()
+        with self.write_lock:
+            self.line.set(txt)
+            self.__changed()
 
     def interrupted_buffer(self):
-        with self.buffer_lock.for_read():
+        with self.write_lock:
             return self.read_interrupted_buffer
 
-    def input(self, label: str = None, color=None, history=None):
+    def input(self, label: str = None, color=None, history: InputHistory = None):
         """"
         throws KeyboardInterrupt or ReadError
         """
         with self.read_lock:
-            self.history = history or []
-            self.history_tail_index = len(self.history)
-            self.read_interrupted_buffer = ''
-            self.read_interrupted = False
-            if label is not None:
-                self.update_input_label(label)
-            self.cursor_at = 0
-            if color is not None:
-                self.update_input_label_color(color)
+            self.begin_input(label, color, history)
             t = threading.Thread(target=self.thread_read)
             t.daemon = True
             t.start()
             t.join()
-            v = self.read_buffer
-            self.read_buffer = ''
-            if self.read_interrupted:
-                self.read_interrupted = False
-                raise KeyboardInterrupt()
-            if self.read_error:
-                err = self.read_error
-                self.read_error = None
-                raise ReadError(err)
-            return v
+            return self.end_input()
+
+    def begin_input(self, label: str = None, color=None, history: InputHistory = None):
+        """
+        start reading a line from keys given to feed_key, input() does it with a thread that reads the terminal
+        """
+        with self.write_lock:
+            self.editing = True
+            self.history = history if history is not None else InputHistory()
+            self.history.reset()
+            self.read_interrupted_buffer = ''
+            self.read_interrupted = False
+            if label is not None:
+                self.label = label
+            if color is not None:
+                self.label_color = color
+            self.__changed()
+
+    def end_input(self) -> str:
+        """
+        the line read since begin_input, throws KeyboardInterrupt or ReadError
+        """
+        with self.write_lock:
+            self.editing = False
+            self.__changed()
+            v = self.line.text()
+            self.line.set('')
+        if self.read_interrupted:
+            self.read_interrupted = False
+            raise KeyboardInterrupt()
+        if self.read_error:
+            err = self.read_error
+            self.read_error = None
+            raise ReadError(err)
+        return v
+
+
+def line_diff(shown: Optional[Tuple[str, str, str, int]], line: Optional[Tuple[str, str, str, int]]) -> str:
+    """
+    escape codes and text that turn the input line shown into line, the cursor is on the shown line.
+    either is (label, label color, buffer, cursor) or None for no input line
+    """
+    if line is None:
+        return '' if shown is None else '\r\x1b[K'
+    label, color, buffer, cursor = line
+    if shown is None or shown[:2] != line[:2]:
+        return '\r\x1b[K' + colored(label, color) + buffer + move_cursor(len(buffer), cursor)
+    old_buffer, old_cursor = shown[2], shown[3]
+    if old_buffer == buffer:
+        return move_cursor(old_cursor, cursor)
+    same = 0
+    for old_char, char in zip(old_buffer, buffer):
+        if old_char != char:
+            break
+        same += 1
+    # rewrite from the first changed cell, clear what is left of a longer line
+    return (move_cursor(old_cursor, same) + buffer[same:] + ('\x1b[K' if len(old_buffer) > len(buffer) else '') +
+            move_cursor(len(buffer), cursor))
+
+
+def move_cursor(column: int, to: int) -> str:
+    if to > column:
+        return f'\x1b[{to - column}C'
+    if to < column:
+        return f'\x1b[{column - to}D'
+    return ''
+
+
+class KeyDecoder:
+    """
+    splits what a terminal in cbreak mode sends into the keys readkey() returns, for callers that read the
+    terminal without blocking
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = ''  # start of an escape sequence that is not complete yet
+
+    def feed(self, data: bytes) -> List[str]:
+        text = self.pending + self.decoder.decode(data)
+        keys = []
+        at = 0
+        while at < len(text):
+            end = at + 1
+            # terminals write a sequence at once, an escape at the end of the data is the escape key
+            if text[at] == '\x1b' and end < len(text):
+                if text[end] in '[O':
+                    # CSI or SS3, ends with a byte in @..~
+                    end += 1
+                    while end < len(text) and not '@' <= text[end] <= '~':
+                        end += 1
+                    if end == len(text):
+                        break
+                end += 1  # alt+key comes as escape and the key
+            keys.append(text[at:end])
+            at = end
+        self.pending = text[at:]
+        return keys
@@ -1,16 +1,22 @@
 # Import socket module
 import os
+import selectors
 import socket as sockets
+import sys
 import threading
 import traceback
 from concurrent.futures import ThreadPoolExecutor
-from typing import Optional
+from collections import deque
+from typing import Deque, Optional
 
 from termcolor import colored
 
 from BufferedSocketStream import BufferedSocketStream
 from ReentrantRWLock import ReentrantRWLock
-from cli_io import IO, ReadError
+from compression import Inflater, InflatingReader
+from cli_io import IO, KeyDecoder, ReadError
+from line_editor import InputHistory
+from frame_codec import decode_server_frame_v2
 from lib import soft_join
 from server_types import ServerUser, ClientUser, Group, Message, ClientMessage, parse_args
 
@@ -22,7 +28,7 @@ system_user = ServerUser(None, senders, username='system')
 global_group = Group('global', system_user, senders)
 system_user.system_user = system_user
 server_user = ClientUser(senders=senders, username='null')
-server_user.target = global_group
+server_user.target = global_group.name
 server_user.target_context = Message.CONTEXT_GROUP
 server_user.chat_target = ''
 groups = [global_group]
@@ -30,6 +36,9 @@ users = [system_user, server_user]
 
 send_receive_lock = threading.Lock()
 picking_username = False
+username_prompts = 0  # '/req username' received so far
+engine = 'threads'  # engine=selectors runs the whole client on one thread
+outgoing = bytearray()  # engine=selectors, bytes the socket did not take yet
 
 allowed_colors = [
     'grey',
@@ -77,167 +86,336 @@ def write_program_info(txt):
     io.write(colored('program: ' + txt, target_colors[system_user.name]))
 
 
+def send_to_server(data: bytes):
+    if engine == 'threads':
+        server_user.send_bytes_async(data)
+        return
+    if not outgoing:
+        try:
+            data = data[server_user.socket.send(data):]
+        except BlockingIOError:
+            pass
+    outgoing.extend(data)
+
+
+def handle_server_message(msg: ClientMessage):
+    """
+    show or apply one message of the server
+    """
+    global picking_username, username_prompts
+    if msg.sender_context == Message.CONTEXT_SYSTEM:
+        if msg.target_context == Message.CONTEXT_USER:
+            # only for me
+            if msg.content.startswith('/hello'):
+                # handshake answer, compression needs nothing more from this side
+                if 'version=2' in msg.content.split():
+                    server_user.protocol = 2
+                return
+            elif msg.content == '/ping':
+                # heartbeat, the server drops connections that stay quiet
+                send_to_server(ClientMessage.to_server(target_context=Message.CONTEXT_SYSTEM, target='system',
+                                                       content='/pong', version=server_user.protocol))
+                return
+            elif msg.content == '/req username':
+                picking_username = True
+                username_prompts += 1
+                server_user.target = system_user.name
+                server_user.chat_target = 'username'
+                io.update_input_label("username: ")
+                io.update_input_label_color(target_colors[system_user.name])
+                return
+            elif msg.content.startswith('/set username '):
+                server_user.name = msg.content[14:]
+                picking_username = False
+                server_user.chat_target = server_user.target = 'global'
+                io.update_input_label("global: ")
+                io.update_input_label_color('white')
+                return
+            elif msg.content.startswith('/switch '):
+                server_user.target = server_user.chat_target = msg.content[8:]
+                io.update_input_label(server_user.chat_target + ": ")
+                io.update_input_label_color(target_colors.get(server_user.target, 'white'))
+                return
+            elif msg.content.startswith("You're whispering to"):
+                io.write(colored(msg.content, whisper_color))
+                return
+            else:
+                write_message_formatted(msg.content, sender=msg.sender, is_system=True)
+                return
+        elif msg.target_context == Message.CONTEXT_GROUP:
+            write_message_formatted(msg.content, group=msg.target, sender=msg.sender, is_system=True)
+            return
+        else:
+            write_error("error: server sent message with unhandled context: " + msg.target_context)
+            return
+    elif msg.target == server_user.name:
+        write_message_formatted(msg.content, sender=msg.sender, is_whisper=True)
+        return
+    elif msg.target_context == Message.CONTEXT_USER and msg.sender == server_user.name:
+        # my own whisper, replayed from the history
+        io.write(colored(f"You're whispering to {msg.target}: {msg.content}", whisper_color))
+        return
+    elif msg.target_context == Message.CONTEXT_GROUP:
+        write_message_formatted(msg.content, group=msg.target, sender=msg.sender)
+        return
+    write_error(f"received unhandled message {msg}")
+
+
+def handle_input(msg: str) -> bool:
+    """
+    apply one line typed by the user, returns False when the user asked to exit
+    """
+    if msg.startswith('/switch ') and len(msg[8:].strip()) > 0:
+        server_user.target_context = Message.CONTEXT_GROUP
+        server_user.chat_target = server_user.target = msg[8:].strip()
+        io.update_input_label(server_user.chat_target + ": ")
+        io.update_input_label_color(target_colors.get(server_user.target, 'white'))
+        return True
+    elif msg.startswith('/color ') and len(msg[7:].strip()) > 0:
+        color = msg[7:].strip()
+        if color not in allowed_colors:
+            write_error('client: allowed colors are ' + ','.join(allowed_colors))
+            return True
+        target_colors[server_user.target] = color
+        io.update_input_label_color(color)
+        return True
+    elif msg == '/exit' or msg == '/quit':
+        write_program_info("exiting chat program")
+        close_program.set()
+        #server_user.socket.close()
+        return False
+
+    elif msg.startswith('/w ') and len(msg[3:].strip()) > 0:
+        msg = msg[3:].strip()
+        sep = msg.find(' ')
+        if sep == -1:
+            write_error('must provide user and message')
+            return True
+        username = msg[0:sep].strip()
+        msg = msg[sep:].strip()
+        if len(msg) == 0:
+            write_error('must provide user and message message')
+            return True
+        send_to_server(
+            ClientMessage.to_server(
+                target_context=Message.CONTEXT_USER,
+                target=username,
+                content=msg,
+                version=server_user.protocol,
+            )
+        )
+        io.update_input_buffer(f'/w {username} ')
+        return True
+    elif msg == '/help':
+        io.write('')
+        write_program_info('''chat commands
+/w <user_name>          whisper user
+/switch <group_name>    switch to another group
+/color                  change color of this group
+/quit or /exit          exit
+/help                   show commands\n''')
+        pass  # show program
+    elif msg == '':
+        return True
+    # otherwise send to server
+    send_to_server(
+        ClientMessage.to_server(
+            target_context=server_user.target_context,
+            target=server_user.target,
+            content=msg,
+            version=server_user.protocol,
+        )
+    )
+    return True
+
+
 def server_interface_thread():
     """
     handles commands from the server
     """
-    global picking_username
     try:
-        input_stream = BufferedSocketStream(server_user.socket)
+        # blocks can only come after the hello offered compression, plain frames read the same either way
+        input_stream = InflatingReader(BufferedSocketStream(server_user.socket))
         while True:
             try:
                 msg = ClientMessage.from_server(input_stream)
             except ConnectionError as err:
                 write_error(f"fatal: server connection dropped, cause: {err}")
                 break
-            # io.write(str(msg))
             with send_receive_lock:
-                if msg.sender_context == Message.CONTEXT_SYSTEM:
-                    if msg.target_context == Message.CONTEXT_USER:
-                        # only for me
-                        if msg.content == '/req username':
-                            picking_username = True
-                            server_user.target = system_user.name
-                            server_user.chat_target = 'username'
-                            io.update_input_label("username: ")
-                            io.update_input_label_color(target_colors[system_user.name])
-                            continue
-                        elif msg.content.startswith('/set username '):
-                            server_user.name = msg.content[14:]
-                            picking_username = False
-                            server_user.chat_target = server_user.target = 'global'
-                            io.update_input_label("global: ")
-                            io.update_input_label_color('white')
-                            continue
-                        elif msg.content.startswith('/switch '):
-                            server_user.target = server_user.chat_target = msg.content[8:]
-                            io.update_input_label(server_user.chat_target + ": ")
-                            io.update_input_label_color(target_colors.get(server_user.target, 'white'))
-                            continue
-                        elif msg.content.startswith("You're whispering to"):
-                            io.write(colored(msg.content, whisper_color))
-                            continue
-                        else:
-                            write_message_formatted(msg.content, sender=msg.sender, is_system=True)
-                            continue
-                    elif msg.target_context == Message.CONTEXT_GROUP:
-                        write_message_formatted(msg.content, group=msg.target, sender=msg.sender, is_system=True)
-                        continue
-                    else:
-                        write_error("error: server sent message with unhandled context: " + msg.target_context)
-                        continue
-                elif msg.target == server_user.name:
-                    write_message_formatted(msg.content, sender=msg.sender, is_whisper=True)
-                    continue
-                elif msg.target_context == Message.CONTEXT_GROUP:
-                    write_message_formatted(msg.content, group=msg.target, sender=msg.sender)
-                    continue
-            write_error(f"received unhandled message {msg}")
+                handle_server_message(msg)
     finally:
         close_program.set()
 
 
+class InputState:
+    """
+    what reading the terminal remembers from one line to the next
+    """
+
+    def __init__(self):
+        self.last_was_interrupt = False
+        self.interrupt_times = 0
+        self.history = InputHistory()
+
+    def interrupted(self) -> bool:
+        """
+        Ctrl+C while reading a line, returns False on the third one in a row
+        """
+        if self.interrupt_times == 2:
+            write_program_info("exiting chat program")
+            close_program.set()
+            return False
+        if self.last_was_interrupt or len(io.interrupted_buffer()) == 0:
+            write_program_info(f"type /exit to quit or hit Ctrl+C {2 - self.interrupt_times} more times")
+            self.interrupt_times += 1
+        else:
+            self.last_was_interrupt = True
+        return True
+
+    def line(self, msg: str) -> bool:
+        """
+        a line was read, returns False when the user asked to exit
+        """
+        msg = msg.strip()
+        self.history.add(msg)
+        self.last_was_interrupt = False
+        self.interrupt_times = 0
+        try:
+            return handle_input(msg)
+        except BaseException as e:
+            write_error("error:" + str(e) + "\ntraceback:" + traceback.format_exc())
+            return True
+
+
 def interaction_thread():
     """
     handles commands from the user terminal
     """
-    last_was_interrupt = False
-    interrupt_times = 0
-    input_history = []
+    state = InputState()
     try:
         while True:
             try:
-                msg = io.input(history=input_history).strip()
-                if len(msg) > 0:
-                    input_history.append(msg)
-                if len(input_history) > 1000:
-                    input_history.pop(0)
+                msg = io.input(history=state.history)
             except KeyboardInterrupt:
-                if interrupt_times == 2:
-                    write_program_info("exiting chat program")
-                    close_program.set()
+                if not state.interrupted():
                     return
-                if last_was_interrupt or len(io.interrupted_buffer()) == 0:
-                    write_program_info(f"type /exit to quit or hit Ctrl+C {2 - interrupt_times} more times")
-                    interrupt_times += 1
-                else:
-                    last_was_interrupt = True
-                    continue
                 continue
             except ReadError as e:
                 write_error("input-error:" + str(e))
                 continue
-            last_was_interrupt = False
-            interrupt_times = 0
-            try:
-                with send_receive_lock:
-                    if msg.startswith('/switch ') and len(msg[8:].strip()) > 0:
-                        server_user.target_context = Message.CONTEXT_GROUP
-                        server_user.chat_target = server_user.target = msg[8:].strip()
-                        io.update_input_label(server_user.chat_target + ": ")
-                        io.update_input_label_color(target_colors.get(server_user.target, 'white'))
-                        continue
-                    elif msg.startswith('/color ') and len(msg[7:].strip()) > 0:
-                        color = msg[7:].strip()
-                        if color not in allowed_colors:
-                            write_error('client: allowed colors are ' + ','.join(allowed_colors))
-                            continue
-                        target_colors[server_user.target] = color
-                        io.update_input_label_color(color)
-                        continue
-                    elif msg == '/exit' or msg == '/quit':
-                        write_program_info("exiting chat program")
-                        close_program.set()
-                        #server_user.socket.close()
-                        return
-
-                    elif msg.startswith('/w ') and len(msg[3:].strip()) > 0:
-                        msg = msg[3:].strip()
-                        sep = msg.find(' ')
-                        if sep == -1:
-                            write_error('must provide user and message')
-                            continue
-                        username = msg[0:sep].strip()
-                        msg = msg[sep:].strip()
-                        if len(msg) == 0:
-                            write_error('must provide user and message message')
-                            continue
-                        server_user.send_bytes_async(
-                            ClientMessage.to_server(
-                                target_context=Message.CONTEXT_USER,
-                                target=username,
-                                content=msg,
-                            )
-                        )
-                        io.update_input_buffer(f'/w {username} ')
-                        continue
-                    elif msg == '/help':
-                        io.write('')
-                        write_program_info('''chat commands
-/w <user_name>          whisper user
-/switch <group_name>    switch to another group
-/color                  change color of this group
-/quit or /exit          exit
-/help                   show commands\n''')
-                        pass  # show program
-                    elif msg == '':
-                        continue
-                    # otherwise send to server
-                    server_user.send_bytes_async(
-                        ClientMessage.to_server(
-                            target_context=server_user.target_context,
-                            target=server_user.target,
-                            content=msg,
-                        )
-                    )
-            except BaseException as e:
-                write_error("error:" + str(e) + "\ntraceback:" + traceback.format_exc())
+            with send_receive_lock:
+                if not state.line(msg):
+                    return
     finally:
         close_program.set()
 
 
+def serve_selectors():
+    """
+    engine=selectors, one thread waits on the socket and the terminal together and nothing else is started.
+    the terminal is put in cbreak mode so keys arrive as they are typed, piped input is read line by line
+    and the client exits once it was sent
+    """
+    try:
+        import termios
+        import tty
+    except ImportError as e:
+        raise ValueError("engine=selectors needs a posix terminal, use engine=threads") from e
+    socket = server_user.socket
+    socket.setblocking(False)
+    stdin = sys.stdin.fileno()
+    terminal = os.isatty(stdin)
+    selector = selectors.DefaultSelector()
+    selector.register(socket, selectors.EVENT_READ)
+    selector.register(stdin, selectors.EVENT_READ)
+    socket_events = selectors.EVENT_READ
+    inflater = Inflater()
+    received = bytearray()
+    keys = KeyDecoder()
+    typed = bytearray()  # piped input after the last full line
+    piped_lines: Deque[str] = deque()
+    prompts_answered = 0
+    state = InputState()
+    piped_done = False
+    saved_mode = None
+    if terminal:
+        saved_mode = termios.tcgetattr(stdin)
+        tty.setcbreak(stdin)
+        mode = termios.tcgetattr(stdin)
+        mode[3] &= ~termios.ISIG  # Ctrl+C comes as a key, like it does from readkey
+        termios.tcsetattr(stdin, termios.TCSANOW, mode)
+        io.begin_input(history=state.history)
+    try:
+        while not close_program.is_set() and not (piped_done and not piped_lines and not outgoing):
+            for selected, events in selector.select(io.frame_due()):
+                if selected.fileobj is socket:
+                    if events & selectors.EVENT_WRITE:
+                        del outgoing[:socket.send(outgoing)]
+                    if events & selectors.EVENT_READ:
+                        data = socket.recv(64 * 1024)
+                        if not data:
+                            write_error("fatal: server connection dropped, cause: received 0 bytes")
+                            return
+                        received.extend(data)
+                        # decoded to tuples, no view of received outlives the call
+                        frames, consumed, _ = inflater.decode_frames(received, decode_server_frame_v2)
+                        del received[:consumed]
+                        for frame in frames:
+                            handle_server_message(ClientMessage.from_frame(frame))
+                    continue
+                data = os.read(stdin, 4096)
+                if terminal:
+                    for key in keys.feed(data):
+                        if io.feed_key(key) and not read_line(state):
+                            return
+                    continue
+                if not data:
+                    selector.unregister(stdin)
+                    piped_done = True
+                typed.extend(data)
+                *lines, rest = typed.split(b'\n')
+                typed = bytearray(rest)
+                piped_lines.extend(line.decode('utf-8', 'replace') for line in lines)
+            # a script does not see the prompts, its first line answers the username prompt and the rest waits
+            # until the name was accepted
+            while piped_lines and username_prompts and (not picking_username or prompts_answered < username_prompts):
+                prompts_answered = username_prompts
+                if not state.line(piped_lines.popleft()):
+                    return
+            if io.frame_due() == 0:
+                io.render()
+            wanted = selectors.EVENT_READ | (selectors.EVENT_WRITE if outgoing else 0)
+            if wanted != socket_events:
+                selector.modify(socket, wanted)
+                socket_events = wanted
+    except ConnectionError as err:
+        write_error(f"fatal: server connection dropped, cause: {err}")
+    finally:
+        io.flush()
+        if saved_mode is not None:
+            termios.tcsetattr(stdin, termios.TCSADRAIN, saved_mode)
+        selector.close()
+        close_program.set()
+
+
+def read_line(state: InputState) -> bool:
+    """
+    the terminal finished a line, hand it over and start the next one. returns False when the user asked to exit
+    """
+    try:
+        line = io.end_input()
+    except KeyboardInterrupt:
+        go_on = state.interrupted()
+    else:
+        go_on = state.line(line)
+    if go_on:
+        io.begin_input(history=state.history)
+    return go_on
+
+
 def main():
-    import sys
+    global engine
     args = parse_args(sys.argv[1:])
     host = args.get('host', 'localhost')  # default all networks
     try:
@@ -246,6 +424,11 @@ def main():
         print("port parse failed, expected integer")
         raise e
 
+    engine = args.get('engine', 'threads')
+    if engine not in ('threads', 'selectors'):
+        raise ValueError(f"unknown engine {engine}, expected threads or selectors")
+    io.auto_render = engine == 'threads'  # the selectors loop draws the frames itself
+
     s = sockets.socket(sockets.AF_INET, sockets.SOCK_STREAM)
 
     try:
@@ -255,6 +438,19 @@ def main():
         exit(0)
     server_user.socket = s
     io.write(f"connected to {host}:{port}")
+    compress = args.get('compress', 'zlib')  # compress=off reads plain frames only
+    protocol = args.get('protocol', '2')  # protocol=1 keeps the v1 frames and their 65535 byte messages
+    options = [f'version={protocol}'] if protocol != '1' else []
+    if compress != 'off':
+        options.append(f'compress={compress}')
+    options.append('heartbeat=ping')  # answered in handle_server_message
+    if options:
+        s.sendall(ClientMessage.to_server(target_context=Message.CONTEXT_SYSTEM, target='system',
+                                          content=' '.join(['/hello'] + options)))
+    if engine == 'selectors':
+        serve_selectors()
+        print()
+        return
     communicator = threading.Thread(target=server_interface_thread)
     communicator.daemon = True
     communicator.start()
@@ -263,6 +459,7 @@ def main():
     interactor.start()
     soft_join(interactor, close_program)
     soft_join(communicator, close_program)
+    io.flush()
     print()
 
 
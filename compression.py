@@ -0,0 +1,166 @@
+"""
+optional compression of the server to client stream, a client offers it in its hello and the server answers with
+what it accepted. every connection keeps one deflate stream, so names and phrases seen earlier on the connection
+compress to a few bytes, and a preset dictionary of typical traffic helps from the first frame.
+a batch of frames at least threshold bytes long goes out as one block, smaller batches stay plain frames:
+SIGZ(2) SIZE(4) DEFLATE(SIZE), the deflate data ends with a sync flush so it inflates to whole frames.
+blocks and plain frames mix freely, a client inflates blocks in order and reads the frames inside
+"""
+import struct
+import zlib
+from typing import Callable, List, Tuple, TypeVar, Union
+
+from frame_codec import SIG, encode_name, server_head
+
+T = TypeVar('T')
+
+SIGZ = SIG + 1  # first bytes of a compressed block, never the start of a frame
+SIGZ_BYTES = SIGZ.to_bytes(2, 'little')
+BLOCK_HEAD = struct.Struct('<HI')  # SIGZ, SIZE
+SYNC_TAIL = b'\x00\x00\xff\xff'  # ends every sync flush, left off the wire and put back before inflating
+METHODS = ('zlib',)
+
+# a 4KiB window and a small hash table keep a connection's deflate state around 32KiB instead of 256KiB
+WBITS = -12  # raw deflate, no zlib header per block
+MEM_LEVEL = 5
+LEVEL = 6
+
+
+def preset_dictionary() -> bytes:
+    """
+    frame prefixes and phrases the server sends all the time, the most common ones last.
+    clients must build the same bytes, change it only together with the method name
+    """
+    user, group, system = 1, 2, 3  # Message contexts
+    phrases = [
+        "you was invited by ", " to join group ", " type \"/accept ", "invite was sent to ",
+        "you are not the group admin", "you have created the group ", "is now the group admin",
+        "has entered the group", "has left", "has disconnected", "has connected", "users in ", "/switch ",
+        "You're whispering to ", "Hi there, how are you? Nice to meet you, not too bad, thanks. that's great",
+    ]
+    prefixes = [
+        server_head(system, user) + encode_name('system'),
+        server_head(system, group) + encode_name('system'),
+        server_head(user, user),
+        server_head(user, group),
+        encode_name('global'),
+    ]
+    return ''.join(phrases).encode('utf-8') + b''.join(prefixes)
+
+
+PRESET_DICTIONARY = preset_dictionary()
+
+
+class Deflater:
+    """
+    compressing side of one connection, used by its single writer
+    """
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold  # smaller batches are sent as they are
+        self.stream = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, MEM_LEVEL, zdict=PRESET_DICTIONARY)
+
+    def encode(self, buffers: List[bytes]) -> List[bytes]:
+        """
+        the buffers of a batch of frames as they go on the wire
+        """
+        if sum(len(buffer) for buffer in buffers) < self.threshold:
+            return buffers
+        data = b''.join([self.stream.compress(buffer) for buffer in buffers] +
+                        [self.stream.flush(zlib.Z_SYNC_FLUSH)[:-len(SYNC_TAIL)]])
+        # sent even when it did not shrink, the other side's stream has to see what this one consumed
+        return [BLOCK_HEAD.pack(SIGZ, len(data)), data]
+
+
+class Inflater:
+    """
+    decompressing side of one connection
+    """
+
+    def __init__(self):
+        self.stream = zlib.decompressobj(WBITS, zdict=PRESET_DICTIONARY)
+
+    def inflate(self, data) -> bytes:
+        return self.stream.decompress(bytes(data) + SYNC_TAIL)
+
+    @staticmethod
+    def decode_block(buffer, offset=0) -> Union[Tuple[memoryview, int], int, None]:
+        """
+        the deflate data of the block at offset and the block size, the bytes the block needs when it is incomplete,
+        or None when offset is not at a block
+        """
+        available = len(buffer) - offset
+        if available < BLOCK_HEAD.size:
+            if available >= 2 and buffer[offset:offset + 2] != SIGZ_BYTES:
+                return None
+            return BLOCK_HEAD.size
+        sig, size = BLOCK_HEAD.unpack_from(buffer, offset)
+        if sig != SIGZ:
+            return None
+        end = BLOCK_HEAD.size + size
+        if available < end:
+            return end
+        return memoryview(buffer)[offset + BLOCK_HEAD.size:offset + end], end
+
+    def decode_frames(self, buffer, decode_frame: Callable) -> Tuple[List[T], int, int]:
+        """
+        every complete frame in buffer, plain or inside blocks. decode_frame is a single frame decoder of
+        frame_codec, returns (frames, bytes consumed, bytes needed by the incomplete frame or block that follows)
+        """
+        frames = []
+        offset = 0
+        while True:
+            block = Inflater.decode_block(buffer, offset)
+            if block is None:
+                decoded = decode_frame(buffer, offset)
+                if type(decoded) is int:
+                    return frames, offset, decoded
+                frames.append(decoded[0])
+                offset += decoded[1]
+            elif type(block) is int:
+                return frames, offset, block
+            else:
+                data, size = block
+                inflated = self.inflate(data)
+                position = 0
+                while position < len(inflated):  # blocks hold whole frames
+                    frame, frame_size = decode_frame(inflated, position)
+                    frames.append(frame)
+                    position += frame_size
+                offset += size
+
+
+class InflatingReader:
+    """
+    read_frame of a BufferedSocketStream for a server stream that may hold blocks
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.inflater = Inflater()
+        self.pending = memoryview(b'')  # inflated frames not read yet
+
+    def read_frame(self, parse: Callable[[memoryview], Union[Tuple[T, int], int]]) -> T:
+        while True:
+            if self.pending:
+                frame, size = parse(self.pending)
+                self.pending = self.pending[size:]
+                return frame
+            is_block, frame = self.stream.read_frame(lambda view: self._parse(view, parse))
+            if not is_block:
+                return frame
+            self.pending = memoryview(self.inflater.inflate(frame))
+
+    @staticmethod
+    def _parse(view: memoryview, parse: Callable[[memoryview], Union[Tuple[T, int], int]]):
+        """
+        (True, deflate data) for a block or (False, frame) for a plain frame
+        """
+        block = Inflater.decode_block(view)
+        if block is None:
+            parsed = parse(view)
+            return parsed if type(parsed) is int else ((False, parsed[0]), parsed[1])
+        if type(block) is int:
+            return block
+        data, size = block
+        return (True, bytes(data)), size
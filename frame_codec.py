@@ -0,0 +1,358 @@
+"""
+struct based encoding and decoding of the wire frames described in server.py.
+headers are unpacked with precompiled structs, and the *_frames decoders walk every
+complete frame of a buffer in one loop. decoders take v1 and v2 frames alike, the signature tells them apart
+"""
+import struct
+import time
+from typing import List, Optional, Tuple, Union
+
+SIG = 65136
+SIG_BYTES = SIG.to_bytes(length=2, byteorder='little')
+SIG2 = SIG + 2  # protocol v2 frames, SIG + 1 starts a compressed block
+SIG2_BYTES = SIG2.to_bytes(length=2, byteorder='little')
+
+CLIENT_HEAD = struct.Struct('<HBB')  # SIG, TARGET_CONTEXT, TARGET_SIZE
+SERVER_HEAD = struct.Struct('<HBBB')  # SIG, SENDER_CONTEXT, TARGET_CONTEXT, SENDER_SIZE
+SERVER_CONTEXTS = struct.Struct('<HBB')  # SIG, SENDER_CONTEXT, TARGET_CONTEXT
+NAME_SIZE = struct.Struct('<B')
+MAX_NAME = 255  # bytes of a utf-8 name, it has one size byte
+CONTENT_SIZE = struct.Struct('<H')
+MAX_CONTENT_V1 = 65535
+
+FRAME2_HEAD = struct.Struct('<HI')  # SIG2, SIZE of the rest of the frame
+CLIENT2_HEAD = struct.Struct('<HIBBB')  # SIG2, SIZE, FLAGS, TARGET_CONTEXT, TARGET_SIZE
+SERVER2_HEAD = struct.Struct('<HIBBBQ')  # SIG2, SIZE, FLAGS, SENDER_CONTEXT, TARGET_CONTEXT, TIMESTAMP
+FLAGS_OFFSET = 6  # in both v2 heads
+FLAG_REPLAY = 1  # the frame comes from the message history
+PROTOCOL_VERSION = 2  # newest version this code speaks
+MAX_FRAME_SIZE = 256 * 1024  # v2 client frames claiming more are refused before any of it is buffered
+
+ClientFrame = Tuple[int, str, str]  # target_context, target, content
+ServerFrame = Tuple[int, int, str, str, str]  # sender_context, target_context, sender, target, content
+# sender_context, target_context, sender, target, content, message_id, timestamp (us), flags
+ServerFrameV2 = Tuple[int, int, str, str, str, int, int, int]
+
+
+class FrameError(ConnectionError):
+    """
+    the peer sent a frame that can't be read, the connection is dropped like a closed one
+    """
+
+
+def encode_varint(value: int) -> bytes:
+    """
+    unsigned LEB128, 7 bits per byte, low bits first
+    """
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(buffer, offset: int) -> Tuple[int, int]:
+    """
+    returns (value, offset after it), the varint must be complete
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_name(name: str) -> bytes:
+    """
+    SIZE(1) + utf-8 name, as it appears in frames
+    """
+    name_bytes = name.encode('utf-8')
+    return NAME_SIZE.pack(len(name_bytes)) + name_bytes
+
+
+def encode_content(content: Union[str, bytes]) -> bytes:
+    """
+    MESSAGE_SIZE(2) + utf-8 message, as it appears in v1 frames.
+    longer messages are cut to what the size can hold, a cut multi byte character is dropped
+    """
+    content_bytes = content.encode('utf-8') if isinstance(content, str) else content
+    if len(content_bytes) > MAX_CONTENT_V1:
+        content_bytes = content_bytes[:MAX_CONTENT_V1].decode('utf-8', 'ignore').encode('utf-8')
+    return CONTENT_SIZE.pack(len(content_bytes)) + content_bytes
+
+
+def encode_client_frame(target_context: int, target: str, content: str) -> bytes:
+    target_bytes = target.encode('utf-8')
+    content_bytes = content.encode('utf-8')
+    # one join of packed headers beats pack_into a preallocated bytearray for frames this small
+    return b''.join((CLIENT_HEAD.pack(SIG, target_context, len(target_bytes)), target_bytes,
+                     CONTENT_SIZE.pack(len(content_bytes)), content_bytes))
+
+
+def encode_client_frame_v2(target_context: int, target: str, content: str, flags=0) -> bytes:
+    target_bytes = target.encode('utf-8')
+    content_bytes = content.encode('utf-8')
+    size = CLIENT2_HEAD.size - FRAME2_HEAD.size + len(target_bytes) + len(content_bytes)
+    return b''.join((CLIENT2_HEAD.pack(SIG2, size, flags, target_context, len(target_bytes)), target_bytes,
+                     content_bytes))
+
+
+def server_head(sender_context: int, target_context: int) -> bytes:
+    """
+    SIG and contexts of a server to client frame, the encoded sender name follows
+    """
+    return SERVER_CONTEXTS.pack(SIG, sender_context, target_context)
+
+
+def encode_server_frame(sender_context: int, target_context: int, sender_field: bytes, target_field: bytes,
+                        content_field: bytes) -> bytes:
+    """
+    join a server to client frame from already encoded fields, see encode_name and encode_content
+    """
+    return b''.join((SERVER_CONTEXTS.pack(SIG, sender_context, target_context), sender_field, target_field,
+                     content_field))
+
+
+def encode_server_frame_v2(sender_context: int, target_context: int, sender_field: bytes, target_field: bytes,
+                           content: bytes, message_id: int, timestamp: int, flags=0) -> bytes:
+    """
+    join a v2 server to client frame, the name fields are the same as in v1 and content is the raw utf-8
+    """
+    message_id_field = encode_varint(message_id)
+    size = (SERVER2_HEAD.size - FRAME2_HEAD.size + len(message_id_field) + len(sender_field) + len(target_field) +
+            len(content))
+    return b''.join((SERVER2_HEAD.pack(SIG2, size, flags, sender_context, target_context, timestamp),
+                     message_id_field, sender_field, target_field, content))
+
+
+def with_flags(frame: bytes, flags: int) -> bytes:
+    """
+    copy of a v2 frame with flags added
+    """
+    copy = bytearray(frame)
+    copy[FLAGS_OFFSET] |= flags
+    return bytes(copy)
+
+
+def frame2_size(buffer, offset: int, min_size: int, max_size: Optional[int]) -> int:
+    """
+    whole size of the v2 frame at offset, SIG2 and SIZE must be buffered
+    """
+    size = FRAME2_HEAD.size + FRAME2_HEAD.unpack_from(buffer, offset)[1]
+    if max_size is not None and size > max_size:
+        raise FrameError(f"frame of {size} bytes is over the {max_size} bytes limit")
+    if size < min_size:
+        raise FrameError(f"frame of {size} bytes is shorter than its head")
+    return size
+
+
+def decode_client_frame_v2(buffer, offset=0) -> Union[Tuple[ClientFrame, int], int]:
+    available = len(buffer) - offset
+    if available < FRAME2_HEAD.size:
+        return FRAME2_HEAD.size
+    end = frame2_size(buffer, offset, CLIENT2_HEAD.size, MAX_FRAME_SIZE)
+    if available < end:
+        return end
+    _, _, flags, target_context, target_size = CLIENT2_HEAD.unpack_from(buffer, offset)
+    content_at = CLIENT2_HEAD.size + target_size
+    if content_at > end:
+        raise FrameError("target runs past the end of the frame")
+    return (
+        target_context,
+        str(buffer[offset + CLIENT2_HEAD.size:offset + content_at], 'utf-8'),
+        str(buffer[offset + content_at:offset + end], 'utf-8'),
+    ), end
+
+
+def decode_client_frame(buffer, offset=0) -> Union[Tuple[ClientFrame, int], int]:
+    """
+    decode the client to server frame at offset,
+    returns (frame, frame size) or the number of bytes the frame needs when it is incomplete
+    """
+    available = len(buffer) - offset
+    if available < CLIENT_HEAD.size:
+        return CLIENT_HEAD.size
+    sig, target_context, target_size = CLIENT_HEAD.unpack_from(buffer, offset)
+    if sig == SIG2:
+        return decode_client_frame_v2(buffer, offset)
+    if sig != SIG:
+        raise FrameError(f"Invalid message signature {bytes(buffer[offset:offset + 2])}")
+    content_at = CLIENT_HEAD.size + target_size
+    if available < content_at + CONTENT_SIZE.size:
+        return content_at + CONTENT_SIZE.size
+    end = content_at + CONTENT_SIZE.size + CONTENT_SIZE.unpack_from(buffer, offset + content_at)[0]
+    if available < end:
+        return end
+    return (
+        target_context,
+        str(buffer[offset + CLIENT_HEAD.size:offset + content_at], 'utf-8'),
+        str(buffer[offset + content_at + CONTENT_SIZE.size:offset + end], 'utf-8'),
+    ), end
+
+
+def decode_client_frames(buffer) -> Tuple[List[ClientFrame], int, int]:
+    """
+    decode every complete client to server frame in buffer,
+    returns (frames, bytes consumed, bytes needed by the incomplete frame that follows)
+    """
+    frames = []
+    offset = 0
+    while True:
+        decoded = decode_client_frame(buffer, offset)
+        if type(decoded) is int:
+            return frames, offset, decoded
+        frames.append(decoded[0])
+        offset += decoded[1]
+
+
+def decode_server_frame_v2(buffer, offset=0) -> Union[Tuple[ServerFrameV2, int], int]:
+    """
+    decode the server to client frame at offset with the v2 fields, v1 frames have message id, timestamp and flags 0.
+    returns (frame, frame size) or the number of bytes the frame needs when it is incomplete
+    """
+    available = len(buffer) - offset
+    if available < SERVER2_HEAD.size:
+        if available >= 2 and buffer[offset:offset + 2] == SIG_BYTES:
+            return _with_v2_fields(decode_server_frame(buffer, offset))
+        return SERVER2_HEAD.size
+    if buffer[offset:offset + 2] == SIG_BYTES:
+        return _with_v2_fields(decode_server_frame(buffer, offset))
+    end = frame2_size(buffer, offset, SERVER2_HEAD.size + 3, None)  # the server is trusted
+    if available < end:
+        return end
+    _, _, flags, sender_context, target_context, timestamp = SERVER2_HEAD.unpack_from(buffer, offset)
+    message_id, sender_at = decode_varint(buffer, offset + SERVER2_HEAD.size)
+    target_at = sender_at + 1 + buffer[sender_at]
+    content_at = target_at + 1 + buffer[target_at]
+    return (
+        sender_context,
+        target_context,
+        str(buffer[sender_at + 1:target_at], 'utf-8'),
+        str(buffer[target_at + 1:content_at], 'utf-8'),
+        str(buffer[content_at:offset + end], 'utf-8'),
+        message_id,
+        timestamp,
+        flags,
+    ), end
+
+
+def _with_v2_fields(decoded):
+    if type(decoded) is int:
+        return decoded
+    return decoded[0] + (0, 0, 0), decoded[1]
+
+
+def decode_server_frame(buffer, offset=0) -> Union[Tuple[ServerFrame, int], int]:
+    """
+    decode the server to client frame at offset,
+    returns (frame, frame size) or the number of bytes the frame needs when it is incomplete
+    """
+    available = len(buffer) - offset
+    if available < SERVER_HEAD.size:
+        return SERVER_HEAD.size
+    sig, sender_context, target_context, sender_size = SERVER_HEAD.unpack_from(buffer, offset)
+    if sig == SIG2:
+        decoded = decode_server_frame_v2(buffer, offset)
+        return decoded if type(decoded) is int else (decoded[0][:5], decoded[1])
+    if sig != SIG:
+        raise FrameError(f"Invalid message signature {bytes(buffer[offset:offset + 2])}")
+    target_at = SERVER_HEAD.size + sender_size
+    if available < target_at + NAME_SIZE.size:
+        return target_at + NAME_SIZE.size
+    content_at = target_at + NAME_SIZE.size + buffer[offset + target_at]
+    if available < content_at + CONTENT_SIZE.size:
+        return content_at + CONTENT_SIZE.size
+    end = content_at + CONTENT_SIZE.size + CONTENT_SIZE.unpack_from(buffer, offset + content_at)[0]
+    if available < end:
+        return end
+    return (
+        sender_context,
+        target_context,
+        str(buffer[offset + SERVER_HEAD.size:offset + target_at], 'utf-8'),
+        str(buffer[offset + target_at + NAME_SIZE.size:offset + content_at], 'utf-8'),
+        str(buffer[offset + content_at + CONTENT_SIZE.size:offset + end], 'utf-8'),
+    ), end
+
+
+def decode_server_frames(buffer) -> Tuple[List[ServerFrame], int, int]:
+    """
+    decode every complete server to client frame in buffer,
+    returns (frames, bytes consumed, bytes needed by the incomplete frame that follows)
+    """
+    frames = []
+    offset = 0
+    while True:
+        decoded = decode_server_frame(buffer, offset)
+        if type(decoded) is int:
+            return frames, offset, decoded
+        frames.append(decoded[0])
+        offset += decoded[1]
+
+
+def to_version(frame, version: int):
+    """
+    a complete server to client frame in the given protocol version, frames already in it are returned as they are
+    """
+    is_v2 = frame[:2] == SIG2_BYTES
+    if is_v2 == (version >= 2):
+        return frame
+    if is_v2:
+        (sender_context, target_context, sender, target, content, _, _, _), _ = decode_server_frame_v2(frame)
+        return encode_server_frame(sender_context, target_context, encode_name(sender), encode_name(target),
+                                   encode_content(content.encode('utf-8')))
+    (sender_context, target_context, sender, target, content), _ = decode_server_frame(frame)
+    return encode_server_frame_v2(sender_context, target_context, encode_name(sender), encode_name(target),
+                                  content.encode('utf-8'), 0, 0, FLAG_REPLAY)
+
+
+class Frame:
+    """
+    a server to client frame shared by its receivers, encoded for a protocol version the first time a receiver
+    of that version is written to
+    """
+    __slots__ = ('sender_context', 'target_context', 'sender_field', 'target_field', 'content', 'message_id',
+                 'timestamp', 'flags', '_v1', '_v2')
+
+    def __init__(self, sender_context: int, target_context: int, sender_field: bytes, target_field: bytes,
+                 content: bytes, message_id=0, timestamp: Optional[int] = None, flags=0):
+        self.sender_context = sender_context
+        self.target_context = target_context
+        self.sender_field = sender_field
+        self.target_field = target_field
+        self.content = content  # utf-8
+        self.message_id = message_id
+        self.timestamp = timestamp if timestamp is not None else time.time_ns() // 1000  # us
+        self.flags = flags
+        self._v1: Optional[bytes] = None
+        self._v2: Optional[bytes] = None
+
+    def encoded(self, version: int) -> bytes:
+        # two writers may encode at once, both get the same bytes
+        if version >= 2:
+            if self._v2 is None:
+                self._v2 = encode_server_frame_v2(self.sender_context, self.target_context, self.sender_field,
+                                                  self.target_field, self.content, self.message_id, self.timestamp,
+                                                  self.flags)
+            return self._v2
+        if self._v1 is None:
+            self._v1 = encode_server_frame(self.sender_context, self.target_context, self.sender_field,
+                                           self.target_field, encode_content(self.content))
+        return self._v1
+
+    def __len__(self):
+        # queue accounting, close to the size in either version
+        return SERVER2_HEAD.size + len(self.sender_field) + len(self.target_field) + len(self.content) + 4
+
+    @staticmethod
+    def from_v2(data: bytes) -> 'Frame':
+        (sender_context, target_context, sender, target, content, message_id, timestamp, flags), _ = \
+            decode_server_frame_v2(data)
+        frame = Frame(sender_context, target_context, encode_name(sender), encode_name(target),
+                      content.encode('utf-8'), message_id, timestamp, flags)
+        frame._v2 = bytes(data)
+        return frame
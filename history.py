@@ -0,0 +1,295 @@
+"""
+persistent message history, one append-only log per group.
+whispers are not persisted, the last WHISPER_BYTES of each pair are kept in memory while both its users stay
+connected. the next user to take one of the names must not read them, so they are dropped when either name is
+released or taken again, and a restart starts without them.
+a log is a directory of numbered segments, each segment is a preallocated memory mapped file of server to client
+frames exactly as they were sent, filled from the front, and the end offset of every frame, filled from the back.
+an append is two copies into the map and no system call.
+replayed frames are views of the mapped segments, they are queued for sending without being copied
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+INDEX_ITEM = struct.Struct('<Q')  # end offset of one frame, the first item is the last 8 bytes of the segment
+MIN_SEGMENT_BYTES = 128 * 1024  # room for the biggest frame (255 byte names, 65535 byte message)
+MAX_FILE_NAME = 255
+WHISPER_BYTES = 128 * 1024  # frames kept per whisper pair, room for the biggest frame
+
+
+class Segment:
+    """
+    one mapped file of frames, appends fill it until the next frame and its index item do not fit
+    """
+
+    def __init__(self, path: str, number: int, capacity: int):
+        self.number = number
+        self.log_path = os.path.join(path, f'{number:08d}.log')
+        with open(self.log_path, 'a+b') as file:
+            if os.path.getsize(self.log_path) < capacity:
+                file.truncate(capacity)
+            # the map keeps its own handle to the file
+            self.map = mmap.mmap(file.fileno(), 0)
+        self.view = memoryview(self.map)
+        self.capacity = len(self.map)
+        self.ends = array('Q')
+        # the items end at the first that is not past the one before, a new file is zeros and a crash may have
+        # left a frame without its item
+        while True:
+            item_at = self.capacity - (len(self.ends) + 1) * INDEX_ITEM.size
+            end, = INDEX_ITEM.unpack_from(self.map, item_at) if item_at >= 0 else (0,)
+            if end <= self.end or end > item_at:
+                break
+            self.ends.append(end)
+
+    @property
+    def end(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    def append(self, frame: bytes) -> bool:
+        """
+        returns False when the frame does not fit in this segment
+        """
+        start = self.end
+        end = start + len(frame)
+        item_at = self.capacity - (len(self.ends) + 1) * INDEX_ITEM.size
+        if end > item_at:
+            return False
+        self.map[start:end] = frame
+        INDEX_ITEM.pack_into(self.map, item_at, end)  # after the frame, an item always points at a whole frame
+        self.ends.append(end)
+        return True
+
+    def frame(self, position: int) -> memoryview:
+        return self.view[self.ends[position - 1] if position else 0:self.ends[position]]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # replayed views are still queued, the map is closed when the last one is released
+
+    def remove(self):
+        self.close()
+        remove_files(self.log_path)
+
+
+def remove_files(*paths: str):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # still mapped on windows, it goes with the next clear
+
+
+def file_name(name: str) -> str:
+    """
+    name if it fits the 255 bytes most file systems allow, otherwise its digest.
+    log names are hex or hold a '+', they never look like a digest
+    """
+    return name if len(name) <= MAX_FILE_NAME else 'sha256-' + hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+
+class MessageLog:
+    """
+    the segments of one group or whisper pair, appends and reads of different logs never wait on each other.
+    the files are opened by the first use under the log's own lock, after closing previous, the log of the same
+    path this one replaces
+    """
+
+    def __init__(self, path: str, segment_bytes: int, max_segments: int, previous: Optional['MessageLog'] = None):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.previous = previous
+        self.lock = threading.Lock()
+        self.opened = False
+        self.closed = False
+        self.segments: Deque[Segment] = deque()
+
+    def _open(self):
+        if self.opened:
+            return
+        if self.previous is not None:
+            self.previous.close()  # the files never have two writers
+            self.previous = None
+        os.makedirs(self.path, exist_ok=True)
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.path)
+                         if name.endswith('.log') and name[:-4].isdigit())
+        for number in numbers[:-self.max_segments]:
+            remove_files(os.path.join(self.path, f'{number:08d}.log'))
+        self.segments.extend(Segment(self.path, number, self.segment_bytes)
+                             for number in numbers[-self.max_segments:])
+        if not self.segments:
+            self.segments.append(Segment(self.path, 0, self.segment_bytes))
+        self.opened = True
+
+    def append(self, frame: bytes) -> bool:
+        """
+        returns False if the log was closed meanwhile
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            self._open()
+            if not self.segments[-1].append(frame):
+                self.segments.append(Segment(self.path, self.segments[-1].number + 1, self.segment_bytes))
+                if len(self.segments) > self.max_segments:
+                    self.segments.popleft().remove()
+                self.segments[-1].append(frame)
+            return True
+
+    def last(self, count: int, max_bytes: int) -> Optional[List[memoryview]]:
+        """
+        views of up to the last count frames, oldest first, together at most max_bytes long.
+        None if the log was closed meanwhile
+        """
+        frames = []
+        size = 0
+        # taken under the lock, a view outlives the close of its segment but can't be taken after it
+        with self.lock:
+            if self.closed:
+                return None
+            self._open()
+            for segment in reversed(self.segments):
+                for position in range(len(segment.ends) - 1, -1, -1):
+                    frame = segment.frame(position)
+                    size += len(frame)
+                    if len(frames) >= count or size > max_bytes:
+                        frames.reverse()
+                        return frames
+                    frames.append(frame)
+        frames.reverse()
+        return frames
+
+    def clear(self):
+        with self.lock:
+            self._open()
+            while self.segments:
+                self.segments.popleft().remove()
+            self.segments.append(Segment(self.path, 0, self.segment_bytes))
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for segment in self.segments:
+                segment.close()
+            if self.previous is not None:
+                self.previous.close()
+
+
+class History:
+    """
+    the logs under one directory, at most max_open logs stay mapped, the least recently used are closed.
+    whispers are kept in memory beside them
+    """
+
+    def __init__(self, directory: str, segment_bytes=1024 * 1024, max_segments=8, max_open=256):
+        self.directory = directory
+        self.segment_bytes = max(segment_bytes, MIN_SEGMENT_BYTES)
+        self.max_segments = max(1, max_segments)
+        self.max_open = max(1, max_open)
+        self.logs: 'OrderedDict[str, MessageLog]' = OrderedDict()
+        self.closing: Dict[str, MessageLog] = {}  # evicted logs until they are closed
+        self.whispers: Dict[Tuple[str, str], Deque[bytes]] = {}
+        self.whisper_bytes: Dict[Tuple[str, str], int] = {}
+        self.partners: Dict[str, Set[str]] = {}  # names each name has whispers with
+        self.lock = threading.Lock()
+
+    def group_path(self, group_name: str) -> str:
+        # group names may hold any character, hex keeps them valid file names
+        return os.path.join(self.directory, 'groups', file_name(group_name.encode('utf-8').hex()))
+
+    def log(self, path: str) -> MessageLog:
+        """
+        the log of path, opening and closing files happens outside the lock of all logs
+        """
+        evicted = None
+        with self.lock:
+            log = self.logs.get(path)
+            if log is not None:
+                self.logs.move_to_end(path)
+                return log
+            if len(self.logs) >= self.max_open:
+                evicted = self.logs.popitem(last=False)[1]
+                self.closing[evicted.path] = evicted
+            log = MessageLog(path, self.segment_bytes, self.max_segments, previous=self.closing.pop(path, None))
+            self.logs[path] = log
+        if evicted is not None:
+            evicted.close()
+            with self.lock:
+                if self.closing.get(evicted.path) is evicted:
+                    del self.closing[evicted.path]
+        return log
+
+    def append(self, path: str, frame: bytes):
+        while not self.log(path).append(frame):
+            pass  # closed by eviction between the lookup and the append, open it again
+
+    def last(self, path: str, count: int, max_bytes: int) -> List[memoryview]:
+        if not os.path.isdir(path):
+            return []
+        while True:
+            frames = self.log(path).last(count, max_bytes)
+            if frames is not None:
+                return frames
+            # closed by eviction between the lookup and the read, open it again
+
+    def append_whisper(self, user_name: str, other_name: str, frame: bytes):
+        pair = tuple(sorted((user_name, other_name)))
+        with self.lock:
+            frames = self.whispers.setdefault(pair, deque())
+            frames.append(frame)
+            size = self.whisper_bytes.get(pair, 0) + len(frame)
+            while size > WHISPER_BYTES:
+                size -= len(frames.popleft())
+            self.whisper_bytes[pair] = size
+            self.partners.setdefault(user_name, set()).add(other_name)
+            self.partners.setdefault(other_name, set()).add(user_name)
+
+    def last_whispers(self, user_name: str, other_name: str, count: int, max_bytes: int) -> List[bytes]:
+        with self.lock:
+            frames = self.whispers.get(tuple(sorted((user_name, other_name))), ())
+            last = []
+            for frame in reversed(frames):
+                if len(last) >= count or max_bytes < len(frame):
+                    break
+                max_bytes -= len(frame)
+                last.append(frame)
+        last.reverse()
+        return last
+
+    def forget_whispers(self, name: str):
+        """
+        drop every whisper of name
+        """
+        with self.lock:
+            for other in self.partners.pop(name, set()):
+                pair = tuple(sorted((name, other)))
+                self.whispers.pop(pair, None)
+                self.whisper_bytes.pop(pair, None)
+                partners = self.partners.get(other)
+                if partners is not None:
+                    partners.discard(name)
+                    if not partners:
+                        del self.partners[other]
+
+    def clear(self, path: str):
+        if os.path.isdir(path):
+            self.log(path).clear()
+
+    def close(self):
+        with self.lock:
+            logs = list(self.logs.values())
+            self.logs.clear()
+        for log in logs:
+            log.close()
@@ -1,5 +1,15 @@
+import itertools
+import logging
+import os
+import socket as sockets
+import struct
+import sys
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from threading import Thread
+from typing import List, Tuple
 
 release_joins = {'value': False}
 
@@ -18,8 +28,128 @@ def soft_join(t: Thread, break_event: threading.Event = None):
             release_joins['value'] = True
 
 
-def thread_print(msg):
+class CountingExecutor(ThreadPoolExecutor):
     """
-    print the thread id along with the message
+    thread pool that counts the tasks submitted and not finished yet, for metrics
     """
-    print(f'{threading.current_thread().name}-{str(threading.current_thread().ident)}: {msg}', flush=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+
+    def submit(self, *args, **kwargs) -> Future:
+        with self._pending_lock:
+            self.pending += 1
+        try:
+            future = super().submit(*args, **kwargs)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _):
+        with self._pending_lock:
+            self.pending -= 1
+
+
+TRACE = 5  # per message reports, below DEBUG
+logging.addLevelName(TRACE, 'TRACE')
+log = logging.getLogger('chat')
+
+
+class SampleFilter(logging.Filter):
+    """
+    lets one of every "every" trace records through, records of other levels always pass
+    """
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self.counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > TRACE or next(self.counter) % self.every == 0
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    queues the record as is, message formatting happens on the writer thread instead of the caller's
+    """
+
+    def prepare(self, record: logging.LogRecord):
+        return record
+
+
+def setup_logging(level: str = 'info', trace_sample: int = 1) -> QueueListener:
+    """
+    send the 'chat' logger through a queue to a background writer thread, callers never wait on stdout.
+    returns the listener, stop it to flush the queue on exit
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(threadName)s: %(message)s'))
+    records = SimpleQueue()
+    listener = QueueListener(records, handler)
+    listener.start()
+    queue_handler = DeferredQueueHandler(records)
+    queue_handler.addFilter(SampleFilter(trace_sample))
+    log.addHandler(queue_handler)
+    log.setLevel(TRACE if level.lower() == 'trace' else level.upper())
+    log.propagate = False
+    return listener
+
+
+def set_send_timeout(socket: sockets.socket, seconds: float):
+    """
+    make blocking sends on socket fail after seconds without progress, receives are not affected
+    """
+    if hasattr(sockets, 'SO_SNDTIMEO'):
+        if os.name == 'nt':
+            value = struct.pack('L', int(seconds * 1000))
+        else:
+            value = struct.pack('ll', int(seconds), int((seconds % 1) * 1_000_000))
+        socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_SNDTIMEO, value)
+
+
+# most buffers one sendmsg call takes, posix guarantees at least 16
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else 16
+
+
+def send_buffers(socket: sockets.socket, buffers: List[bytes]) -> int:
+    """
+    write every buffer in order with as few sendmsg calls as possible, returns the number of calls.
+    a partial write resumes inside the buffer where it stopped
+    """
+    if not hasattr(socket, 'sendmsg'):  # windows
+        socket.sendall(b''.join(buffers))
+        return 1
+    return send_buffers_until(socket, buffers, 0)[0]
+
+
+def send_buffers_nowait(socket: sockets.socket, buffers: List[bytes]) -> Tuple[int, List[bytes]]:
+    """
+    like send_buffers but stops where the socket would block, returns the number of calls and what was not sent.
+    the socket stays blocking for its reader, only these sends don't wait
+    """
+    if not hasattr(socket, 'sendmsg') or not hasattr(sockets, 'MSG_DONTWAIT'):  # windows, blocks until sent
+        return send_buffers(socket, buffers), []
+    return send_buffers_until(socket, buffers, sockets.MSG_DONTWAIT)
+
+
+def send_buffers_until(socket: sockets.socket, buffers: List[bytes], flags: int) -> Tuple[int, List[bytes]]:
+    pending = list(buffers)
+    start = 0
+    calls = 0
+    while start < len(pending):
+        try:
+            sent = socket.sendmsg(pending[start:start + IOV_MAX], [], flags)
+        except BlockingIOError:
+            return calls, pending[start:]
+        calls += 1
+        while start < len(pending) and sent >= len(pending[start]):
+            sent -= len(pending[start])
+            start += 1
+        if sent:
+            pending[start] = memoryview(pending[start])[sent:]
+    return calls, []
@@ -0,0 +1,137 @@
+"""
+model of the terminal input line: the text is a gap buffer, so typing, deleting and moving the cursor by one
+cell cost the same on a pasted page as on an empty line, and the input history is a bounded deque searched by
+the prefix typed before browsing
+"""
+from collections import deque
+from typing import Deque, List, Optional
+
+
+class GapBuffer:
+    """
+    characters of the line with an empty gap at the cursor, edits at the cursor only move the gap bounds.
+    moving the cursor by n cells moves n characters across the gap
+    """
+
+    def __init__(self, text='', capacity=64):
+        self.cells: List[str] = [''] * max(capacity, len(text) * 2)
+        self.gap_start = 0  # the cursor
+        self.gap_end = len(self.cells)
+        self._text: Optional[str] = None  # cached text(), dropped by every edit
+        self.insert(text)
+
+    @property
+    def cursor(self) -> int:
+        return self.gap_start
+
+    def __len__(self):
+        return len(self.cells) - (self.gap_end - self.gap_start)
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = ''.join(self.cells[:self.gap_start]) + ''.join(self.cells[self.gap_end:])
+        return self._text
+
+    def insert(self, text: str):
+        if not text:
+            return
+        if len(text) > self.gap_end - self.gap_start:
+            self._grow(len(text))
+        self.cells[self.gap_start:self.gap_start + len(text)] = text
+        self.gap_start += len(text)
+        self._text = None
+
+    def delete_before(self) -> bool:
+        """
+        backspace, returns False at the start of the line
+        """
+        if self.gap_start == 0:
+            return False
+        self.gap_start -= 1
+        self._text = None
+        return True
+
+    def delete_after(self) -> bool:
+        """
+        delete, returns False at the end of the line
+        """
+        if self.gap_end == len(self.cells):
+            return False
+        self.gap_end += 1
+        self._text = None
+        return True
+
+    def move_to(self, position: int):
+        position = max(0, min(position, len(self)))
+        if position < self.gap_start:
+            count = self.gap_start - position
+            self.cells[self.gap_end - count:self.gap_end] = self.cells[position:self.gap_start]
+            self.gap_start -= count
+            self.gap_end -= count
+        elif position > self.gap_start:
+            count = position - self.gap_start
+            self.cells[self.gap_start:position] = self.cells[self.gap_end:self.gap_end + count]
+            self.gap_start += count
+            self.gap_end += count
+
+    def set(self, text: str):
+        """
+        replace the whole line, the cursor goes to its end
+        """
+        self.gap_start = 0
+        self.gap_end = len(self.cells)
+        self._text = None
+        self.insert(text)
+
+    def _grow(self, needed: int):
+        # doubling keeps a long paste at amortized O(1) per character
+        extra = max(needed, len(self.cells))
+        self.cells[self.gap_end:self.gap_end] = [''] * extra
+        self.gap_end += extra
+
+
+class InputHistory:
+    """
+    the last max_lines lines, oldest first. browsing goes back through the lines that start with what was typed
+    before the first step back, and forward past the newest one returns to that text
+    """
+
+    def __init__(self, max_lines=1000):
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+        self.position = 0  # index of the line shown while browsing, len(lines) when not browsing
+        self.prefix: Optional[str] = None  # the typed text, set while browsing
+
+    def add(self, line: str):
+        if line and (not self.lines or self.lines[-1] != line):
+            self.lines.append(line)  # the oldest line drops out in O(1)
+        self.reset()
+
+    def reset(self):
+        self.position = len(self.lines)
+        self.prefix = None
+
+    def older(self, typed: str) -> Optional[str]:
+        """
+        the previous line starting with the prefix, None if there is none
+        """
+        if self.prefix is None:
+            self.prefix = typed
+        for position in range(self.position - 1, -1, -1):
+            if self.lines[position].startswith(self.prefix):
+                self.position = position
+                return self.lines[position]
+        return None
+
+    def newer(self) -> Optional[str]:
+        """
+        the next line starting with the prefix, the prefix itself after the newest, None when not browsing
+        """
+        if self.prefix is None:
+            return None
+        for position in range(self.position + 1, len(self.lines)):
+            if self.lines[position].startswith(self.prefix):
+                self.position = position
+                return self.lines[position]
+        typed = self.prefix
+        self.reset()
+        return typed
@@ -0,0 +1,206 @@
+"""
+counters, gauges and histograms of the server, rendered in the prometheus text format.
+updates take one uncontended lock so they can stay on in production, gauges are read only when scraped.
+serve_http exposes every metric on http://host:port/metrics
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+Sample = Tuple[str, Dict[str, str], float]  # name suffix, labels, value
+
+_metrics: List['Metric'] = []
+_metrics_lock = threading.Lock()
+
+
+class Metric:
+    """
+    one metric, or with label_name set a family of metrics created by labels()
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, doc: str, label_name: Optional[str] = None, register=True):
+        self.name = name
+        self.doc = doc
+        self.label_name = label_name
+        self.children: Dict[str, 'Metric'] = {}
+        self._lock = threading.Lock()
+        if register:
+            with _metrics_lock:
+                _metrics.append(self)
+
+    def labels(self, value: str):
+        child = self.children.get(value)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(value, self._child())
+        return child
+
+    def _child(self) -> 'Metric':
+        raise NotImplementedError
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+    def family_samples(self) -> Iterable[Sample]:
+        if self.label_name is None:
+            yield from self.samples()
+            return
+        for value, child in list(self.children.items()):
+            for suffix, labels, sample in child.samples():
+                yield suffix, dict(labels, **{self.label_name: value}), sample
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, doc: str, label_name: Optional[str] = None, register=True):
+        super().__init__(name, doc, label_name, register)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _child(self):
+        return Counter(self.name, self.doc, register=False)
+
+    def samples(self):
+        yield '', {}, self.value
+
+
+class Gauge(Metric):
+    """
+    value read from a function at scrape time, a dict result is one sample per label value
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, doc: str, read: Callable[[], Union[float, Dict[str, float]]],
+                 label_name: Optional[str] = None, register=True):
+        super().__init__(name, doc, label_name, register)
+        self.read = read
+
+    def family_samples(self):
+        value = self.read()
+        if isinstance(value, dict):
+            for label, sample in value.items():
+                yield '', {self.label_name: label}, sample
+        else:
+            yield '', {}, value
+
+
+class CallbackCounter(Gauge):
+    """
+    counter kept elsewhere and read at scrape time
+    """
+    type = 'counter'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, doc: str, buckets: Tuple[float, ...], label_name: Optional[str] = None,
+                 register=True):
+        super().__init__(name, doc, label_name, register)
+        self.buckets = buckets  # upper bounds, ascending
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def _child(self):
+        return Histogram(self.name, self.doc, self.buckets, register=False)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield '_bucket', {'le': repr(float(bound))}, cumulative
+        cumulative += counts[-1]
+        yield '_bucket', {'le': '+Inf'}, cumulative
+        yield '_sum', {}, total
+        yield '_count', {}, cumulative
+
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+frames_in = Counter('chat_frames_in_total', 'frames received from clients')
+frames_out = Counter('chat_frames_out_total', 'frames written to clients')
+bytes_in = Counter('chat_bytes_in_total', 'bytes received from clients')
+bytes_out = Counter('chat_bytes_out_total', 'bytes written to clients')
+compression_in = Counter('chat_compression_in_bytes_total', 'frame bytes written to connections with compression')
+compression_out = Counter('chat_compression_out_bytes_total', 'wire bytes those frames took after compression')
+send_calls = Counter('chat_send_calls_total', 'socket write calls for clients, one writes every frame of a batch')
+fanout = Histogram('chat_fanout_size', 'receivers of one group or server wide message', SIZE_BUCKETS)
+lock_wait = Histogram('chat_lock_wait_seconds', 'time spent waiting for a contended state lock', LATENCY_BUCKETS,
+                      label_name='lock')
+connections_refused = Counter('chat_connections_refused_total', 'connections closed by admission control',
+                              label_name='reason')
+idle_disconnects = Counter('chat_idle_disconnects_total', 'connections dropped for not answering a ping')
+command_latency = Histogram('chat_command_seconds', 'time to handle one client message', LATENCY_BUCKETS,
+                            label_name='command')
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render() -> str:
+    """
+    every registered metric in the prometheus text exposition format
+    """
+    lines = []
+    with _metrics_lock:
+        metrics = list(_metrics)
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.doc}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for suffix, labels, value in metric.family_samples():
+            if labels:
+                label_text = ','.join(f'{key}="{escape(str(label))}"' for key, label in labels.items())
+                lines.append(f'{metric.name}{suffix}{{{label_text}}} {format_value(value)}')
+            else:
+                lines.append(f'{metric.name}{suffix} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def escape(label: str) -> str:
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # scrapes are not worth a log line
+
+
+def serve_http(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    serve /metrics from a daemon thread, returns the server so it can be shut down
+    """
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    thread = threading.Thread(target=http_server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return http_server
@@ -0,0 +1,128 @@
+"""
+token buckets, the admission of new connections and the message rate limits of users and groups.
+a bucket refills from the monotonic clock when it is used, so a limit costs a few operations per check and
+needs no timer
+"""
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+
+class TokenBucket:
+    """
+    rate tokens per second up to burst, a bucket starts full
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, cost=1.0, now: Optional[float] = None) -> bool:
+        """
+        False, taking nothing, when there are fewer than cost tokens
+        """
+        if self.refill(time.monotonic() if now is None else now) < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class KeyedBuckets:
+    """
+    a bucket per key, created full on first use. buckets that refilled completely are the same as new ones,
+    they are dropped whenever the table doubles in size so keys seen once don't pile up
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.prune_at = 1024
+
+    def take(self, key: str, cost=1.0, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.prune_at:
+                self.prune(now)
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+        return bucket.take(cost, now)
+
+    def prune(self, now: float):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket.refill(now) < self.burst}
+        self.prune_at = max(1024, len(self.buckets) * 2)
+
+
+class Admission:
+    """
+    decides on each new connection before anything is read from it: at most max_connections open at once and,
+    with ip_rate set, ip_rate new connections per second from one address after a burst of ip_burst.
+    the accept path takes only this object's lock
+    """
+    FULL = 'full'
+    THROTTLED = 'throttled'
+
+    def __init__(self, max_connections: int, ip_rate=0.0, ip_burst=0.0):
+        self.max_connections = max_connections
+        self.per_ip = KeyedBuckets(ip_rate, max(ip_burst, 1.0)) if ip_rate > 0 else None
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def admit(self, ip: str) -> Optional[str]:
+        """
+        None when the connection is admitted, release it once it closes. otherwise why it was refused
+        """
+        with self._lock:
+            if self.connections >= self.max_connections:
+                return Admission.FULL
+            if self.per_ip is not None and not self.per_ip.take(ip):
+                return Admission.THROTTLED
+            self.connections += 1
+            return None
+
+    def release(self):
+        with self._lock:
+            self.connections -= 1
+
+
+class RateLimit:
+    """
+    messages per second and bytes per second, each with its own burst. a message passes only when both buckets
+    have room and then takes from both, one lock makes it safe to share between the handlers of a group
+    """
+
+    def __init__(self, message_rate: float, message_burst: float, byte_rate: float, byte_burst: float):
+        self.messages = TokenBucket(message_rate, message_burst)
+        self.bytes = TokenBucket(byte_rate, byte_burst)
+        self._lock = threading.Lock()
+
+    def allow(self, size: int, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        size = min(size, self.bytes.burst)  # a message bigger than the burst passes when the bucket is full
+        with self._lock:
+            if self.messages.refill(now) < 1 or self.bytes.refill(now) < size:
+                return False
+            self.messages.tokens -= 1
+            self.bytes.tokens -= size
+            return True
+
+
+class Limits(NamedTuple):
+    message_rate: float
+    message_burst: float
+    byte_rate: float
+    byte_burst: float
+
+    def new(self) -> RateLimit:
+        return RateLimit(*self)
+
+    def __str__(self):
+        return f"{self.message_rate:g} messages and {self.byte_rate:.0f} bytes per second"
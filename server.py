@@ -1,34 +1,122 @@
+import asyncio
+import atexit
+import itertools
+import json
 import os
-import re
 import socket as sockets
+import struct
+import subprocess
+import sys
+import tempfile
 import threading
-import traceback
-from concurrent.futures import ThreadPoolExecutor
-from typing import List, Optional
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from termcolor import colored
 
+import metrics
 from BufferedSocketStream import BufferedSocketStream
+from CommandTable import Command, CommandTable
 from ReentrantRWLock import ReentrantRWLock
-from lib import soft_join, thread_print
-from server_types import Invite, Group, ServerMessage, ServerUser, Message, parse_args
+from TimerWheel import TimerWheel
+from OutboundQueue import OutboundQueue
+from rate_limit import Admission, Limits
+from compression import Deflater, METHODS as COMPRESSION_METHODS
+from bus import Broker, BusHub, EVENT_NODE_DOWN, EVENT_STATE, EVENT_SYNC, FIRST_EVENT, NODE_ID, connect, \
+    encode_event, parse_address
+import frame_codec
+from frame_codec import FLAG_REPLAY, MAX_NAME, PROTOCOL_VERSION, Frame, decode_client_frame, encode_client_frame_v2, \
+    encode_name, to_version, with_flags
+from history import History
+from lib import soft_join, log, set_send_timeout, setup_logging, CountingExecutor
+from usernames import RULE as USERNAME_RULE, NameReservations, NameSuggestions, valid_username
+from server_types import Invite, Group, ServerMessage, ServerUser, AsyncServerUser, RemoteUser, ServerRegistry, \
+    Message, parse_args
 
-server_state_lock = ReentrantRWLock()
-senders = ThreadPoolExecutor(max_workers=200, thread_name_prefix='server_senders')
+server_state_lock = ReentrantRWLock()  # guards the registry indexes, each group has its own state_lock
+server_state_lock.on_wait = metrics.lock_wait.labels('server').observe
+# drains never wait on a peer (see User.write_nowait), so a few threads per core keep up with any number of users
+senders = CountingExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4), thread_name_prefix='server_senders')
 
 system_user = ServerUser(None, senders, username='system')
 system_user.system_user = system_user
 
-# reserved name 'system'
-users: List[ServerUser] = [system_user]
 global_group = Group('global', system_user, senders)
 global_group.locked = True
 global_group.admin = system_user
 
-groups = [global_group]  # first group is the global group and it has no admin
-reserved_names = [global_group.name, system_user.name, 'admin', 'null', 'none', 'program']
+# reserved name 'system', the global group has no admin
+registry = ServerRegistry()
+registry.add_user(system_user)
+registry.add_group(global_group)
+reserved_names = {global_group.name, system_user.name, 'admin', 'null', 'none', 'program'}
+# every name in use or being picked, logins check and take a name here without the server state lock
+username_owners = NameReservations(reserved_names, owner=system_user)
+username_suggestions = NameSuggestions()  # suggest_names=path adds the words of a file
+commands = CommandTable()  # server commands, the handlers below register themselves
 
-# SEND_TIMEOUT = 3600  # 1 hour inactivity
+metrics.Gauge('chat_users', 'connected users with a username', lambda: len(registry.users) - 1)
+metrics.Gauge('chat_connections', 'open client connections, with and without a username',
+              lambda: admission.connections)
+metrics.Gauge('chat_groups', 'groups including the global group', lambda: len(registry.groups))
+metrics.Gauge('chat_senders_queue_depth', 'outbound drains queued or running on the sender threads',
+              lambda: senders.pending)
+metrics.CallbackCounter('chat_outbound_overflow_total', 'times a slow consumer policy fired',
+                        lambda: {policy: OutboundQueue.stats()[policy] for policy in OutboundQueue.POLICIES},
+                        label_name='policy')
+metrics.CallbackCounter('chat_outbound_dropped_frames_total', 'frames dropped by slow consumer policies',
+                        lambda: OutboundQueue.stats()['dropped_frames'])
+metrics.CallbackCounter('chat_outbound_dropped_bytes_total', 'bytes dropped by slow consumer policies',
+                        lambda: OutboundQueue.stats()['dropped_bytes'])
+
+# connections are admitted before anything is read from them, see configure_admission
+admission = Admission(max_connections=30)
+listen_backlog = 128
+# refused connections get one v1 system frame, the client has not said which versions it reads
+REFUSALS = {
+    reason: Frame(Message.CONTEXT_SYSTEM, Message.CONTEXT_USER, system_user.name_field, encode_name(''),
+                  content.encode('utf-8'), 0, None).encoded(1)
+    for reason, content in ((Admission.FULL, 'SERVER_FULL'),
+                            (Admission.THROTTLED, 'SERVER_BUSY too many connections from your address, try later'))
+}
+
+# checked before a message is handled, a dropped message is never fanned out. None turns a limit off
+user_limits: Optional[Limits] = Limits(message_rate=20, message_burst=40, byte_rate=64 * 1024, byte_burst=256 * 1024)
+group_limits: Optional[Limits] = Limits(message_rate=200, message_burst=400, byte_rate=1024 * 1024,
+                                        byte_burst=2 * 1024 * 1024)
+
+send_timeout = 10.0  # seconds a consumer may take no data while frames wait for it before it is dropped
+
+# a connection whose hello offered heartbeat=ping and that sent nothing for idle_timeout seconds gets a /ping, if it
+# is still quiet ping_timeout seconds later it is dropped and leaves its groups like on any disconnect. clients that
+# can't answer pings are only dropped after quiet_timeout seconds of silence, by default never.
+# one wheel holds the deadline of every connection
+idle_timeout = 60.0
+ping_timeout = 20.0
+quiet_timeout = 0.0
+reaper: Optional[TimerWheel] = None  # None when neither idle_timeout nor quiet_timeout is set
+PING = '/ping'
+PONG = '/pong'
+
+history: Optional[History] = None  # message logs, history_dir= turns them on
+history_replay = 20  # messages replayed on join and by /history without a count
+history_max = 500
+
+compression_methods = COMPRESSION_METHODS  # offered to clients that ask in their hello, compression=off empties it
+compress_threshold = 128  # bytes, smaller batches of frames are sent uncompressed
+
+# the nodes of a cluster (workers=N on one host, broker= across hosts) keep the same state by applying the logins,
+# server commands and leaves of every user in broker order, chat is routed only to the nodes hosting a receiver
+broker: Optional[Broker] = None  # set on cluster nodes only
+node_id = 0
+EVENT_JOIN = FIRST_EVENT  # ORIGIN, NAME_SIZE(1), NAME
+EVENT_COMMAND = FIRST_EVENT + 1  # ORIGIN, SENDER_SIZE(1), SENDER, v2 client to server frame
+EVENT_LEAVE = FIRST_EVENT + 2  # NAME_SIZE(1), NAME
+EVENT_DELIVER = FIRST_EVENT + 3  # TARGET_CONTEXT(1), TARGET_SIZE(1), TARGET, v2 server to client frame
+ORIGIN = struct.Struct('<HQ')  # node that has the connection, ticket its handler waits on
+tickets = itertools.count()
+message_ids = itertools.count(1)  # MESSAGE_ID of v2 frames is next(message_ids) << 16 | node_id
+pending: Dict[int, Tuple[ServerUser, Callable[[bool], None]]] = {}  # handlers of this node waiting on the broker
 
 """"
 Message Struct(server to client)
@@ -54,6 +142,51 @@ Message Struct(client to server)
     MESSAGE(utf-8)
 ]
 
+Message Struct v2(server to client), every integer little endian
+[
+    SIG2(2)
+    SIZE(4)                 bytes after this field, at most max_frame_bytes
+    FLAGS(1)                1 = replayed from the history
+    SENDER_CONTEXT(1)
+    TARGET_CONTEXT(1)
+    TIMESTAMP(8)            server receive time, us since the epoch
+    MESSAGE_ID(varint)      LEB128, 0 for system messages
+    SENDER_SIZE(1)
+    SENDER(utf-8)
+    TARGET_SIZE(1)
+    TARGET(utf-8)
+    MESSAGE(utf-8)          the rest of the frame
+]
+
+Message Struct v2(client to server)
+[
+    SIG2(2)
+    SIZE(4)
+    FLAGS(1)
+    TARGET_CONTEXT(1)
+    TARGET_SIZE(1)
+    TARGET(utf-8)
+    MESSAGE(utf-8)          the rest of the frame
+]
+
+the signature tells the versions apart, a server reads both from any client. v1 is what a client gets until its
+hello asks for more, a message over 65535 bytes reaches a v1 client cut to that size
+
+handshake, optional: before its username a client may send "/hello version=2 compress=zlib heartbeat=ping" in the
+SYSTEM target context, the server answers "/hello" followed by the options it accepted. frames after the answer come
+in the accepted version. once compress is accepted a batch of frames may come as one block, see compression.py
+
+heartbeat: once heartbeat=ping is accepted the server sends "/ping" to the connection when it was quiet for a while,
+the client answers "/pong" in the SYSTEM target context. any frame counts as an answer, a connection that sends none
+is dropped
+
+Compressed block(server to client)
+[
+    SIGZ(2)
+    SIZE(4)
+    DEFLATE(SIZE)
+]
+
 client commands handled by server:
 /create <group_name>    create a new group
 /leave                  leave this group
@@ -63,6 +196,9 @@ client commands handled by server:
 /banned                 show ban list
 /ban <user_name>        ban user
 /kick <user_name>       kick user from this group
+/lock                   lock this group, only invites from the admin are valid
+/unlock                 unlock this group
+/history [count]        show the last messages of this group, or of whispers while both users stay connected
 /help                   show commands
 
 client commands handled by client:
@@ -74,20 +210,6 @@ client commands handled by client:
 """
 
 
-def send_system_message_async(msg: str):
-    for user in users:
-        user.send_system_message_async(
-            ServerMessage.to_client(
-                target_context=ServerMessage.CONTEXT_USER,
-                sender_context=ServerMessage.CONTEXT_SYSTEM,
-                sender=system_user,
-                target=user,
-                content=msg,
-                report=True
-            )
-        )
-
-
 def format_user_group(group: Group, this_user: ServerUser, user: ServerUser):
     txt = user.name
     if this_user == user:
@@ -99,417 +221,1224 @@ def format_user_group(group: Group, this_user: ServerUser, user: ServerUser):
     return txt
 
 
+def pick_username(this_user: ServerUser, uname: str) -> bool:
+    """
+    validate the requested username and reserve it for this_user, returns False if it was rejected.
+    the name stays reserved until this_user leaves or its join is refused
+    """
+    uname = uname.strip().lower()
+    if not valid_username(uname):
+        this_user.send_system_message(USERNAME_RULE)
+        return False
+    if not username_owners.reserve(uname, this_user):
+        free = username_suggestions.suggest(uname, lambda name: name not in username_owners)
+        this_user.send_system_message(f"username {uname} already taken" +
+                                      (f", free names: {', '.join(free)}" if free else ''))
+        return False
+    this_user.name = uname
+    return True
+
+
+def hello(this_user: ServerUser, content: str):
+    """
+    answer the handshake of a client, options it does not know are left out of the answer
+    """
+    options = dict(option.split('=', 1) for option in content.split()[1:] if '=' in option)
+    accepted = []
+    version = int(options['version']) if options.get('version', '').isdigit() else 1
+    version = max(1, min(version, PROTOCOL_VERSION))
+    if version > 1:
+        accepted.append(f'version={version}')
+    method = next((m for m in options.get('compress', '').split(',') if m in compression_methods), None)
+    if method is not None and this_user.deflater is None:
+        accepted.append(f'compress={method}')
+    heartbeat = options.get('heartbeat') == 'ping' and reaper is not None and idle_timeout > 0
+    if heartbeat:
+        accepted.append('heartbeat=ping')
+    this_user.send_system_message_async(' '.join(['/hello'] + accepted))
+    if heartbeat and not this_user.heartbeat:
+        this_user.heartbeat = True
+        watch(this_user)  # its checks may have stopped while it could not be pinged
+    this_user.protocol = version  # frames are encoded when written, the answer may already be in this version
+    if method is not None and this_user.deflater is None:
+        # the client inflates from its hello on, the answer itself may already be compressed
+        this_user.deflater = Deflater(compress_threshold)
+
+
+def replay_history(this_user: ServerUser, path: str, count: int, title: str) -> int:
+    """
+    queue the last count logged frames of path for this_user, returns how many there were
+    """
+    return replay_frames(this_user, history.last(path, count, this_user.outbound.max_bytes // 2), title)
+
+
+def replay_frames(this_user: ServerUser, frames: List[bytes], title: str) -> int:
+    # logged frames are views of the mapped log, queued as one frame so they stay together.
+    # they are v2 frames, only v1 clients get copies
+    if frames:
+        this_user.send_system_message_async(f"{title}, last {len(frames)} messages:")
+        this_user.send_bytes_async(tuple(to_version(frame, this_user.protocol) for frame in frames))
+    return len(frames)
+
+
+def forward_message(this_user: ServerUser, message: ServerMessage):
+    frame = ServerMessage.to_client(
+        target_context=message.target_context,
+        sender_context=Message.CONTEXT_USER,
+        target=message.target,
+        sender=this_user,
+        content=message.content,
+        report=True,
+        message_id=next(message_ids) << 16 | node_id,
+        timestamp=message.received_at,
+    )
+    if history is not None:
+        # logged first, whoever got the message finds it in the history
+        logged = with_flags(frame.encoded(2), FLAG_REPLAY)
+        if isinstance(message.target, Group):
+            history.append(history.group_path(message.target.name), logged)
+        else:
+            history.append_whisper(this_user.name, message.target.name, logged)
+    if broker is not None:
+        route(message.target, frame)
+        return
+    message.target.send_bytes_async(frame)
+
+
+def join_server(this_user: ServerUser):
+    if history is not None:
+        history.forget_whispers(this_user.name)  # left by an earlier user of the name
+    with server_state_lock.for_write():
+        registry.add_user(this_user)
+    with global_group.state_lock.for_write():
+        global_group.join_user(this_user, None)
+        # queued before the replay, the client needs its name to show its own whispers
+        this_user.send_system_message_async(f"/set username {this_user.name}")
+        if history is not None:
+            replay_history(this_user, history.group_path(global_group.name), history_replay,
+                           f"history of {global_group.name}")
+    global_group.send_system_message_async(f"{this_user.name} has connected")
+
+
+def leave_server(this_user: ServerUser):
+    with server_state_lock.for_write():
+        registry.remove_user(this_user)
+    username_owners.release(this_user.name, this_user)
+    if history is not None:
+        history.forget_whispers(this_user.name)
+    for group in list(this_user.groups):
+        with group.state_lock.for_write():
+            group.remove_user(this_user, f"{this_user.name} has disconnected")
+            abandoned = len(group.users) == 0 and group is not global_group
+        if abandoned:
+            remove_abandoned_group(group)
+    for group in list(this_user.invited_to):
+        with group.state_lock.for_write():
+            group.take_invites(this_user)
+
+
+def remove_abandoned_group(group: Group):
+    # someone may have joined since the group lock was released, check again holding both
+    with server_state_lock.for_write(), group.state_lock.for_write():
+        if group.users or group.removed:
+            return
+        group.removed = True
+        registry.remove_group(group)
+    log.info("abandoned group was removed: %s", group.name)
+
+
+@commands.command('/create', '<group_name>', 'create a new group')
+def create_group(this_user: ServerUser, message: ServerMessage, argument: str):
+    group_name = argument.strip()
+    if len(group_name) <= 0:
+        this_user.send_system_message_async("no group name provided try /help command")
+        return
+    if len(group_name.encode('utf-8')) > MAX_NAME:
+        this_user.send_system_message_async(f"group name is longer than {MAX_NAME} bytes")
+        return
+    with server_state_lock.for_write():
+        exists = group_name in registry.groups or group_name in reserved_names
+        if not exists:
+            # not published yet, nobody else can see the group before add_group
+            group = Group(group_name, system_user, senders)
+            group.rate_limit = group_limits.new() if group_limits else None
+            if history is not None:
+                history.clear(history.group_path(group.name))  # the name may belong to a group that was removed
+            group.join_user(this_user, f"you have created the group {group.name}")
+            group.admin = this_user
+            registry.add_group(group)
+    if exists:
+        this_user.send_system_message_async(f"{group_name} name is taken")
+        return
+    this_user.send_system_message(f"/switch {group.name}")
+
+
+@commands.command('/leave', doc='leave this group')
+def leave_group(this_user: ServerUser, message: ServerMessage, argument: str):
+    if not isinstance(message.target, Group):
+        this_user.send_system_message_async("target is not a group")
+        return
+    with message.target.state_lock.for_write():
+        if this_user not in message.target.users:
+            this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
+            return
+        message.target.remove_user(this_user, f"{this_user.name} has left")
+        if message.target == global_group:
+            global_group.add_invite(Invite(this_user, system_user))
+
+    if message.target == global_group:
+        this_user.send_system_message_async(
+            f"you have unsubscribed from the global group use \"/accept {global_group.name}\" to come back")
+    else:
+        this_user.send_system_message_async(f"you left the group {message.target.name}")
+
+
+@commands.command('/invite', '<user_name>', 'send a group invite')
+def invite_user(this_user: ServerUser, message: ServerMessage, argument: str):
+    user_name = argument.strip()
+    if not isinstance(message.target, Group):
+        this_user.send_system_message_async("target is not a group")
+        return
+    group = message.target
+    if len(user_name) <= 0:
+        this_user.send_system_message_async("no username provided try /help command")
+        return
+
+    if not group:
+        this_user.send_system_message_async("group no longer exists")
+        this_user.send_system_message(f"/switch {global_group.name}")
+        return
+    with server_state_lock.for_read():
+        user = registry.find_user(user_name) if user_name not in reserved_names else None
+    if not user:
+        this_user.send_system_message_async(f"user not found:{user_name}")
+        return
+    if user == this_user:
+        this_user.send_system_message_async(
+            f"you can't invite yourself, you're already in group {group.name}")
+        return
+    if user in this_user.ban_list:
+        this_user.send_system_message_async(f"{user.name} is in your ban list")
+        return
+    with group.state_lock.for_write():
+        if group.locked and group.admin is not this_user:
+            this_user.send_system_message_async(
+                "you can't send invites, this group is locked and you are not the admin")
+            return
+        group.add_invite(Invite(user=user, invited_by=this_user))
+    user.send_system_message_async(
+        f"you was invited by {this_user.name} to join group {group.name} type \"/accept {group.name}\" to join")
+    this_user.send_system_message_async(f"invite was sent to {user.name}")
+
+
+@commands.command('/accept', '<group_name>', 'accept a group invite')
+def accept_invite(this_user: ServerUser, message: ServerMessage, argument: str):
+    group_name = argument.strip()
+    if len(group_name) <= 0:
+        this_user.send_system_message_async("no group name provided try /help command")
+        return
+    with server_state_lock.for_read():
+        group = registry.find_group(group_name)
+    if group is None:
+        this_user.send_system_message_async("invite expired or group does not exist")
+        return
+    with group.state_lock.for_write():
+        invite = None
+        if not group.removed:
+            invites = group.take_invites(this_user)  # consume all invites
+            # TODO: clear invite list in kick command or leave command
+            if invites:
+                # an invite from the admin is still valid after the group was locked
+                invite = next((i for i in invites if i.invited_by is group.admin), invites[-1])
+        invalid = invite is None or (group.locked and invite.invited_by is not group.admin)
+
+        if invalid:
+            this_user.send_system_message_async("invite expired or group does not exist")
+            return
+        if this_user in group.admin.ban_list:
+            this_user.send_system_message(f"You are banned by the group admin and can't join {group.name}")
+            return
+        if this_user in group.users:
+            this_user.send_system_message_async(f"you are already in group {group.name}")
+            return
+        group.join_user(this_user, f"{this_user.name} has entered the group" if group is not global_group else f"{this_user.name} has re-entered the group")
+        if history is not None:
+            # under the group lock every message is either in the replay or sent live, never both
+            replay_history(this_user, history.group_path(group.name), history_replay, f"history of {group.name}")
+    this_user.send_system_message(f"/switch {group.name}")
+
+
+@commands.command('/users', doc='show users in this group')
+def list_users(this_user: ServerUser, message: ServerMessage, argument: str):
+    if not isinstance(message.target, Group):
+        this_user.send_system_message_async("target is not a group")
+        return
+    with message.target.state_lock.for_read():
+        if this_user not in message.target.users:
+            this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
+            return
+        this_user.send_bytes_async(
+            ServerMessage.to_client(
+                target_context=Message.CONTEXT_GROUP,
+                sender_context=Message.CONTEXT_SYSTEM,
+                sender=system_user,
+                target=message.target,  # it is sent only to this_user
+                content=f'users in {message.target.name}:\n' +
+                        '\n'.join(format_user_group(message.target, this_user, user) for user in message.target.users),
+                report=True
+            )
+        )
+
+
+@commands.command('/banned', doc='show ban list')
+def list_banned(this_user: ServerUser, message: ServerMessage, argument: str):
+    # ban_list is only changed by this user's own handler, no lock needed
+    this_user.send_bytes_async(
+        ServerMessage.to_client(
+            target_context=Message.CONTEXT_GROUP,
+            sender_context=Message.CONTEXT_SYSTEM,
+            sender=system_user,
+            target=message.target,  # it is sent only to this_user
+            content=f'banned users:\n' +
+                    '\n'.join(user.name for user in this_user.ban_list),
+            report=True
+        )
+    )
+
+
+@commands.command('/ban', '<user_name>', 'ban user')
+def ban_user(this_user: ServerUser, message: ServerMessage, argument: str):
+    user_name = argument.strip()
+    if not isinstance(message.target, Group):
+        this_user.send_system_message_async("target is not a group")
+        return
+    if len(user_name) <= 0:
+        this_user.send_system_message_async("no username provided try /help command")
+        return
+
+    with server_state_lock.for_read():
+        user = registry.find_user(user_name)
+    if not user:
+        this_user.send_system_message_async(f"user {user_name} does not exist")
+        return
+    for group in list(this_user.groups):
+        with group.state_lock.for_write():
+            if this_user == group.admin and this_user in group.users and user in group.users:
+                group.remove_user(user, f"{user.name} was banned by the admin")
+                user.send_system_message_async(f"you was kicked from group {group.name}, because the admin banned you")
+    this_user.ban_list[user] = None
+    this_user.send_system_message_async(f"{user.name} is now in your ban list")
+
+
+@commands.command('/kick', '<user_name>', 'kick user from this group')
+def kick_user(this_user: ServerUser, message: ServerMessage, argument: str):
+    user_name = argument.strip()
+    sep = user_name.find(' ')
+    reason = ''
+    if sep != -1:
+        reason = 'reason: ' + user_name[sep:].strip()
+        user_name = user_name[:sep]
+    if not isinstance(message.target, Group):
+        this_user.send_system_message_async("target is not a group")
+        return
+    group = message.target
+    if len(user_name) <= 0:
+        this_user.send_system_message_async("no username provided try /help command")
+        return
+
+    if not group:
+        this_user.send_system_message_async("group no longer exists")
+        this_user.send_system_message(f"/switch {global_group.name}")
+        return
+    with server_state_lock.for_read():
+        user = registry.find_user(user_name)
+    with group.state_lock.for_write():
+        if group.admin is not this_user:
+            this_user.send_system_message_async(
+                f"can't kick {user_name} you are not the admin of {group.name}")
+            return
+        if user not in group.users:
+            user = None
+        if user is None:
+            this_user.send_system_message_async(f"{user_name} is not in your group {group.name}")
+            return
+        elif user == this_user:
+            this_user.send_system_message_async("you can't kick your self, use /leave")
+            return
+        group.remove_user(user, f"{user.name} was kicked from the group")
+        user.send_system_message_async(f"you was kicked by the admin from group {group.name} {reason}")
+        user.send_system_message_async(f"/switch {global_group.name}")
+        this_user.send_system_message_async(f"{user.name} was kicked")
+
+
+@commands.command('/lock', doc='lock this group, only invites from the admin are valid')
+def lock_group(this_user: ServerUser, message: ServerMessage, argument: str):
+    if not isinstance(message.target, Group):
+        this_user.send_system_message_async("target is not a group")
+        return
+    if not message.target:
+        this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
+        this_user.send_system_message(f"/switch {global_group.name}")
+        return
+    with message.target.state_lock.for_write():
+        if message.target.admin is not this_user:
+            this_user.send_system_message_async("you are not the group admin")
+            return
+        if message.target.locked:
+            this_user.send_system_message_async("group is already locked")
+            return
+        message.target.lock()
+        message.target.drop_invites_not_from(this_user)
+
+
+@commands.command('/unlock', doc='unlock this group')
+def unlock_group(this_user: ServerUser, message: ServerMessage, argument: str):
+    if not isinstance(message.target, Group):
+        this_user.send_system_message_async("target is not a group")
+        return
+    if not message.target:
+        this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
+        return
+    with message.target.state_lock.for_write():
+        if message.target.admin is not this_user:
+            this_user.send_system_message_async("you are not the group admin")
+            return
+        if not message.target.locked:
+            this_user.send_system_message_async("group is not locked")
+            return
+        message.target.unlock()
+
+
+@commands.command('/history', '[count]',
+                  'show the last messages of this group, or of whispers while both users stay connected')
+def show_history(this_user: ServerUser, message: ServerMessage, argument: str):
+    if history is None:
+        this_user.send_system_message_async("history is not enabled on this server")
+        return
+    count = argument.strip()
+    try:
+        count = min(int(count), history_max) if count else history_replay
+    except ValueError:
+        this_user.send_system_message_async("count must be a number, try /help command")
+        return
+    if isinstance(message.target, Group):
+        with message.target.state_lock.for_read():
+            if this_user not in message.target.users:
+                this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
+                return
+            replayed = replay_history(this_user, history.group_path(message.target.name), count,
+                                      f"history of {message.target.name}")
+    else:
+        frames = history.last_whispers(this_user.name, message.target.name, count, this_user.outbound.max_bytes // 2)
+        replayed = replay_frames(this_user, frames, f"whispers with {message.target.name}")
+    if not replayed:
+        this_user.send_system_message_async("no history")
+
+
+@commands.command('/help', doc='show commands')
+def show_help(this_user: ServerUser, message: ServerMessage, argument: str):
+    this_user.send_system_message_async('chat commands:\n' + commands.help())
+
+
+def handle_message_timed(this_user: ServerUser, message: ServerMessage):
+    started = time.perf_counter()
+    found = commands.find(message.content)
+    handle_message(this_user, message, found)
+    metrics.command_latency.labels('message' if found is None else found[0].name).observe(
+        time.perf_counter() - started)
+
+
+def handle_message(this_user: ServerUser, message: ServerMessage, found: Optional[Tuple[Command, str]]):
+    """
+    route one message received from this_user, runs its server command or forwards it to the target.
+    found is the message's entry in commands
+    """
+    if message.target_context == Message.CONTEXT_SYSTEM:
+        if message.content != PONG:  # the pong did its part when it was received
+            this_user.send_system_message_async("the system context is only for the hello before the username")
+        return
+    with server_state_lock.for_read():
+        message.target = registry.find_target(message.target_str)
+    if not message.target:
+        if message.target_context == Message.CONTEXT_GROUP:
+            this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
+            this_user.send_system_message(f"/switch {global_group.name}")
+        elif message.target_context == Message.CONTEXT_USER:
+            this_user.send_system_message_async(f"user {message.target_str} does not exist")
+        else:
+            this_user.send_system_message_async(f"target {message.target_str} does not exist")
+        return
+    if found is None:
+        handle_chat(this_user, message)
+    else:
+        command, argument = found
+        command.handler(this_user, message, argument)
+
+
+def handle_chat(this_user: ServerUser, message: ServerMessage):
+    if isinstance(message.target, Group):
+        with message.target.state_lock.for_read():
+            if this_user not in message.target.users:
+                this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
+                return
+            if this_user in message.target.admin.ban_list:
+                this_user.send_system_message_async(f"you are banned by {message.target.name}'s admin")
+                return
+            if message.content.strip() == '':
+                this_user.send_system_message_async("empty message")
+                return
+            limit = message.target.rate_limit
+            if limit is not None and not limit.allow(len(message.content)):
+                report_dropped(this_user, f"group {message.target.name} is over {group_limits}")
+                return
+            # still under the lock, so a user that joins gets each message either live or in the replay
+            forward_message(this_user, message)
+        return
+    this_user.send_system_message_async(
+        f"You're whispering to {message.target.name}: {message.content}")
+    if this_user in message.target.ban_list:
+        this_user.send_system_message_async(f"you are banned by {message.target.name}")
+        return
+    if message.target in this_user.ban_list:
+        this_user.send_system_message_async(f"you banned {message.target.name}")
+        return
+    if message.content.strip() == '':
+        this_user.send_system_message_async("empty message")
+        return
+    forward_message(this_user, message)
+
+
+def login(this_user: ServerUser, uname: str) -> bool:
+    """
+    pick the username and join the server, returns False if the name was rejected.
+    on a cluster node the join waits for its turn on the broker, the name may be taken by then
+    """
+    if not pick_username(this_user, uname):
+        return False
+    if broker is None:
+        join_server(this_user)
+        return True
+    return wait_on_broker(EVENT_JOIN, this_user)
+
+
+async def login_async(this_user: ServerUser, uname: str) -> bool:
+    if broker is None:
+        return login(this_user, uname)
+    if not pick_username(this_user, uname):
+        return False
+    return await wait_on_broker_async(EVENT_JOIN, this_user)
+
+
+def within_limit(this_user: ServerUser, message: ServerMessage) -> bool:
+    """
+    take the message from this_user's rate limit, False when it has to be dropped. content characters stand in
+    for bytes, chat text is mostly one byte each
+    """
+    limit = this_user.rate_limit
+    if limit is None or limit.allow(len(message.content)):
+        return True
+    report_dropped(this_user, f"you are over {user_limits}")
+    return False
+
+
+def report_dropped(this_user: ServerUser, reason: str):
+    # once a second at most, a flooder must not get a reply for each message it floods
+    now = time.monotonic()
+    if now - this_user.limit_reported_at >= 1:
+        this_user.limit_reported_at = now
+        this_user.send_system_message_async(f"message dropped, {reason}")
+
+
+def dispatch(this_user: ServerUser, messages: List[ServerMessage]):
+    """
+    handle the messages of one user in order. on a cluster node server commands go through the broker and
+    the handler waits for each one, so the next message of the user sees its effect
+    """
+    for message in messages:
+        if not within_limit(this_user, message):
+            continue
+        if broker is None or commands.find(message.content) is None:
+            handle_message_timed(this_user, message)
+        else:
+            wait_on_broker(EVENT_COMMAND, this_user, client_frame(message))
+
+
+async def dispatch_async(this_user: ServerUser, message: ServerMessage):
+    if not within_limit(this_user, message):
+        return
+    if broker is None or commands.find(message.content) is None:
+        handle_message_timed(this_user, message)
+    else:
+        await wait_on_broker_async(EVENT_COMMAND, this_user, client_frame(message))
+
+
+def logout(this_user: ServerUser):
+    if broker is None:
+        leave_server(this_user)
+        return
+    with server_state_lock.for_read():
+        joined = registry.users.get(this_user.name) is this_user
+    if joined:
+        # a name that never joined may belong to a user of another node
+        broker.publish(encode_event(EVENT_LEAVE, this_user.name_field))
+    else:
+        username_owners.release(this_user.name, this_user)
+
+
+def client_frame(message: ServerMessage) -> bytes:
+    return encode_client_frame_v2(message.target_context, message.target_str, message.content)
+
+
+def publish_waiting(event_type: int, this_user: ServerUser, done: Callable[[bool], None], payload: bytes):
+    ticket = next(tickets)
+    pending[ticket] = (this_user, done)
+    broker.publish(encode_event(event_type, ORIGIN.pack(node_id, ticket), this_user.name_field, payload))
+
+
+def wait_on_broker(event_type: int, this_user: ServerUser, payload=b'') -> bool:
+    """
+    publish the event of this_user and wait until this node applied it
+    """
+    applied = threading.Event()
+    result = []
+    publish_waiting(event_type, this_user, lambda ok: (result.append(ok), applied.set()), payload)
+    applied.wait()
+    return result[0]
+
+
+async def wait_on_broker_async(event_type: int, this_user: ServerUser, payload=b'') -> bool:
+    loop = asyncio.get_running_loop()
+    applied = loop.create_future()
+    publish_waiting(event_type, this_user, lambda ok: loop.call_soon_threadsafe(applied.set_result, ok), payload)
+    return await applied
+
+
+def route(target: Union[Group, ServerUser], frame: Frame):
+    """
+    send frame to the receivers on this node and only to the nodes that host the others
+    """
+    receivers = target.members if isinstance(target, Group) else (target,)
+    nodes = {user.node for user in receivers if isinstance(user, RemoteUser)}
+    if nodes:
+        context = Message.CONTEXT_GROUP if isinstance(target, Group) else Message.CONTEXT_USER
+        broker.send_to(nodes, encode_event(EVENT_DELIVER, bytes((context,)), target.name_field, frame.encoded(2)))
+    target.send_bytes_async(frame)  # remote receivers skip it
+
+
+def read_name(payload: bytes, offset: int) -> Tuple[str, int]:
+    end = offset + 1 + payload[offset]
+    return payload[offset + 1:end].decode('utf-8'), end
+
+
+def on_broker_event(event_type: int, payload: bytes):
+    """
+    applies one event of any node to the state of this node, every node applies the published events in the
+    same order. users of other nodes are RemoteUser replicas, each frame is written by the node with the connection
+    """
+    if event_type == EVENT_DELIVER:
+        name, end = read_name(payload, 1)
+        with server_state_lock.for_read():
+            target = registry.find_group(name) if payload[0] == Message.CONTEXT_GROUP else registry.find_user(name)
+        if target is not None:
+            target.send_bytes_async(Frame.from_v2(payload[end:]))
+        return
+    if event_type == EVENT_LEAVE:
+        with server_state_lock.for_read():
+            this_user = registry.find_user(read_name(payload, 0)[0])
+        if this_user is not None:
+            leave_server(this_user)
+        return
+    if event_type == EVENT_NODE_DOWN:
+        node = NODE_ID.unpack_from(payload)[0]
+        with server_state_lock.for_read():
+            gone = [user for user in registry.users.values() if isinstance(user, RemoteUser) and user.node == node]
+        for this_user in gone:
+            leave_server(this_user)
+        log.info("node %s is down, %s of its users left", node, len(gone))
+        return
+    if event_type == EVENT_SYNC:
+        broker.publish(encode_event(EVENT_STATE, payload[:NODE_ID.size], cluster_state()))
+        return
+    if event_type == EVENT_STATE:
+        load_cluster_state(payload)
+        return
+    origin, ticket = ORIGIN.unpack_from(payload)
+    name, end = read_name(payload, ORIGIN.size)
+    waiting = pending.pop(ticket, None) if origin == node_id else None
+    if event_type == EVENT_JOIN:
+        with server_state_lock.for_read():
+            taken = name in registry.users
+        if waiting is None:
+            if not taken:
+                # the broker order decides, a user of this node that reserved the name too is refused at its turn
+                remote_user = RemoteUser(system_user, senders, name, origin)
+                username_owners.assign(name, remote_user)
+                join_server(remote_user)
+            return
+        this_user, done = waiting
+        joined = False
+        try:
+            if taken:
+                username_owners.release(name, this_user)
+                this_user.send_system_message_async(f"username {name} already taken")
+            else:
+                join_server(this_user)
+                joined = True
+        finally:
+            done(joined)
+    elif event_type == EVENT_COMMAND:
+        try:
+            with server_state_lock.for_read():
+                this_user = registry.find_user(name)
+            if this_user is not None:
+                handle_message_timed(this_user, ServerMessage.from_frame(decode_client_frame(payload, end)[0]))
+        finally:
+            if waiting is not None:
+                waiting[1](True)
+
+
+def cluster_state() -> bytes:
+    """
+    users, ban lists, groups and invites for a node joining the cluster again. runs on the bus thread, where every
+    replicated change is applied, so it is the state at the point of the order where the hub asked for it
+    """
+    def current(user: ServerUser) -> bool:
+        # a user that left may still be referenced, a new user of its name is someone else
+        return user is system_user or registry.users.get(user.name) is user
+
+    with server_state_lock.for_read():
+        users = [user for user in registry.users.values() if user is not system_user]
+        groups = list(registry.groups.values())
+        state = {
+            'users': [[user.name, user.node if isinstance(user, RemoteUser) else node_id,
+                       [banned.name for banned in user.ban_list if current(banned)]] for user in users],
+            'groups': [],
+        }
+        for group in groups:
+            with group.state_lock.for_read():
+                state['groups'].append({
+                    'name': group.name,
+                    'admin': group.admin.name if group.admin is not None else None,
+                    'locked': group.locked,
+                    'users': [user.name for user in group.users],
+                    'invites': [[invite.user.name, invite.invited_by.name] for invites in group.pending_invites.values()
+                                for invite in invites if current(invite.user) and current(invite.invited_by)],
+                })
+    return json.dumps(state).encode('utf-8')
+
+
+def load_cluster_state(data: bytes):
+    """
+    take the state of cluster_state, before this node serves anyone. every user in it is a replica
+    """
+    state = json.loads(data)
+    users: Dict[str, ServerUser] = {system_user.name: system_user}
+    with server_state_lock.for_write():
+        for name, node, _ in state['users']:
+            users[name] = RemoteUser(system_user, senders, name, node)
+            registry.add_user(users[name])
+            username_owners.assign(name, users[name])
+        for name, _, banned in state['users']:
+            users[name].ban_list.update(dict.fromkeys(users[other] for other in banned))
+        for described in state['groups']:
+            group = registry.find_group(described['name'])
+            if group is None:
+                group = Group(described['name'], system_user, senders)
+                group.rate_limit = group_limits.new() if group_limits else None
+                registry.add_group(group)
+            with group.state_lock.for_write():
+                for name in described['users']:
+                    group.join_user(users[name], None)
+                group.admin = users.get(described['admin'])
+                group.locked = described['locked']
+                for name, invited_by in described['invites']:
+                    group.add_invite(Invite(users[name], users[invited_by]))
+    log.info("cluster state loaded, %s users and %s groups", len(state['users']), len(state['groups']))
+
+
+def check_idle(this_user: ServerUser):
+    """
+    the deadline of this_user expired on the reaper: wait again if it sent something since, ping it once it was
+    quiet for idle_timeout and drop it if the ping got no answer
+    """
+    if this_user.outbound.closed:
+        return  # it closed while the deadline was expiring
+    timeout = idle_timeout if this_user.heartbeat else quiet_timeout
+    if timeout <= 0:
+        return  # it can't answer a ping and quiet clients are kept
+    quiet = time.monotonic() - this_user.last_seen
+    if quiet < timeout:
+        reaper.schedule(this_user, timeout - quiet)
+    elif this_user.heartbeat and quiet < timeout + ping_timeout:
+        this_user.send_system_message_async(PING)
+        reaper.schedule(this_user, timeout + ping_timeout - quiet)
+    else:
+        log.info("user %s sent nothing for %.0fs, disconnecting", this_user.name, quiet)
+        metrics.idle_disconnects.inc()
+        this_user.disconnect()  # its handler sees the connection closed and cleans up
+
+
+def watch(this_user: ServerUser):
+    # the first check comes when a ping would be due, the hello may turn the heartbeat on before that
+    reaper.schedule(this_user, idle_timeout if idle_timeout > 0 else quiet_timeout)
+
+
+def unwatch(this_user: ServerUser):
+    this_user.outbound.close()  # nothing is written to a closed connection, and check_idle stops for it
+    reaper.cancel(this_user)
+
+
 def handle_client(socket: sockets.socket, full_address: str):
-    # socket.settimeout(SEND_TIMEOUT)
-    input_stream = BufferedSocketStream(socket)
+    set_send_timeout(socket, send_timeout)  # only where sends can't be made non-blocking
+    # the outbound queue does the batching, nagle would only hold back the last frame of a batch
+    socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_NODELAY, 1)
+    input_stream = BufferedSocketStream(socket, on_receive=metrics.bytes_in.inc)
     this_user = ServerUser(system_user, senders, socket)
+    this_user.send_timeout = send_timeout  # writes never wait, a stuck peer holds no sender thread
+    this_user.rate_limit = user_limits.new() if user_limits else None
     this_user.print_network = True
+    this_user.wait_for_send = broker is None  # on a cluster node the bus thread sends, it must not wait on one client
+    if reaper is not None:
+        watch(this_user)
     try:
         this_user.send_system_message("choose a username")
         this_user.send_system_message("/req username")
 
         while True:
             try:
-                uname = ServerMessage.from_client(input_stream, report_from=this_user).content.strip().lower()
+                message = ServerMessage.from_client(input_stream, report_from=this_user)
             except ConnectionError as err:
-                thread_print(f"user {this_user.name} disconnected, cause: {err}")
+                log.info("user %s disconnected, cause: %s", this_user.name, err)
                 return
-            set_uname = True
-            with server_state_lock.for_read():
-                for user in users:
-                    if user.name == uname:
-                        this_user.send_system_message(f"username {uname} already taken")
-                        set_uname = False
-                        break
-                if not re.match(r'^[a-z][a-z0-9_-]*[a-z0-9]$', uname):
-                    this_user.send_system_message(
-                        f"name must begin with a-z letter and contain a-z0-9 '_' or '-' and end with a-z0-9")
-                    set_uname = False
-            if not set_uname or not len(uname) > 0:
-                continue
-            this_user.name = uname
-            break
-
-        with server_state_lock.for_write():
-            users.append(this_user)
-            global_group.users.append(this_user)
-            this_user.groups.append(global_group)
-        this_user.send_system_message(f"/set username {this_user.name}")
-        global_group.send_system_message_async(f"{this_user.name} has connected")
+            this_user.last_seen = time.monotonic()
+            if message.target_context == Message.CONTEXT_SYSTEM:
+                if message.content != PONG:
+                    hello(this_user, message.content)
+            elif login(this_user, message.content):
+                break
 
         while True:
             try:
-                message = ServerMessage.from_client(input_stream, report_from=this_user)
+                messages = ServerMessage.from_client_batch(input_stream, report_from=this_user)
             except ConnectionError as err:
-                thread_print(f"user {this_user.name} disconnected, cause: {err}")
+                log.info("user %s disconnected, cause: %s", this_user.name, err)
                 break
-            message.target = None
-            with server_state_lock.for_read():
-                for group in groups:
-                    if group.name == message.target_str:
-                        message.target = group
-                        break
-                if not message.target:
-                    for user in users:
-                        if user.name == message.target_str:
-                            message.target = user
-                            break
-            if not message.target:
-                if message.target_context == Message.CONTEXT_GROUP:
-                    this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
-                    this_user.send_system_message(f"/switch {global_group.name}")
-                elif message.target_context == Message.CONTEXT_USER:
-                    this_user.send_system_message_async(f"user {message.target_str} does not exist")
-                else:
-                    this_user.send_system_message_async(f"target {message.target_str} does not exist")
-                continue
-            if message.content.startswith('/create '):
-                group_name = message.content[8:].strip()
-                if len(group_name) <= 0:
-                    this_user.send_system_message_async("no group name provided try /help command")
-                    continue
-                exists = False
-                with server_state_lock.for_read():
-                    for group in groups:
-                        if group.name == group_name:
-                            exists = True
-                            break
-                    if group_name in reserved_names:
-                        exists = True
-                if exists:
-                    this_user.send_system_message_async(f"{group_name} name is taken")
-                    continue
-                group = Group(group_name, system_user, senders)
-                with server_state_lock.for_write():
-                    group.join_user(this_user, f"you have created the group {group.name}")
-                    group.admin = this_user
-                    groups.append(group)
-                this_user.send_system_message(f"/switch {group.name}")
-            elif message.content == '/lock':
-                if not isinstance(message.target, Group):
-                    this_user.send_system_message_async("target is not a group")
-                    continue
-                if not message.target:
-                    this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
-                    this_user.send_system_message(f"/switch {global_group.name}")
-                    continue
-                if message.target.admin is not this_user:
-                    this_user.send_system_message_async("you are not the group admin")
-                    continue
-                if message.target.locked:
-                    this_user.send_system_message_async("group is already locked")
-                    continue
-                with server_state_lock.for_write():
-                    message.target.lock()
-                    for i in reversed(range(len(message.target.pending_invites))):
-                        if message.target.pending_invites[i].invited_by is not this_user:
-                            message.target.pending_invites.pop(i)
-            elif message.content == '/unlock':
-                if not isinstance(message.target, Group):
-                    this_user.send_system_message_async("target is not a group")
-                    continue
-                if not message.target:
-                    this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
-                    continue
-                if message.target.admin is not this_user:
-                    this_user.send_system_message_async("you are not the group admin")
-                    continue
-                if not message.target.locked:
-                    this_user.send_system_message_async("group is not locked")
-                    continue
-                with server_state_lock.for_write():
-                    message.target.unlock()
-            elif message.content == '/leave':
-                if not isinstance(message.target, Group):
-                    this_user.send_system_message_async("target is not a group")
-                    continue
-                if not message.target or this_user not in message.target.users:
-                    this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
-                    continue
-                with server_state_lock.for_write():
-                    message.target.remove_user(this_user, f"{this_user.name} has left")
-
-                if message.target == global_group:
-                    global_group.pending_invites.append(Invite(this_user, system_user))
-                    this_user.send_system_message_async(
-                        f"you have unsubscribed from the global group use \"/accept {global_group.name}\" to come back")
-                else:
-                    this_user.send_system_message_async(f"you left the group {message.target.name}")
-            elif message.content == '/users':
-                if not isinstance(message.target, Group):
-                    this_user.send_system_message_async("target is not a group")
-                    continue
-                if not message.target or this_user not in message.target.users:
-                    this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
-                    continue
-                with server_state_lock.for_read():
-                    this_user.send_bytes_async(
-                        ServerMessage.to_client(
-                            target_context=Message.CONTEXT_GROUP,
-                            sender_context=Message.CONTEXT_SYSTEM,
-                            sender=system_user,
-                            target=message.target,  # it is sent only to this_user
-                            content=f'users in {message.target.name}:\n' +
-                                    '\n'.join(format_user_group(message.target, this_user, user) for user in message.target.users),
-                            report=True
-                        )
-                    )
-            elif message.content == '/banned':
-                with server_state_lock.for_read():
-                    this_user.send_bytes_async(
-                        ServerMessage.to_client(
-                            target_context=Message.CONTEXT_GROUP,
-                            sender_context=Message.CONTEXT_SYSTEM,
-                            sender=system_user,
-                            target=message.target,  # it is sent only to this_user
-                            content=f'banned users:\n' +
-                                    '\n'.join(user.name for user in this_user.ban_list),
-                            report=True
-                        )
-                    )
-            elif message.content == '/help':
-                this_user.send_system_message_async('''chat commands:
-/create <group_name>    create a new group
-/leave                  leave this group
-/invite <user_name>     send a group invite
-/accept <group_name>    accept a group invite
-/users                  show users in this group
-/banned                 show ban list
-/ban <user_name>        ban user
-/kick <user_name>       kick user from this group
-/help                   show commands
-''')
-                continue
-            elif message.content.startswith('/invite '):
-                user_name = message.content[8:].strip()
-                if not isinstance(message.target, Group):
-                    this_user.send_system_message_async("target is not a group")
-                    continue
-                group = message.target
-                if len(user_name) <= 0:
-                    this_user.send_system_message_async("no username provided try /help command")
-                    continue
-
-                if not group:
-                    this_user.send_system_message_async("group no longer exists")
-                    this_user.send_system_message(f"/switch {global_group.name}")
-                    continue
-                if group.locked and group.admin is not this_user:
-                    this_user.send_system_message_async(
-                        "you can't send invites, this group is locked and you are not the admin")
-                    continue
-                user = None
-                with server_state_lock.for_write():
-                    for u in users:
-                        if u.name == user_name:
-                            user = u
-                            break
-                        if user_name in reserved_names:
-                            user = None
-                    if not user:
-                        this_user.send_system_message_async(f"user not found:{user_name}")
-                        continue
-                    if user == this_user:
-                        this_user.send_system_message_async(
-                            f"you can't invite yourself, you're already in group {group.name}")
-                        continue
-                    if user in this_user.ban_list:
-                        this_user.send_system_message_async(f"{user.name} is in your ban list")
-                        continue
-                    group.pending_invites.append(Invite(user=user, invited_by=this_user))
-                user.send_system_message_async(
-                    f"you was invited by {user.name} to join group {group.name} type \"/accept {group.name}\" to join")
-                this_user.send_system_message_async(f"invite was sent to {user.name}")
-            elif message.content.startswith('/kick '):
-                user_name = message.content[6:].strip()
-                sep = user_name.find(' ')
-                reason = ''
-                if sep != -1:
-                    user_name = user_name[:sep]
-                    reason = 'reason: ' + message.content[6:].strip()[sep:].strip()
-                if not isinstance(message.target, Group):
-                    this_user.send_system_message_async("target is not a group")
-                    continue
-                group = message.target
-                if len(user_name) <= 0:
-                    this_user.send_system_message_async("no username provided try /help command")
-                    continue
-
-                if not group:
-                    this_user.send_system_message_async("group no longer exists")
-                    this_user.send_system_message(f"/switch {global_group.name}")
-                    continue
-                user = None
-                with server_state_lock.for_write():
-                    if group.admin is not this_user:
-                        this_user.send_system_message_async(
-                            f"can't kick {user_name} you are not the admin of {group.name}")
-                        continue
-                    for u in group.users:
-                        if u.name == user_name:
-                            user = u
-                            break
-                    if user is None:
-                        this_user.send_system_message_async(f"{user_name} is not in your group {group.name}")
-                        continue
-                    elif user == this_user:
-                        this_user.send_system_message_async("you can't kick your self, use /leave")
-                        continue
-                    group.remove_user(user, f"{user.name} was kicked from the group")
-                    user.send_system_message_async(f"you was kicked by the admin from group {group.name} {reason}")
-                    user.send_system_message_async(f"/switch {global_group.name}")
-                    this_user.send_system_message_async(f"{user.name} was kicked")
-            elif message.content.startswith('/ban '):
-                user_name = message.content[4:].strip()
-                if not isinstance(message.target, Group):
-                    this_user.send_system_message_async("target is not a group")
-                    continue
-                if len(user_name) <= 0:
-                    this_user.send_system_message_async("no username provided try /help command")
-                    continue
-
-                with server_state_lock.for_write():
-                    user = None
-                    for u in users:
-                        if u.name == user_name:
-                            user = u
-                            break
-                    if not user:
-                        this_user.send_system_message_async(f"user {user.name} does not exist")
-                        continue
-                    for group in this_user.groups:
-                        if this_user == group.admin and this_user in group.users and user in group.users:
-                            group.remove_user(user, f"{user.name} was banned by the admin")
-                            user.send_system_message_async(f"you was kicked from group {group.name}, because the admin banned you")
-                    this_user.ban_list.append(user)
-                    this_user.send_system_message_async(f"{user.name} is now in your ban list")
-            elif message.content.startswith('/accept '):
-                group_name = message.content[8:].strip()
-                if len(group_name) <= 0:
-                    this_user.send_system_message_async("no group name provided try /help command")
-                    continue
-                group = None
-                with server_state_lock.for_write():
-                    for gr in groups:
-                        if gr.name == group_name:
-                            group = gr
-                            break
-                    invite: Optional[Invite] = None
-                    if group:
-                        for i in reversed(range(len(group.pending_invites))):
-                            if group.pending_invites[i].user == this_user:
-                                if invite is None:
-                                    invite = group.pending_invites[i]
-                                elif group.pending_invites[i].invited_by == group.admin:
-                                    invite = group.pending_invites[i]
-                                    # TODO: clear invite list in kick command or leave command
-                                group.pending_invites.pop(i)  # consume all invites
-                    invalid = group is None or invite is None or (group.locked and invite.invited_by is not group.admin)
-
-                    if invalid:
-                        this_user.send_system_message_async("invite expired or group does not exist")
-                        continue
-                    if this_user in group.admin.ban_list:
-                        this_user.send_system_message(f"You are banned by the group admin and can't join {group.name}")
-                        continue
-                    group.join_user(this_user, f"{user.name} has entered the group" if group is not global_group else f"{user.name} has re-entered the group")
-                    this_user.send_system_message(f"/switch {group.name}")
-            else:
-                with server_state_lock.for_read():
-                    if isinstance(message.target, Group) and this_user not in message.target.users:
-                        this_user.send_system_message_async(f"group {message.target_str} does not exist, or not subscribed")
-                        continue
-                    if isinstance(message.target, ServerUser):
-                        this_user.send_system_message_async(
-                            f"You're whispering to {message.target.name}: {message.content}")
-                    if isinstance(message.target, ServerUser) and this_user in message.target.ban_list:
-                        this_user.send_system_message_async(f"you are banned by {message.target.name}")
-                        continue
-                    if isinstance(message.target, ServerUser) and message.target in this_user.ban_list:
-                        this_user.send_system_message_async(f"you banned {message.target.name}")
-                        continue
-                    if isinstance(message.target, Group) and this_user in message.target.admin.ban_list:
-                        this_user.send_system_message_async(f"you are banned by {message.target.name}'s admin")
-                        continue
-                if message.content.strip() == '':
-                    this_user.send_system_message_async("empty message")
-                    continue
-                # forward to target(s)
-                message.target.send_bytes_async(
-                    ServerMessage.to_client(
-                        target_context=message.target_context,
-                        sender_context=Message.CONTEXT_USER,
-                        target=message.target,
-                        sender=this_user,
-                        content=message.content,
-                        report=True
-                    )
-                )
+            this_user.last_seen = time.monotonic()
+            dispatch(this_user, messages)
     except BaseException:
-        thread_print(f"error in handler for {full_address} ({this_user.name}), cause: {traceback.format_exc()}")
+        log.exception("error in handler for %s (%s)", full_address, this_user.name)
     finally:
-        with server_state_lock.for_write():
-            if this_user in users:
-                users.remove(this_user)
-            for j in reversed(range(len(groups))):
-                removed = False
-                if this_user in groups[j].users:
-                    groups[j].remove_user(this_user, f"{this_user.name} has disconnected")
-                    if len(groups[j].users) == 0 and groups[j] is not global_group:
-                        thread_print(f"abandoned group was removed: {groups[j].name}")
-                        groups.pop(j)
-                        removed = True
-                if not removed:
-                    for i in reversed(range(len(groups[j].pending_invites))):
-                        if groups[j].pending_invites[i].user == this_user:
-                            groups[j].pending_invites.pop(i)
+        logout(this_user)
+        if reaper is not None:
+            unwatch(this_user)
         socket.close()
+        admission.release()
 
 
-def server():
-    import sys
-    args = parse_args(sys.argv[1:])
-    host = args.get('host', '0.0.0.0')  # default all networks
+async def handle_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, full_address: str):
+    """
+    same as handle_client but runs as a task on the asyncio engine's event loop
+    """
+    this_user = AsyncServerUser(system_user, senders, writer)
+    this_user.rate_limit = user_limits.new() if user_limits else None
+    this_user.print_network = True
+    if reaper is not None:
+        watch(this_user)
     try:
-        port = int(args.get('port', 50600))
-    except ValueError as e:
-        print("port parse failed, expected integer")
-        raise e
+        this_user.send_system_message("choose a username")
+        this_user.send_system_message("/req username")
+
+        while True:
+            try:
+                message = await ServerMessage.from_client_async(reader, report_from=this_user)
+            except ConnectionError as err:
+                log.info("user %s disconnected, cause: %s", this_user.name, err)
+                return
+            this_user.last_seen = time.monotonic()
+            if message.target_context == Message.CONTEXT_SYSTEM:
+                if message.content != PONG:
+                    hello(this_user, message.content)
+            elif await login_async(this_user, message.content):
+                break
+
+        while True:
+            try:
+                message = await ServerMessage.from_client_async(reader, report_from=this_user)
+            except ConnectionError as err:
+                log.info("user %s disconnected, cause: %s", this_user.name, err)
+                break
+            this_user.last_seen = time.monotonic()
+            await dispatch_async(this_user, message)
+            # readexactly does not yield while data is buffered, let the writers run before the next message
+            await asyncio.sleep(0)
+    except BaseException:
+        log.exception("error in handler for %s (%s)", full_address, this_user.name)
+    finally:
+        logout(this_user)
+        if reaper is not None:
+            unwatch(this_user)
+        writer.close()
+        admission.release()
+
+
+def refuse(socket: sockets.socket, reason: str):
+    metrics.connections_refused.labels(reason).inc()
+    try:
+        socket.setblocking(False)  # a storm of refusals must not wait on any of them
+        socket.send(REFUSALS[reason])
+    except OSError:
+        pass
+    socket.close()
 
+
+def serve_threads(host: str, port: int, reuse_port=False):
     server_socket = sockets.socket(sockets.AF_INET, sockets.SOCK_STREAM)
     server_socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEADDR, 1)
+    if reuse_port:
+        # every worker listens on the port, the kernel spreads the connections over them
+        server_socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEPORT, 1)
 
     server_socket.bind((host, port))
 
-    server_socket.listen(5)
-    print("chat server is listening in {}:{} press Ctrl+C to stop".format(host, port))
-    max_users = 30  # protect the server
+    server_socket.listen(listen_backlog)
+    log.info("chat server is listening in %s:%s press Ctrl+C to stop", host, port)
 
     try:
         while True:
             client_socket, address = server_socket.accept()
-            with server_state_lock.for_write():
-                if len(users) > max_users:
-                    client_socket.send("SERVER_FULL".encode("utf-8"))
-                    client_socket.close()
-                    continue
-                print('Accepted:', address[0], ':', address[1])
-                # Start a new thread and return its identifier
-                c_thread = threading.Thread(target=handle_client,
-                                            args=(client_socket, address[0] + ':' + str(address[1])))
-                c_thread.daemon = True
-                c_thread.name = 'client-loop'
+            refused = admission.admit(address[0])
+            if refused is not None:
+                refuse(client_socket, refused)
+                continue
+            log.info('accepted %s:%s', address[0], address[1])
+            # Start a new thread and return its identifier
+            c_thread = threading.Thread(target=handle_client,
+                                        args=(client_socket, address[0] + ':' + str(address[1])))
+            c_thread.daemon = True
+            c_thread.name = 'client-loop'
+            try:
                 c_thread.start()
+            except RuntimeError:
+                # out of threads, handle_client never runs to release the connection
+                admission.release()
+                refuse(client_socket, Admission.FULL)
     finally:
         server_socket.close()
 
 
+async def serve_asyncio(host: str, port: int, reuse_port=False):
+    """
+    single event loop engine, every connection is a task instead of a thread
+    """
+
+    async def accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info('peername')
+        refused = admission.admit(address[0])
+        if refused is not None:
+            metrics.connections_refused.labels(refused).inc()
+            writer.write(REFUSALS[refused])
+            writer.close()
+            return
+        log.info('accepted %s:%s', address[0], address[1])
+        await handle_client_async(reader, writer, address[0] + ':' + str(address[1]))
+
+    async_server = await asyncio.start_server(accept, host, port, reuse_address=True, reuse_port=reuse_port,
+                                              backlog=listen_backlog)
+    log.info("chat server (asyncio) is listening in %s:%s press Ctrl+C to stop", host, port)
+    async with async_server:
+        await async_server.serve_forever()
+
+
+def configure_admission(args: Dict[str, str], engine: str):
+    """
+    max_users=N open connections at most, listen_backlog=N connections may wait for accept in the kernel.
+    ip_rate=R lets one address open R connections per second after a burst of ip_burst=N, off by default
+    """
+    global admission, listen_backlog
+    try:
+        # protect the server, one thread per user is much heavier than one task per user
+        max_users = int(args.get('max_users', 30 if engine == 'threads' else 10000))
+        listen_backlog = int(args.get('listen_backlog', listen_backlog))
+        ip_rate = float(args.get('ip_rate', 0))
+        ip_burst = float(args.get('ip_burst', max(ip_rate * 2, 1)))
+    except ValueError as e:
+        print("max_users, listen_backlog, ip_rate and ip_burst expect numbers")
+        raise e
+    admission = Admission(max_users, ip_rate, ip_burst)
+
+
+def parse_limits(args: Dict[str, str], scope: str, limits: Limits) -> Optional[Limits]:
+    """
+    the scope_rate, scope_burst, scope_byte_rate and scope_byte_burst options over limits, None if a rate is 0
+    """
+    try:
+        parsed = Limits(*(float(args.get(f'{scope}_{name}', default))
+                          for name, default in zip(('rate', 'burst', 'byte_rate', 'byte_burst'), limits)))
+    except ValueError as e:
+        print(f"{scope}_rate, {scope}_burst, {scope}_byte_rate and {scope}_byte_burst expect numbers")
+        raise e
+    return parsed if parsed.message_rate > 0 and parsed.byte_rate > 0 else None
+
+
+def configure_rate_limits(args: Dict[str, str]):
+    """
+    messages and bytes a second one user may send with user_rate=R user_burst=N user_byte_rate=R
+    user_byte_burst=N, and the members of one group together with the same options starting with group_.
+    a rate of 0 turns that limit off, rate_limit=off turns both off
+    """
+    global user_limits, group_limits
+    if args.get('rate_limit', 'on') == 'off':
+        user_limits = group_limits = None
+    else:
+        user_limits = parse_limits(args, 'user', user_limits)
+        group_limits = parse_limits(args, 'group', group_limits)
+    global_group.rate_limit = group_limits.new() if group_limits else None
+
+
+def configure_heartbeat(args: Dict[str, str]):
+    """
+    idle_timeout=seconds of silence before a connection that agreed to the heartbeat is pinged, 0 never pings.
+    ping_timeout=seconds it then has to send anything. quiet_timeout=seconds of silence before a client that can't
+    answer pings is dropped, 0 (the default) keeps it
+    """
+    global idle_timeout, ping_timeout, quiet_timeout, reaper
+    try:
+        idle_timeout = float(args.get('idle_timeout', idle_timeout))
+        ping_timeout = float(args.get('ping_timeout', ping_timeout))
+        quiet_timeout = float(args.get('quiet_timeout', quiet_timeout))
+    except ValueError as e:
+        print("idle_timeout, ping_timeout and quiet_timeout parse failed, expected numbers")
+        raise e
+    timeouts = [timeout for timeout in (idle_timeout, ping_timeout, quiet_timeout) if timeout > 0]
+    if idle_timeout <= 0 and quiet_timeout <= 0:
+        return
+    # a deadline fires up to one tick late, a tick much shorter than the timeouts keeps that small
+    reaper = TimerWheel(tick=min(1.0, max(0.05, min(timeouts) / 8)))
+    reaper.start(lambda user: run_logged(check_idle, user), name='reaper')
+
+
+def run_logged(function: Callable, *args):
+    try:
+        function(*args)
+    except Exception:
+        log.exception("%s failed", function.__name__)
+
+
+def configure_outbound(args: Dict[str, str]):
+    """
+    per user outbound limits, what to do with consumers that can't keep up and how long a burst may gather
+    before it is written (flush_window_us, 0 writes right away)
+    """
+    global send_timeout
+    try:
+        OutboundQueue.MAX_FRAMES = int(args.get('outbound_frames', OutboundQueue.MAX_FRAMES))
+        OutboundQueue.MAX_BYTES = int(args.get('outbound_bytes', OutboundQueue.MAX_BYTES))
+        OutboundQueue.FLUSH_WINDOW = int(args.get('flush_window_us', 0)) / 1_000_000
+        send_timeout = float(args.get('send_timeout', send_timeout))
+    except ValueError as e:
+        print("outbound_frames, outbound_bytes, flush_window_us and send_timeout expect numbers")
+        raise e
+    policy = args.get('slow_consumer', OutboundQueue.POLICY)
+    if policy not in OutboundQueue.POLICIES:
+        raise ValueError(f"unknown slow_consumer policy {policy}, expected one of {', '.join(OutboundQueue.POLICIES)}")
+    OutboundQueue.POLICY = policy
+
+
+def configure_compression(args: Dict[str, str]):
+    """
+    compression=off refuses it to every client, compress_threshold=N bytes leaves smaller batches uncompressed
+    """
+    global compression_methods, compress_threshold
+    if args.get('compression', 'on') == 'off':
+        compression_methods = ()
+    try:
+        compress_threshold = int(args.get('compress_threshold', compress_threshold))
+    except ValueError as e:
+        print("compress_threshold parse failed, expected integer")
+        raise e
+
+
+def configure_usernames(args: Dict[str, str]):
+    """
+    suggest_names=path offers the names of a word list, one per line, when the asked username is taken
+    """
+    global username_suggestions
+    if 'suggest_names' in args:
+        username_suggestions = NameSuggestions.load(args['suggest_names'])
+        log.info("%s names to suggest were loaded from %s", len(username_suggestions.words), args['suggest_names'])
+
+
+def configure_protocol(args: Dict[str, str]):
+    """
+    max_frame_bytes=N drops clients that announce a bigger v2 frame before any of it is read
+    """
+    try:
+        frame_codec.MAX_FRAME_SIZE = int(args.get('max_frame_bytes', frame_codec.MAX_FRAME_SIZE))
+    except ValueError as e:
+        print("max_frame_bytes parse failed, expected integer")
+        raise e
+    if frame_codec.MAX_FRAME_SIZE > OutboundQueue.MAX_BYTES:
+        log.warning("max_frame_bytes is over outbound_bytes, the biggest messages will be dropped")
+
+
+def configure_metrics(args: Dict[str, str], port_offset=0):
+    """
+    metrics_port=N serves prometheus metrics on http://metrics_host:N/metrics, off by default
+    """
+    if 'metrics_port' not in args:
+        return
+    try:
+        port = int(args['metrics_port']) + port_offset
+    except ValueError as e:
+        print("metrics_port parse failed, expected integer")
+        raise e
+    host = args.get('metrics_host', '127.0.0.1')  # local only unless asked
+    metrics.serve_http(host, port)
+    log.info("metrics are served on http://%s:%s/metrics", host, port)
+
+
+def configure_history(args: Dict[str, str]):
+    """
+    history_dir=path keeps a log of every group message there, off by default.
+    whispers are only kept in memory, until either user disconnects
+    """
+    global history, history_replay
+    if 'history_dir' not in args:
+        return
+    try:
+        history_replay = int(args.get('history_replay', history_replay))
+        segment_bytes = int(args.get('history_segment_bytes', 1024 * 1024))
+        max_segments = int(args.get('history_segments', 8))
+    except ValueError as e:
+        print("history_replay, history_segment_bytes and history_segments expect numbers")
+        raise e
+    # a segment has room for the biggest frame, and a log keeps at least the segment it appends to
+    segment_bytes = max(segment_bytes, frame_codec.MAX_FRAME_SIZE + 1024)
+    max_segments = max(max_segments, 1)
+    history = History(args['history_dir'], segment_bytes=segment_bytes, max_segments=max_segments)
+    log.info("message history is kept in %s", os.path.abspath(args['history_dir']))
+
+
+def configure_cluster(args: Dict[str, str]):
+    """
+    broker=address makes this process node node_id=N of a cluster, address is host:port, unix:path or local.
+    broker_listen=address also runs the hub in this process, it waits for nodes=M nodes before the cluster starts
+    a node that stops takes its users with it, started again with the same node_id it catches up and rejoins
+    """
+    global broker, node_id
+    if 'broker_listen' in args:
+        try:
+            nodes = int(args.get('nodes', 1))
+        except ValueError as e:
+            print("nodes parse failed, expected integer")
+            raise e
+        BusHub(parse_address(args['broker_listen']), nodes).run_in_thread()
+        log.info("broker hub is listening on %s for %s nodes", args['broker_listen'], nodes)
+    address = args.get('broker', args.get('broker_listen'))
+    if address is None:
+        return
+    try:
+        node_id = int(args.get('node_id', 0))
+    except ValueError as e:
+        print("node_id parse failed, expected integer")
+        raise e
+    broker = connect(address, node_id, on_broker_event)
+    broker.start()
+    broker.started.wait()  # the state starts out the same on every node only if none of them missed an event
+    log.info("node %s joined the cluster", node_id)
+
+
+def serve_workers(workers: int, argv: List[str]):
+    """
+    supervisor of workers=N, runs the bus hub and N worker processes that listen on the same port
+    """
+    if not hasattr(sockets, 'SO_REUSEPORT') or not hasattr(sockets, 'AF_UNIX'):
+        raise ValueError("workers need SO_REUSEPORT and unix sockets, this platform can only run one process")
+    path = os.path.join(tempfile.gettempdir(), f'chat-bus-{os.getpid()}.sock')
+    BusHub(path, workers).run_in_thread()
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), *argv, f'node_id={i}',
+                                   f'broker=unix:{path}']) for i in range(workers)]
+    atexit.register(stop_workers, processes, path)
+    log.info("started %s workers", workers)
+    while all(process.poll() is None for process in processes):
+        time.sleep(0.5)
+    # the users of a dead worker would stay in the state of the others
+    log.error("a worker exited, stopping the server")
+    stop_workers(processes, path)
+
+
+def stop_workers(processes: List[subprocess.Popen], path: str):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    if os.path.exists(path):
+        os.remove(path)  # left behind if a worker never connected
+
+
+def server():
+    args = parse_args(sys.argv[1:])
+    host = args.get('host', '0.0.0.0')  # default all networks
+    try:
+        port = int(args.get('port', 50600))
+    except ValueError as e:
+        print("port parse failed, expected integer")
+        raise e
+    engine = args.get('engine', 'threads')
+    if engine not in ('threads', 'asyncio'):
+        raise ValueError(f"unknown engine {engine}, expected threads or asyncio")
+    try:
+        workers = int(args.get('workers', 1))
+    except ValueError as e:
+        print("workers parse failed, expected integer")
+        raise e
+    clustered = workers > 1 or 'broker' in args or 'broker_listen' in args
+    if clustered and 'history_dir' in args:
+        raise ValueError("history_dir works on a single node only, the nodes would each keep part of the messages")
+    if workers > 1 and 'node_id' not in args:
+        if 'broker' in args or 'broker_listen' in args:
+            raise ValueError("workers run their own broker, give every process of a cluster its own node_id instead")
+        serve_workers(workers, sys.argv[1:])
+        return
+
+    reuse_port = workers > 1  # a worker of serve_workers
+    configure_cluster(args)
+    configure_admission(args, engine)
+    configure_rate_limits(args)
+    configure_heartbeat(args)
+    configure_outbound(args)
+    configure_compression(args)
+    configure_protocol(args)
+    configure_usernames(args)
+    configure_metrics(args, node_id if reuse_port else 0)  # workers serve their own metrics on consecutive ports
+    configure_history(args)
+
+    if engine == 'asyncio':
+        asyncio.run(serve_asyncio(host, port, reuse_port))
+    else:
+        serve_threads(host, port, reuse_port)
+
+
 def main():
+    args = parse_args(sys.argv[1:])
+    try:
+        trace_sample = int(args.get('trace_sample', 1))
+    except ValueError as e:
+        print("trace_sample parse failed, expected integer")
+        raise e
+    # log_level=trace reports every message sent and received, trace_sample=N keeps one of every N reports
+    log_writer = setup_logging(args.get('log_level', 'info'), trace_sample)
     t = threading.Thread(target=server)
     t.daemon = True
     t.start()
     soft_join(t)
     print('\n! Received keyboard interrupt, server will stop, client threads will be dropped.\n')
+    log.info('slow consumer policy fired: %s', ', '.join(f'{k}={v}' for k, v in OutboundQueue.stats().items()))
+    log_writer.stop()
 
 
 if __name__ == '__main__':
@@ -1,14 +1,22 @@
+import asyncio
 import random
 import socket as sockets
-import traceback
+import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Union, Optional
-
-from termcolor import colored
+from typing import List, Union, Optional, Dict, Tuple
 
+import frame_codec
+import metrics
 from BufferedSocketStream import BufferedSocketStream
+from compression import Deflater
+from frame_codec import encode_name, encode_client_frame, encode_client_frame_v2, server_head, \
+    decode_client_frame, decode_client_frames, decode_server_frame_v2, frame2_size, Frame, FrameError, CLIENT_HEAD, \
+    CLIENT2_HEAD, CONTENT_SIZE, FRAME2_HEAD, SIG, SIG2, SIG_BYTES
+from IOWaiter import IOWaiter
+from OutboundQueue import OutboundQueue
+from rate_limit import RateLimit
 from ReentrantRWLock import ReentrantRWLock
-from lib import thread_print
+from lib import log, send_buffers, send_buffers_nowait, TRACE
 
 
 class DisconnectedError(Exception):
@@ -16,29 +24,126 @@ class DisconnectedError(Exception):
 
 
 class User:
+    wait_for_send = True  # send_bytes waits for the write, off where the caller must never block on one peer
+    # set where writes must never block a pool thread: a peer that takes no data for that long is dropped
+    send_timeout: Optional[float] = None
+
     def __init__(self, senders: ThreadPoolExecutor, socket: sockets.socket, username=None):
         self.socket = socket
-        self.socket_lock = ReentrantRWLock()
         self.name = username if username is not None else 'user-' + str(random.randint(1, 9999))
         self.senders = senders
+        self.outbound = OutboundQueue(self.write_frames, senders.submit, self.on_send_error, self.on_send_overflow)
+        self.deflater: Optional[Deflater] = None  # set when the client asked for compression
+        self.protocol = 1  # wire protocol version, raised by the hello
+        self.rate_limit: Optional[RateLimit] = None  # checked on every message received from the user
+        self.limit_reported_at = 0.0  # monotonic time the user was last told a message was dropped
+        self.unsent: List[bytes] = []  # what a non-blocking write could not send, written before anything else
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, name: str):
+        self._name = name
+        self.name_field = encode_name(name)  # encoded once, reused by every frame that names this user
 
     def join_group(self, group):
         group.join_user(self)
 
-    def send_bytes_async(self, data: bytes):
-        return self.senders.submit(user_send, self, data)
-
-    def send_bytes(self, data: bytes):
-        with self.socket_lock.for_write():
-            self.socket.send(data)
+    def send_bytes_async(self, data: Union[bytes, Tuple[bytes, ...], Frame]):
+        self.outbound.put(data)
+
+    def send_bytes(self, data: Union[bytes, Tuple[bytes, ...], Frame]):
+        if not self.outbound.put(data, wait=self.wait_for_send):
+            raise DisconnectedError(f"could not send to user {self.name}")
+
+    def write_frames(self, frames: List[bytes]):
+        """
+        called by the outbound queue writer only, one writer per user at a time
+        """
+        buffers = self.compress(OutboundQueue.buffers(frames, self.protocol))
+        metrics.frames_out.inc(len(frames))
+        metrics.bytes_out.inc(sum(len(buffer) for buffer in buffers))
+        # gathered by the kernel, the frames and their shared parts are never copied into one buffer
+        if self.send_timeout is None:
+            metrics.send_calls.inc(send_buffers(self.socket, buffers))
+            return True
+        return self.write_nowait(buffers)
+
+    def write_nowait(self, buffers: List[bytes]) -> bool:
+        """
+        send what the socket takes without waiting, False when the rest waits for the socket to become writable
+        """
+        calls, self.unsent = send_buffers_nowait(self.socket, buffers)
+        metrics.send_calls.inc(calls)
+        if not self.unsent:
+            return True
+        IOWaiter.shared().when_writable(self.socket, lambda: self.senders.submit(self.resume_writing),
+                                        self.send_timeout, self.on_send_stalled)
+        return False
+
+    def resume_writing(self):
+        if self.outbound.closed:
+            return
+        try:
+            done = self.write_nowait(self.unsent)
+        except BaseException as e:
+            self.outbound.close()
+            self.on_send_error(e)
+            return
+        if done:
+            self.outbound.drain()
+
+    def on_send_stalled(self):
+        if self.outbound.closed:
+            return
+        log.warning("user %s took no data for %ss, disconnecting", self.name, self.send_timeout)
+        self.disconnect()
+
+    def compress(self, buffers: List[bytes]) -> List[bytes]:
+        deflater = self.deflater
+        if deflater is None:
+            return buffers
+        compressed = deflater.encode(buffers)
+        if compressed is not buffers:
+            metrics.compression_in.inc(sum(len(buffer) for buffer in buffers))
+            metrics.compression_out.inc(sum(len(buffer) for buffer in compressed))
+        return compressed
+
+    def on_send_error(self, err: BaseException):
+        log.warning("send bytes to user %s failed, cause: %s", self.name, err)
+        self.disconnect()
+
+    def on_send_overflow(self, policy: str):
+        if policy == OutboundQueue.DISCONNECT:
+            log.warning("user %s is a slow consumer, disconnecting", self.name)
+            self.disconnect()
+        else:
+            log.warning("user %s is a slow consumer, outbound queue is full (%s)", self.name, policy)
+
+    def disconnect(self):
+        """
+        drop the connection, the reader sees it as closed and does the cleanup
+        """
+        self.outbound.close()
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(sockets.SHUT_RDWR)
+            except OSError:
+                pass
 
 
 class ServerUser(User):
     def __init__(self, system_user, senders: ThreadPoolExecutor, socket: sockets.socket = None, username=None):
         super().__init__(senders, socket, username)
-        self.groups = []
+        # dicts are used as insertion ordered sets
+        self.groups: Dict[Group, None] = {}
         self.system_user = system_user
-        self.ban_list: List[ServerUser] = []
+        self.ban_list: Dict[ServerUser, None] = {}
+        self.invited_to: Dict[Group, None] = {}  # groups holding a pending invite for this user
+        self.last_seen = time.monotonic()  # when the last frame was received, read by the idle reaper
+        self.heartbeat = False  # its hello agreed to answer pings
 
     def send_system_message_async(self, message: str):
         self.send_bytes_async(
@@ -65,6 +170,74 @@ class ServerUser(User):
         )
 
 
+class AsyncServerUser(ServerUser):
+    """
+    user served by the asyncio engine, writes are buffered by the event loop transport instead of blocking
+    """
+
+    def __init__(self, system_user, senders: ThreadPoolExecutor, writer: asyncio.StreamWriter, username=None):
+        super().__init__(system_user, senders, writer.get_extra_info('socket'), username)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        # the transport buffers writes, so the event loop itself is the writer
+        self.outbound = OutboundQueue(self.write_frames, self.loop.call_soon_threadsafe, self.on_send_error,
+                                      self.on_send_overflow, schedule_later=self.call_later)
+
+    def send_bytes(self, data: Union[bytes, Tuple[bytes, ...], Frame]):
+        # never wait here, this may run on the event loop thread that does the writing
+        if not self.outbound.put(data):
+            raise DisconnectedError(f"could not send to user {self.name}")
+
+    def call_later(self, delay: float, function):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, function)
+
+    def write_frames(self, frames: List[bytes]):
+        if self.writer.is_closing():
+            raise DisconnectedError("connection closed")
+        buffers = self.compress(OutboundQueue.buffers(frames, self.protocol))
+        self.writer.writelines(buffers)
+        metrics.send_calls.inc()  # the transport writes what fits right away, the rest when the socket is writable
+        metrics.frames_out.inc(len(frames))
+        metrics.bytes_out.inc(sum(len(buffer) for buffer in buffers))
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            # the peer is not keeping up, leave the next frames in the outbound queue where its limits apply
+            self.loop.create_task(self.resume_writing())
+            return False
+        return True
+
+    async def resume_writing(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.outbound.close()
+            return
+        self.outbound.drain()
+
+    def disconnect(self):
+        self.outbound.close()
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+
+class RemoteUser(ServerUser):
+    """
+    replica of a user connected to another node of the cluster, that node does all the sending to it
+    """
+
+    def __init__(self, system_user, senders: ThreadPoolExecutor, username: str, node: int):
+        super().__init__(system_user, senders, None, username)
+        self.node = node
+
+    def send_bytes_async(self, data: Union[bytes, Tuple[bytes, ...], Frame]):
+        pass
+
+    def send_bytes(self, data: Union[bytes, Tuple[bytes, ...], Frame]):
+        pass
+
+    def disconnect(self):
+        pass
+
+
 class Invite:
     def __init__(self, user: ServerUser, invited_by: ServerUser):
         self.user = user
@@ -72,12 +245,23 @@ class Invite:
 
 
 class Group:
+    """
+    members, admin and invites of a group are guarded by its own state_lock so groups don't block each other.
+    lock order is the server state lock first then one group lock, never two groups at once
+    """
+
     def __init__(self, name: str, system_user: ServerUser, senders: ThreadPoolExecutor):
-        self.users: List[ServerUser] = []
+        self.state_lock = ReentrantRWLock()
+        self.state_lock.on_wait = metrics.lock_wait.labels('group').observe
+        self.removed = False  # set under both locks when the registry dropped the group
+        self.users: Dict[ServerUser, None] = {}  # insertion ordered set, the first user inherits the admin
+        self.members: Tuple[ServerUser, ...] = ()  # snapshot of users for fan-out, replaced on every change
         self.admin = None
         self.name = name
+        self.name_field = encode_name(name)
         self.locked = False
-        self.pending_invites: List[Invite] = []
+        self.pending_invites: Dict[ServerUser, List[Invite]] = {}  # invites by invited user
+        self.rate_limit: Optional[RateLimit] = None  # shared by every member sending to the group
         self.senders = senders
         self.system_user = system_user
 
@@ -90,13 +274,19 @@ class Group:
         self.send_system_message_async("group invites are now locked")
 
     def send_bytes_async(self, data: bytes):
-        for user in self.users:
-            self.senders.submit(group_send, self, user, data)
+        # members is immutable, joins and leaves in other threads don't disturb the fan-out
+        members = self.members
+        metrics.fanout.observe(len(members))
+        for user in members:
+            user.send_bytes_async(data)
 
-    def join_user(self, user: ServerUser, report: str):
+    def join_user(self, user: ServerUser, report: Optional[str]):
         assert user not in self.users, "can't join two times"
-        self.users.append(user)
-        user.groups.append(self)
+        self.users[user] = None
+        self.members = tuple(self.users)
+        user.groups[self] = None
+        if report is None:
+            return
         self.send_bytes_async(
             ServerMessage.to_client(
                 target_context=ServerMessage.CONTEXT_GROUP,
@@ -110,8 +300,9 @@ class Group:
 
     def remove_user(self, user: ServerUser, report: str):
         assert user in self.users, "remove_user: user not joined"
-        self.users.remove(user)
-        user.groups.remove(self)
+        del self.users[user]
+        self.members = tuple(self.users)
+        del user.groups[self]
         if len(self.users) > 0:
             self.send_bytes_async(
                 ServerMessage.to_client(
@@ -124,7 +315,7 @@ class Group:
                 )
             )
             if self.admin == user:
-                self.admin = self.users[0]
+                self.admin = self.members[0]
                 self.send_bytes_async(
                     ServerMessage.to_client(
                         target_context=ServerMessage.CONTEXT_GROUP,
@@ -136,6 +327,25 @@ class Group:
                     )
                 )
 
+    def add_invite(self, invite: Invite):
+        self.pending_invites.setdefault(invite.user, []).append(invite)
+        invite.user.invited_to[self] = None
+
+    def take_invites(self, user: ServerUser) -> List[Invite]:
+        """
+        remove and return the pending invites of user, oldest first
+        """
+        user.invited_to.pop(self, None)
+        return self.pending_invites.pop(user, [])
+
+    def drop_invites_not_from(self, invited_by: ServerUser):
+        for user in list(self.pending_invites):
+            invites = [invite for invite in self.pending_invites[user] if invite.invited_by is invited_by]
+            if invites:
+                self.pending_invites[user] = invites
+            else:
+                self.take_invites(user)
+
     def send_system_message_async(self, message: str):
         self.send_bytes_async(
             ServerMessage.to_client(
@@ -149,18 +359,48 @@ class Group:
         )
 
 
-def group_send(grp: Group, usr: ServerUser, dt: bytes):
-    try:
-        usr.send_bytes(dt)
-    except BaseException as e:
-        thread_print(f"group {grp.name} send fail to user {usr.name} cause {str(e)} data: {dt.decode('utf-8')}")
+class ServerRegistry:
+    """
+    users and groups of the server indexed by name, callers hold the server state lock.
+    the lock guards only these indexes, the state of each group is behind the group's own lock.
+    users and groups share one namespace when resolving a message target, groups win
+    """
+
+    def __init__(self):
+        self.users: Dict[str, ServerUser] = {}
+        self.groups: Dict[str, Group] = {}
+
+    def add_user(self, user: ServerUser):
+        assert user.name not in self.users, f"user {user.name} already registered"
+        self.users[user.name] = user
+
+    def remove_user(self, user: ServerUser):
+        if self.users.get(user.name) is user:
+            del self.users[user.name]
+
+    def add_group(self, group: Group):
+        assert group.name not in self.groups, f"group {group.name} already registered"
+        self.groups[group.name] = group
+
+    def remove_group(self, group: Group):
+        if self.groups.get(group.name) is group:
+            del self.groups[group.name]
+
+    def find_user(self, name: str) -> Optional[ServerUser]:
+        return self.users.get(name)
+
+    def find_group(self, name: str) -> Optional[Group]:
+        return self.groups.get(name)
+
+    def find_target(self, name: str) -> Optional[Union[Group, ServerUser]]:
+        return self.groups.get(name) or self.users.get(name)
 
 
 class Message:
     CONTEXT_USER = 1  # private
     CONTEXT_GROUP = 2  # group
     CONTEXT_SYSTEM = 3  # system
-    SIG_BYTES = (65136).to_bytes(length=2, byteorder='little')
+    SIG_BYTES = SIG_BYTES
 
 
 class ClientMessage(Message):
@@ -169,6 +409,9 @@ class ClientMessage(Message):
     sender: str
     target: str
     content: str
+    message_id: int  # 0 from a v1 server and for system messages
+    timestamp: int  # server receive time in us, 0 from a v1 server
+    flags: int
     sig: int
 
     @staticmethod
@@ -176,31 +419,36 @@ class ClientMessage(Message):
         target_context: int,
         target: str,
         content: str,
+        version=1,
     ):
-        data = bytearray()
-        data.extend(ServerMessage.SIG_BYTES)
-        data.extend(target_context.to_bytes(length=1, byteorder='little'))
-        target_bytes = target.encode('utf-8')
-        data.extend(len(target_bytes).to_bytes(length=1, byteorder='little'))
-        data.extend(target_bytes)
-        content_bytes = content.encode('utf-8')
-        data.extend(len(content_bytes).to_bytes(length=2, byteorder='little'))
-        data.extend(content_bytes)
-        return data
+        if version >= 2:
+            return encode_client_frame_v2(target_context, target, content)
+        return encode_client_frame(target_context, target, content)
 
     @staticmethod
     def from_server(reader: BufferedSocketStream):
+        return reader.read_frame(ClientMessage.parse)
+
+    @staticmethod
+    def parse(view: memoryview):
+        """
+        parse a server to client frame at the start of view,
+        returns (message, frame size) or the number of bytes needed to complete the frame
+        """
+        decoded = decode_server_frame_v2(view)
+        if type(decoded) is int:
+            return decoded
+        return ClientMessage.from_frame(decoded[0]), decoded[1]
+
+    @staticmethod
+    def from_frame(frame: Tuple[int, int, str, str, str, int, int, int]):
         msg = ClientMessage()
-        msg.sig = reader.read(2)
-        assert msg.sig == ServerMessage.SIG_BYTES, f"Invalid message signature {msg.sig}"
-        msg.sender_context = int.from_bytes(reader.read(1), byteorder='little')
-        msg.target_context = int.from_bytes(reader.read(1), byteorder='little')
-        msg.sender = reader.read(int.from_bytes(reader.read(1), byteorder='little')).decode('utf-8')
-        msg.target = reader.read(int.from_bytes(reader.read(1), byteorder='little')).decode('utf-8')
+        msg.sig = ServerMessage.SIG_BYTES
+        (msg.sender_context, msg.target_context, msg.sender, msg.target, msg.content, msg.message_id, msg.timestamp,
+         msg.flags) = frame
         assert msg.sender_context == ServerMessage.CONTEXT_USER or msg.sender_context == ServerMessage.CONTEXT_SYSTEM, \
             "sender can only be CONTEXT_USER or CONTEXT_SYSTEM"
         assert msg.target_context == ServerMessage.CONTEXT_GROUP or msg.target_context == ServerMessage.CONTEXT_USER, f"target can only be CONTEXT_USER or CONTEXT_GROUP got {msg.target_context}"
-        msg.content = reader.read(int.from_bytes(reader.read(2), byteorder='little')).decode('utf-8')
         return msg
 
     def __str__(self):
@@ -212,14 +460,19 @@ def report_send(target_context: int,
                 sender: Union[User, Group],
                 target: Union[User, Group],
                 content: str):
-    print(f"{colored('sending message :', 'cyan')} sender:{(sender.name if sender else 'null').ljust(10)},sender_ctx={int_context_str(sender_context).ljust(10)},target_ctx={int_context_str(target_context).ljust(10)},target={(target.name if target else 'null').ljust(10)},content={(content[:15] + '...(truncated)') if len(content) > 15 else content}")
+    if log.isEnabledFor(TRACE):
+        log.log(TRACE, "send sender=%s sender_ctx=%s target_ctx=%s target=%s content=%.15r",
+                sender.name if sender else None, int_context_str(sender_context), int_context_str(target_context),
+                target.name if target else None, content)
 
 
 def report_receive(target_context: int,
                    sender: Optional[User],
                    target: str,
                    content: str):
-    print(f"{colored('received message:', 'green')} sender:{sender.name.ljust(10)},sender_ctx={'USER'.ljust(10)},target_ctx={int_context_str(target_context).ljust(10)},target={target.ljust(10)},content={(content[:15] + '...(truncated)') if len(content) > 15 else content}")
+    if log.isEnabledFor(TRACE):
+        log.log(TRACE, "receive sender=%s target_ctx=%s target=%s content=%.15r",
+                sender.name, int_context_str(target_context), target, content)
 
 
 class ServerMessage(Message):
@@ -227,6 +480,7 @@ class ServerMessage(Message):
     target: Optional[Union[ServerUser, Group]]
     target_str: str
     content: str
+    received_at: int  # us
     sig: int
 
     @staticmethod
@@ -236,42 +490,93 @@ class ServerMessage(Message):
         sender: Union[ServerUser, Group],
         target: Union[ServerUser, Group],
         content: str,
-        report: bool
-    ):
+        report: bool,
+        message_id=0,
+        timestamp: Optional[int] = None,
+    ) -> Frame:
         if report:
             report_send(target_context, sender_context, sender, target, content)
-        data = bytearray()
-        data.extend(ServerMessage.SIG_BYTES)
-        data.extend(sender_context.to_bytes(length=1, byteorder='little'))
-        data.extend(target_context.to_bytes(length=1, byteorder='little'))
-        uname_bytes = sender.name.encode('utf-8')
-        data.extend(len(uname_bytes).to_bytes(length=1, byteorder='little'))
-        data.extend(uname_bytes)
-        target_bytes = target.name.encode('utf-8')
-        data.extend(len(target_bytes).to_bytes(length=1, byteorder='little'))
-        data.extend(target_bytes)
-        content_bytes = content.encode('utf-8')
-        data.extend(len(content_bytes).to_bytes(length=2, byteorder='little'))
-        data.extend(content_bytes)
-        return data
+        return Frame(sender_context, target_context, sender.name_field, target.name_field, content.encode('utf-8'),
+                     message_id, timestamp)
+
+    @staticmethod
+    def client_header(sender_context: int, target_context: int, sender: Union[ServerUser, Group]) -> bytes:
+        """
+        SIG, contexts and sender of a server to client frame
+        """
+        return server_head(sender_context, target_context) + sender.name_field
 
     @staticmethod
     def from_client(reader: BufferedSocketStream, report_from: User = None):
+        msg = reader.read_frame(ServerMessage.parse)
+        msg.check_received(report_from)
+        return msg
+
+    @staticmethod
+    def from_client_batch(reader: BufferedSocketStream, report_from: User = None) -> List['ServerMessage']:
+        """
+        block until at least one message arrived and return every message that is buffered
+        """
+        messages = [ServerMessage.from_frame(frame) for frame in reader.read_frames(decode_client_frames)]
+        for msg in messages:
+            msg.check_received(report_from)
+        return messages
+
+    @staticmethod
+    def parse(view: memoryview):
+        """
+        parse a client to server frame at the start of view,
+        returns (message, frame size) or the number of bytes needed to complete the frame
+        """
+        decoded = decode_client_frame(view)
+        if type(decoded) is int:
+            return decoded
+        return ServerMessage.from_frame(decoded[0]), decoded[1]
+
+    @staticmethod
+    def from_frame(frame: Tuple[int, str, str]):
+        msg = ServerMessage()
+        msg.sig = ServerMessage.SIG_BYTES
+        msg.target_context, msg.target_str, msg.content = frame
+        return msg
+
+    @staticmethod
+    async def from_client_async(reader: asyncio.StreamReader, report_from: User = None):
         msg = ServerMessage()
-        msg.sig = reader.read(2)
-        assert msg.sig == ServerMessage.SIG_BYTES, f"Invalid message signature {msg.sig}"
-        msg.target_context = int.from_bytes(reader.read(1), byteorder='little')
-        msg.target_str = reader.read(int.from_bytes(reader.read(1), byteorder='little')).decode('utf-8')
-        msg.content = reader.read(int.from_bytes(reader.read(2), byteorder='little')).decode('utf-8')
+        try:
+            head = await reader.readexactly(CLIENT_HEAD.size)
+            sig, msg.target_context, target_size = CLIENT_HEAD.unpack(head)
+            msg.sig = ServerMessage.SIG_BYTES
+            if sig == SIG2:
+                head += await reader.readexactly(FRAME2_HEAD.size - CLIENT_HEAD.size)
+                frame = head + await reader.readexactly(frame2_size(head, 0, CLIENT2_HEAD.size, frame_codec.MAX_FRAME_SIZE) - FRAME2_HEAD.size)
+                (msg.target_context, msg.target_str, msg.content), _ = decode_client_frame(frame)
+                metrics.bytes_in.inc(len(frame))
+                msg.check_received(report_from)
+                return msg
+            if sig != SIG:
+                raise FrameError(f"Invalid message signature {head[:2]}")
+            target = await reader.readexactly(target_size + CONTENT_SIZE.size)
+            msg.target_str = str(target[:target_size], 'utf-8')
+            content = await reader.readexactly(CONTENT_SIZE.unpack_from(target, target_size)[0])
+            msg.content = content.decode('utf-8')
+            metrics.bytes_in.inc(CLIENT_HEAD.size + len(target) + len(content))
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionError("received 0 bytes possibly socket disconnected") from e
+        msg.check_received(report_from)
+        return msg
+
+    def check_received(self, report_from: Optional[User]):
+        self.received_at = time.time_ns() // 1000
+        metrics.frames_in.inc()
         if report_from:
             report_receive(
-                target_context=msg.target_context,
+                target_context=self.target_context,
                 sender=report_from,
-                target=msg.target_str,
-                content=msg.content,
+                target=self.target_str,
+                content=self.content,
             )
-        assert msg.target_context == ServerMessage.CONTEXT_GROUP or msg.target_context == ServerMessage.CONTEXT_USER, f"target can only be CONTEXT_USER or CONTEXT_GROUP got {msg.target_context}"
-        return msg
+        assert self.target_context in (ServerMessage.CONTEXT_GROUP, ServerMessage.CONTEXT_USER, ServerMessage.CONTEXT_SYSTEM), f"target can only be CONTEXT_USER, CONTEXT_GROUP or CONTEXT_SYSTEM got {self.target_context}"
 
     def __str__(self):
         return 'ServerMessage{' + f'TARGET_CONTEXT={int_context_str(self.target_context)},TARGET={self.target},CONTENT={self.content}' + '}'
@@ -287,13 +592,6 @@ def int_context_str(context: int):
     return 'UNKNOWN'
 
 
-def user_send(usr: ServerUser, dt: bytes):
-    try:
-        usr.send_bytes(dt)
-    except BaseException:
-        thread_print(f"send bytes to user {usr.name} failed, bytes: {dt.decode('utf-8')}, cause: {traceback.format_exc()}")
-
-
 class ClientUser(User):
     target: str
     chat_target: str
@@ -0,0 +1,106 @@
+"""
+a crowd of clients that stop reading must not hold up the others: starts a threads engine server, logs in
+STALLED users that never read again, floods the global group with big messages and times a whisper between two
+users that still read. run it with pytest or on its own
+"""
+import os
+import socket as sockets
+import subprocess
+import sys
+import time
+
+PORT = int(os.environ.get('SLOW_READERS_PORT', 50931))
+STALLED = 300
+FLOOD = 200  # messages of FLOOD_SIZE bytes to the global group
+FLOOD_SIZE = 16 * 1024
+MAX_LATENCY = 1.0  # seconds a whisper between healthy users may take
+
+SIGNATURE = (65136).to_bytes(2, 'little')
+WHISPER, GROUP = 1, 2
+
+
+def encode(context: int, target: str, content: str) -> bytes:
+    target, content = target.encode(), content.encode()
+    return SIGNATURE + bytes([context, len(target)]) + target + len(content).to_bytes(2, 'little') + content
+
+
+class Peer:
+    def __init__(self, receive_buffer=0):
+        self.socket = sockets.socket()
+        if receive_buffer:
+            self.socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_RCVBUF, receive_buffer)
+        self.socket.connect(('127.0.0.1', PORT))
+        self.socket.settimeout(10)
+        self.data = b''
+
+    def read(self, size: int) -> bytes:
+        while len(self.data) < size:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.data += data
+        read, self.data = self.data[:size], self.data[size:]
+        return read
+
+    def frame(self):
+        assert self.read(2) == SIGNATURE
+        self.read(2)  # source and target contexts
+        sender = self.read(self.read(1)[0]).decode()
+        target = self.read(self.read(1)[0]).decode()
+        return sender, target, self.read(int.from_bytes(self.read(2), 'little')).decode()
+
+    def wait_for(self, content: str, sender=None):
+        while True:
+            frame_sender, _, frame_content = self.frame()
+            if content in frame_content and sender in (None, frame_sender):
+                return
+
+    def send(self, context: int, target: str, content: str):
+        self.socket.sendall(encode(context, target, content))
+
+    def login(self, name: str) -> 'Peer':
+        self.wait_for('/req username')
+        self.send(GROUP, 'global', name)
+        self.wait_for('/set username ' + name)
+        return self
+
+
+def start_server() -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, 'server.py', f'port={PORT}', 'engine=threads',
+                               f'max_users={STALLED + 10}', 'rate_limit=off', 'idle_timeout=0'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            sockets.create_connection(('127.0.0.1', PORT)).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def test_whisper_between_healthy_users_while_peers_stop_reading():
+    server = start_server()
+    try:
+        alice, bob = Peer().login('alice'), Peer().login('bob')
+        stalled = [Peer(receive_buffer=4096).login(f'stalled{index}') for index in range(STALLED)]
+        flooder = Peer().login('flooder')
+        for index in range(FLOOD):
+            flooder.send(GROUP, 'global', f'{index:04}' + 'x' * FLOOD_SIZE)
+        flooder.wait_for(f'{FLOOD - 1:04}', sender='flooder')  # every drain of the flood has been submitted
+        started = time.monotonic()
+        alice.send(WHISPER, 'bob', 'are you there')
+        bob.wait_for('are you there', sender='alice')
+        latency = time.monotonic() - started
+        assert latency < MAX_LATENCY, f"whisper took {latency:.2f}s with {STALLED} peers not reading"
+        for peer in stalled:
+            peer.socket.close()
+    finally:
+        server.terminate()
+        server.wait(5)
+
+
+if __name__ == '__main__':
+    test_whisper_between_healthy_users_while_peers_stop_reading()
+    print("ok")
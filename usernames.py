@@ -0,0 +1,90 @@
+"""
+usernames of the server: the rule a name has to follow, the index that gives each name to one user at a time
+and the free names offered when the asked one is taken
+"""
+import bisect
+import re
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+# a frame gives a name one size byte
+USERNAME = re.compile(r'[a-z][a-z0-9_-]{0,253}[a-z0-9]')
+RULE = "name must begin with a-z letter and contain a-z0-9 '_' or '-' and end with a-z0-9"
+
+
+def valid_username(name: str) -> bool:
+    return USERNAME.fullmatch(name) is not None
+
+
+class NameReservations:
+    """
+    owner of every name in use, a name is reserved before its user joins and stays reserved until it leaves.
+    the check and the reservation are one step under a lock of their own, logins never wait on the server state lock
+    """
+
+    def __init__(self, reserved: Iterable[str] = (), owner=None):
+        self.owners: Dict[str, object] = {name: owner for name in reserved}
+        self._lock = threading.Lock()
+
+    def reserve(self, name: str, owner) -> bool:
+        """
+        False if someone else holds the name
+        """
+        with self._lock:
+            return self.owners.setdefault(name, owner) is owner
+
+    def assign(self, name: str, owner):
+        """
+        hand the name to owner even if it is reserved, for the cluster broker that decides who got it
+        """
+        with self._lock:
+            self.owners[name] = owner
+
+    def release(self, name: Optional[str], owner):
+        with self._lock:
+            if name is not None and self.owners.get(name) is owner:
+                del self.owners[name]
+
+    def __contains__(self, name: str):
+        return name in self.owners
+
+
+class NameSuggestions:
+    """
+    free names close to a taken one, numbered variants first and then names of a word list that share its start.
+    the word list is sorted once so a prefix is found by bisection
+    """
+
+    def __init__(self, words: Iterable[str] = ()):
+        self.words: List[str] = sorted({word for word in (word.strip().lower() for word in words)
+                                        if valid_username(word)})
+
+    @staticmethod
+    def load(path: str) -> 'NameSuggestions':
+        with open(path, 'r', encoding='utf-8') as file:
+            return NameSuggestions(file)
+
+    def with_prefix(self, prefix: str) -> Iterable[str]:
+        for index in range(bisect.bisect_left(self.words, prefix), len(self.words)):
+            if not self.words[index].startswith(prefix):
+                return
+            yield self.words[index]
+
+    def suggest(self, name: str, is_free: Callable[[str], bool], count=3) -> List[str]:
+        suggestions: List[str] = []
+        for candidate in self.candidates(name):
+            if candidate not in suggestions and is_free(candidate):
+                suggestions.append(candidate)
+                if len(suggestions) == count:
+                    break
+        return suggestions
+
+    def candidates(self, name: str) -> Iterable[str]:
+        stem = name.rstrip('0123456789')
+        numbered = valid_username(f'{stem}1')  # an invalid name only gets words
+        if numbered:
+            yield f'{stem}1'
+        for length in range(min(len(name), 3), 0, -1):
+            yield from self.with_prefix(name[:length])
+        if numbered:
+            yield from (f'{stem}{number}' for number in range(2, 1000))